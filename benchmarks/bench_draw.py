@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the formats to send drawings from smartview: json and binary.
+
+For each tree size it draws a whole random tree (with leaf names) with
+the leaves big enough to be seen, as when exporting it. For each format
+it shows the time until the first chunk is ready, the total time, and
+the size of the data (plain and brotli-compressed).
+"""
+
+import time
+import random
+from argparse import ArgumentParser
+
+import brotli
+
+from ete4 import Tree
+from ete4.core import operations as ops
+from ete4.smartview import TreeStyle
+from ete4.smartview.renderer import drawer, binary
+from ete4.smartview.renderer.layouts.default_layouts import LayoutLeafName
+from ete4.smartview.gui.server import json_stream
+
+
+def main():
+    args = get_args()
+
+    random.seed(args.seed)
+
+    print('%-8s %-7s %9s %9s %9s %9s %11s' % (
+        'leaves', 'format', 'elements', 'first(s)', 'total(s)', 'MB', 'MB brotli'))
+
+    for nleaves in args.leaves:
+        t = Tree()
+        t.populate(nleaves, dist_fn=random.random, support_fn=random.random)
+        ops.update_sizes_all(t)
+
+        w, h = t.size
+        zoom = (args.width / w, args.leaf_size, 1)
+        viewport = (0, 0, w, h)
+        layouts = [LayoutLeafName()]
+
+        def draw():
+            d = drawer.DrawerRectFaces(t, viewport, zoom=zoom, layouts=layouts,
+                                       tree_style=TreeStyle())
+            return d.draw()
+
+        nelements = len(list(draw()))  # (and initializes the faces)
+
+        tolerance = 0.01 / max(zoom)
+        streams = {
+            'json': lambda: json_stream(draw(), 64 * 1024),
+            'binary': lambda: binary.stream(draw(), tolerance, 64 * 1024)}
+
+        for fmt, stream in streams.items():
+            t0 = time.perf_counter()
+            chunks = stream()
+            first = next(chunks)
+            t_first = time.perf_counter() - t0
+            data = first + b''.join(chunks)
+            t_total = time.perf_counter() - t0
+
+            mb = len(data) / 1e6
+            mb_brotli = len(brotli.compress(data, quality=args.quality)) / 1e6
+
+            print('%-8d %-7s %9d %9.3f %9.3f %9.2f %11.2f' % (
+                nleaves, fmt, nelements, t_first, t_total, mb, mb_brotli))
+
+
+def get_args():
+    parser = ArgumentParser(description=__doc__)
+
+    add = parser.add_argument  # shortcut
+    add('-n', '--leaves', type=int, nargs='+', default=[1_000, 10_000, 50_000],
+        help='number of leaves of the trees')
+    add('--width', type=float, default=1000, help='width of the view (pixels)')
+    add('--leaf-size', type=float, default=10, help='height of a leaf (pixels)')
+    add('-q', '--quality', type=int, default=5, help='brotli quality')
+    add('--seed', type=int, default=0, help='random seed')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark reading and writing newicks: nodes per second for different shapes.
+
+Shapes:
+  balanced     random Yule tree (typical phylogeny)
+  caterpillar  maximally unbalanced tree (one nesting level per leaf)
+  star         one root with all the leaves as children
+"""
+
+import sys
+import time
+import random
+from argparse import ArgumentParser
+
+from ete4 import Tree
+from ete4.parser import newick
+
+
+def main():
+    args = get_args()
+
+    random.seed(args.seed)
+
+    print('%-12s %10s %14s %14s' % ('shape', 'nodes', 'read nodes/s',
+                                     'write nodes/s'))
+    for shape in args.shapes:
+        text = make_newick(shape, args.leaves)
+        nnodes = text.count(',') + text.count('(') + 1
+
+        t_read = min(timeit(newick.loads, text) for _ in range(args.repeat))
+
+        t = newick.loads(text)
+        t_write = min(timeit(newick.dumps, t) for _ in range(args.repeat))
+
+        print('%-12s %10d %14.0f %14.0f' % (shape, nnodes, nnodes / t_read,
+                                             nnodes / t_write))
+
+
+def make_newick(shape, nleaves):
+    """Return the newick of a tree with the given shape and number of leaves."""
+    # The texts are built directly so we do not depend on the writer.
+    if shape == 'balanced':
+        t = Tree()
+        t.populate(nleaves, dist_fn=random.random, support_fn=random.random)
+        return t.write()
+    elif shape == 'caterpillar':
+        leaves = ['n%d:%g' % (i, random.random()) for i in range(nleaves)]
+        return ('(' * (nleaves - 1) + leaves[0] + ',' +
+                '):0.5,'.join(leaves[1:]) + ');')
+    elif shape == 'star':
+        return '(%s);' % ','.join('n%d:%g' % (i, random.random())
+                                  for i in range(nleaves))
+    else:
+        sys.exit(f'Unknown shape: {shape}')
+
+
+def timeit(f, *args):
+    """Return the time it takes to run f(*args)."""
+    t0 = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - t0
+
+
+def get_args():
+    parser = ArgumentParser(description=__doc__)
+
+    add = parser.add_argument  # shortcut
+    add('-n', '--leaves', type=int, default=100_000, help='number of leaves')
+    add('-r', '--repeat', type=int, default=3, help='repetitions (best is shown)')
+    add('-s', '--shapes', nargs='+', default=['balanced', 'caterpillar', 'star'],
+        help='tree shapes to test')
+    add('--seed', type=int, default=0, help='random seed')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the computation of the distance matrix of treediff.
+
+For a pair of random trees with the same leaf names, it computes the
+matrix of distances between all their nodes (as treediff does before
+matching them) and shows the throughput in cells per second. For
+comparison, it also shows the throughput of calling the distance
+function for each pair (as it was done before), on a sample of rows.
+"""
+
+import time
+import random
+from argparse import ArgumentParser
+
+from ete4 import Tree
+from ete4.tools import ete_diff
+
+
+def main():
+    args = get_args()
+
+    random.seed(args.seed)
+
+    names = ['leaf%d' % i for i in range(args.leaves)]
+    t1, t2 = Tree(), Tree()
+    t1.populate(args.leaves, names=names, dist_fn=random.random)
+    t2.populate(args.leaves, names=random.sample(names, len(names)),
+                dist_fn=random.random)
+
+    parts1 = sorted(t1.get_cached_content('name').items(), key=lambda x: len(x[1]))
+    parts2 = sorted(t2.get_cached_content('name').items(), key=lambda x: len(x[1]))
+    ncells = len(parts1) * len(parts2)
+
+    print(f'{args.leaves} leaves, matrix of {len(parts1)} x {len(parts2)} '
+          f'({ncells / 1e6:.1f} M cells), {args.jobs} jobs')
+    print('%-12s %12s %14s %14s' % ('distance', 'time(s)', 'cells/s', 'before(cells/s)'))
+
+    for name in args.distances:
+        dist_fn = getattr(ete_diff, name)
+
+        parallel = 'async' if args.jobs > 1 else None
+        sample = random.sample(parts1, min(args.sample, len(parts1)))
+
+        t0 = time.perf_counter()
+        if name == 'RF_DIST':  # too slow for the whole matrix
+            ete_diff.distance_matrix(sample, parts2, dist_fn, False,
+                                     'name', 'name', args.jobs, parallel)
+            n = len(sample) * len(parts2)
+        else:
+            ete_diff.distance_matrix(parts1, parts2, dist_fn, False,
+                                     'name', 'name', args.jobs, parallel)
+            n = ncells
+        t = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for a in sample:
+            for b in parts2:
+                dist_fn(a, b, False, 'name', 'name')
+        t_before = time.perf_counter() - t0
+
+        print('%-12s %12.2f %14.3g %14.3g' % (
+            name, t, n / t, len(sample) * len(parts2) / t_before))
+
+
+def get_args():
+    parser = ArgumentParser(description=__doc__)
+
+    add = parser.add_argument  # shortcut
+    add('-n', '--leaves', type=int, default=10_000, help='number of leaves')
+    add('-j', '--jobs', type=int, default=1, help='number of processes')
+    add('-d', '--distances', nargs='+', default=['EUCL_DIST', 'EUCL_DIST_B', 'RF_DIST'],
+        help='distance functions to use')
+    add('--sample', type=int, default=5, help='rows to compute pair by pair')
+    add('--seed', type=int, default=0, help='random seed')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,571 @@
+"""
+Trees as arrays, for fast (vectorized) computations on their nodes.
+
+A FlatTree has the topology and branch lengths of a tree as numpy arrays,
+with the nodes in preorder (so node 0 is the root, and the subtree of
+node i is formed by the nodes i, i+1, ..., end[i]-1).
+
+Example::
+
+  ft = tree.to_arrays()
+  ft.root_distances()  # array with the distance from the root to each node
+  ft.nodes[i]  # the node object (in the original tree) for position i
+
+It also has an index (LcaIndex) to find the common ancestor and distance
+between any two nodes in constant time.
+"""
+
+import numpy as np
+
+
+# Counter used to stamp the changes in trees. All the nodes of a tree share
+# a Stamps object with the values of the counter at its last changes, so an
+# index built when they were different is considered outdated.
+edits = 0
+tracking = False  # are changes stamped? (only since some index needs them)
+
+
+cdef class Stamps:
+    """Stamps of the last changes in a tree (shared by its nodes)."""
+
+    cdef public long edits  # of the last change in topology or dists
+    cdef public long prop_edits  # of the last change of any kind
+    cdef public Stamps merged  # the stamps used instead, once trees are joined
+
+    def __init__(self, long stamp=0):
+        self.edits = self.prop_edits = stamp
+
+    def __reduce__(self):
+        return new_stamps, ()  # a copied tree is a different tree
+
+
+def new_stamps():
+    """Return stamps for a tree that was not stamped before."""
+    global edits
+    edits += 1
+    return Stamps(edits)
+
+
+def stamps_of(node):
+    """Return the stamps of the tree of node (creating them if needed).
+
+    The nodes keep a reference to them, which is set when first looked
+    for (so we only go up until a node that has it). When trees are
+    joined, the stamps of one are merged into the other's.
+    """
+    path = []  # nodes that will point directly to the stamps
+    while node._stamps is None and node.up is not None:
+        path.append(node)
+        node = node.up
+
+    stamps = node._stamps
+    if stamps is None:  # we reached the root of a tree with no stamps yet
+        stamps = new_stamps()
+    elif stamps.merged is not None:
+        while stamps.merged is not None:
+            stamps = stamps.merged
+        merged = node._stamps
+        while merged is not stamps:  # make the merged ones point to the last
+            merged.merged, merged = stamps, merged.merged
+
+    node._stamps = stamps
+    for node in path:
+        node._stamps = stamps
+
+    return stamps
+
+
+def mark_edit(node, topology=True):
+    """Register that the tree of node changed (so its indices are outdated).
+
+    :param topology: If False, only properties other than dist changed
+        (which outdates what depends on them, but not the topology indices).
+    """
+    global edits
+
+    if not tracking or (node._stamps is None and node.up is None):
+        return  # no index was ever built (for the tree), nothing to outdate
+
+    edits += 1
+
+    stamps = stamps_of(node)
+    stamps.prop_edits = edits
+    if topology:
+        stamps.edits = edits
+
+
+def join_stamps(node, parent):
+    """Make the tree of node share the stamps of the tree of parent.
+
+    Needed before node hangs from parent, if node's tree has stamps.
+    """
+    if tracking and node._stamps is not None:
+        stamps, parent_stamps = stamps_of(node), stamps_of(parent)
+        if stamps is not parent_stamps:
+            stamps.merged = parent_stamps
+
+
+def get_edits(tree, props=False):
+    """Return the stamp of the last change in the tree of the given node.
+
+    :param props: If True, consider any change of the properties of its
+        nodes too (not only changes in the topology and dists).
+    """
+    global tracking
+    tracking = True
+
+    stamps = stamps_of(tree)
+    return stamps.prop_edits if props else stamps.edits
+
+
+class FlatTree:
+    """Topology and branch lengths of a tree, as arrays with its nodes in preorder.
+
+    Arrays (of size n, the number of nodes, unless specified):
+
+    - parent: position of the parent of each node (-1 for the root)
+    - end: position after the last node in the subtree of each node
+    - depth: number of branches from the root to each node
+    - dist: branch length of each node (nan if it has none)
+    - child_offsets (size n+1) and children: the children of node i are
+      children[child_offsets[i]:child_offsets[i+1]]
+    - preorder, postorder: positions of the nodes in those traversals
+    """
+
+    def __init__(self, tree):
+        self.nodes, parent, end = get_nodes_parents_and_ends(tree)
+
+        n = len(self.nodes)
+        self.parent = np.array(parent, dtype=np.int_)
+        self.end = np.array(end, dtype=np.int_)
+
+        self.dist = np.array([node.props.get('dist', np.nan)
+                              for node in self.nodes], dtype=float)
+
+        self.depth = get_depths(self.parent)
+
+        # Children in CSR-like format (sorted by position, since it's stable).
+        counts = np.bincount(self.parent[1:], minlength=n)
+        self.child_offsets = np.zeros(n + 1, dtype=np.int_)
+        np.cumsum(counts, out=self.child_offsets[1:])
+        self.children = np.argsort(self.parent[1:], kind='stable') + 1
+
+        self.preorder = np.arange(n)
+
+        # The nodes before node i in postorder are all the ones before the
+        # end of its subtree, except itself and its ancestors.
+        self.postorder = np.empty(n, dtype=np.int_)
+        self.postorder[self.end - 1 - self.depth] = self.preorder
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return f'<FlatTree with {len(self)} nodes at {hex(id(self))}>'
+
+    @property
+    def is_leaf(self):
+        """Array with True for the leaves."""
+        return self.end == self.preorder + 1
+
+    @property
+    def leaves(self):
+        """Positions of the leaves (in preorder)."""
+        return np.flatnonzero(self.is_leaf)
+
+    def subtree_sizes(self):
+        """Return the number of nodes in the subtree of each node."""
+        return self.end - self.preorder
+
+    def leaf_counts(self):
+        """Return the number of leaves in the subtree of each node."""
+        start, stop = self.leaf_ranges()
+        return stop - start
+
+    def leaf_ranges(self):
+        """Return arrays start, stop with the leaves under each node.
+
+        The leaves under node i are leaves[start[i]:stop[i]].
+        """
+        nleaves_before = np.zeros(len(self) + 1, dtype=np.int_)
+        np.cumsum(self.is_leaf, out=nleaves_before[1:])
+        return nleaves_before[self.preorder], nleaves_before[self.end]
+
+    def root_distances(self, topological=False):
+        """Return the distance from the root to each node.
+
+        :param topological: If True, use the number of branches instead
+            of their lengths.
+        """
+        if topological:
+            return self.depth.astype(float)
+
+        return get_root_distances(self.parent, self.dist)
+
+    def heights(self, topological=False):
+        """Return the distance from each node to its furthest leaf."""
+        if topological:
+            dist = np.ones(len(self))
+            dist[0] = 0
+        else:
+            dist = self.dist
+        return get_heights(self.parent, dist)
+
+    def lca(self, nodes1, nodes2):
+        """Return the positions of the lowest common ancestors of the pairs.
+
+        :param nodes1: Positions of the first nodes of each pair.
+        :param nodes2: Positions of the second nodes of each pair.
+        """
+        u = np.asarray(nodes1, dtype=np.int_).ravel()
+        v = np.asarray(nodes2, dtype=np.int_).ravel()
+        u, v = np.minimum(u, v), np.maximum(u, v)
+
+        # The shallowest node in (u, v] (in preorder) is a child of the lca.
+        lo, hi = np.minimum(u + 1, v), v  # (lo = hi when u = v, ignored later)
+        table = self.sparse_table()
+        k = self._log2[hi - lo + 1]
+        a, b = table[k, lo], table[k, hi - (1 << k) + 1]
+        shallowest = np.where(self.depth[a] <= self.depth[b], a, b)
+
+        return np.where(u == v, u, self.parent[shallowest])
+
+    def sparse_table(self):
+        """Return the table to find the shallowest node in a range in O(1).
+
+        table[k, i] is the position of the shallowest node in
+        [i, i + 2**k). It is computed the first time it is needed.
+        """
+        if getattr(self, '_table', None) is None:
+            self._table = get_sparse_table(self.depth)
+            self._log2 = np.zeros(len(self) + 1, dtype=np.int_)
+            self._log2[2:] = np.floor(np.log2(np.arange(2, len(self) + 1)))
+        return self._table
+
+    def distances(self, nodes1, nodes2, topological=False):
+        """Return the distances between the pairs of nodes."""
+        nodes1 = np.asarray(nodes1, dtype=np.int_).ravel()
+        nodes2 = np.asarray(nodes2, dtype=np.int_).ravel()
+        d = self.root_distances(topological)
+        return d[nodes1] + d[nodes2] - 2 * d[self.lca(nodes1, nodes2)]
+
+    def cophenetic_matrix(self, nodes=None, dtype=np.float64,
+                          condensed=False, out=None):
+        """Return the matrix of distances between the given nodes.
+
+        :param nodes: Positions of the nodes (all the leaves if None).
+        :param dtype: Type of the values of the matrix (like np.float32).
+        :param condensed: If True, return only the upper triangle (without
+            the diagonal) as a 1D array, like scipy's pdist().
+        :param out: Array (like a np.memmap) where to write the matrix.
+        """
+        nodes = self.leaves if nodes is None else np.asarray(nodes, dtype=np.int_)
+        m, n = len(nodes), len(self)
+
+        shape = (m * (m - 1) // 2,) if condensed else (m, m)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError(f'output array with shape {out.shape} '
+                             f'instead of {shape}')
+
+        # The lca of two nodes is the shallowest of the lcas of the
+        # consecutive nodes (in preorder) between them. We use keys so the
+        # minimum key corresponds to the shallowest node (a lca).
+        order = np.argsort(nodes, kind='stable')  # to go through them in preorder
+        nodes_sorted = nodes[order]
+        lcas = self.lca(nodes_sorted[:-1], nodes_sorted[1:])
+        keys = self.depth[lcas] * n + lcas
+
+        root_dists = self.root_distances()
+        d = root_dists[nodes_sorted]  # root distances of the nodes
+
+        in_order = bool((order == np.arange(m)).all())  # so we can use slices
+
+        for p in range(m):  # for each row (in preorder)
+            i = order[p]
+
+            if p < m - 1:  # distances to the nodes after it (in preorder)
+                lcas_after = np.minimum.accumulate(keys[p:]) % n
+                dists = d[p] + d[p+1:] - 2 * root_dists[lcas_after]
+                if condensed and in_order:
+                    start = m * p - p * (p + 1) // 2
+                    out[start:start + m - p - 1] = dists
+                elif condensed:
+                    js = order[p+1:]
+                    a, b = np.minimum(i, js), np.maximum(i, js)
+                    out[m * a - a * (a + 1) // 2 + b - a - 1] = dists
+                else:
+                    out[i, order[p+1:] if not in_order else slice(p+1, m)] = dists
+
+            if not condensed:
+                out[i, i] = 0
+                if p > 0:  # distances to the nodes before it
+                    lcas_before = np.minimum.accumulate(keys[p-1::-1])[::-1] % n
+                    dists = d[p] + d[:p] - 2 * root_dists[lcas_before]
+                    out[i, order[:p] if not in_order else slice(0, p)] = dists
+
+        return out
+
+    def index(self, node):
+        """Return the position of the given node."""
+        try:
+            return self._positions[node]
+        except AttributeError:
+            self._positions = {n: i for i, n in enumerate(self.nodes)}
+            return self._positions[node]
+
+    def to_ultrametric(self, topological=False, write=True):
+        """Convert the dists so all leaves are equidistant from the root.
+
+        The leaves end at the original distance from the root to its
+        furthest leaf. If the tree has missing dists (or topological is
+        True), the original dists are ignored and only the topology is used.
+
+        :param write: If True, write the new dists to the nodes too.
+        """
+        dist = self.dist.copy()
+        dist[0] = 0 if np.isnan(dist[0]) else dist[0]
+
+        # Original distance from root to furthest leaf (missing dists as 1).
+        heights = get_heights(self.parent, dist)
+        dist_full = heights[0]
+
+        if topological or dist_full <= 0 or np.isnan(dist).any():
+            dist = np.ones(len(self))  # ignore the original distances
+            dist[0] = 0
+            heights = get_heights(self.parent, dist)
+            dist_full = dist_full if dist_full > 0 else heights[0]
+
+        self.dist = stretch(self.parent, dist, heights, dist_full)
+
+        if write:
+            self.set_prop('dist', self.dist)
+
+    def update_sizes(self):
+        """Set the sizes of all the nodes (like operations.update_sizes_all)."""
+        heights = get_heights(self.parent, self.dist)
+        nleaves = self.leaf_counts()
+
+        for node, dx, nl in zip(self.nodes, heights.tolist(), nleaves.tolist()):
+            node.size = (dx, nl)
+
+    def set_prop(self, pname, values):
+        """Set the property pname of the nodes to the given values."""
+        values = values.tolist() if hasattr(values, 'tolist') else values
+        for node, value in zip(self.nodes, values):
+            node.props[pname] = value
+
+        mark_edit(self.nodes[0])
+
+
+def get_nodes_parents_and_ends(tree):
+    """Return the nodes in preorder, their parents and the ends of subtrees."""
+    cdef long i, j
+    cdef list nodes = [], parents = [], ends = []
+    cdef list pending = [tree], pending_parents = [-1]
+
+    while pending:
+        node = pending.pop()
+
+        if node is None:  # marks the end of the subtree of pending_parents[-1]
+            ends[pending_parents.pop()] = len(nodes)
+            continue
+
+        i = len(nodes)
+        nodes.append(node)
+        parents.append(pending_parents.pop())
+        ends.append(0)  # will be set once we go through its subtree
+
+        pending.append(None)
+        pending_parents.append(i)
+
+        children = node.children  # a list, or a tuple in mapped trees
+        for j in range(len(children) - 1, -1, -1):
+            pending.append(children[j])
+            pending_parents.append(i)
+
+    return nodes, parents, ends
+
+
+def get_depths(const long[:] parent):
+    """Return the number of branches from the root to each node."""
+    cdef long i, n = len(parent)
+
+    depths = np.zeros(n, dtype=np.int_)
+    cdef long[:] d = depths
+
+    for i in range(1, n):  # parents come before their children
+        d[i] = d[parent[i]] + 1
+
+    return depths
+
+
+def get_root_distances(const long[:] parent, const double[:] dist):
+    """Return the sum of dists from the root to each node."""
+    cdef long i, n = len(parent)
+
+    distances = np.zeros(n)
+    cdef double[:] d = distances
+
+    for i in range(1, n):
+        d[i] = d[parent[i]] + dist[i]
+
+    return distances
+
+
+def get_heights(const long[:] parent, const double[:] dist, double default=1):
+    """Return the distance from each node to its furthest leaf (plus its dist).
+
+    Missing dists (nan) take the default value, except for the root (0).
+    """
+    cdef long i, p, n = len(parent)
+    cdef double d
+
+    heights = np.zeros(n)
+    cdef double[:] h = heights
+    cdef double[:] h_children = np.zeros(n)  # max height of the children
+
+    for i in range(n - 1, -1, -1):  # children come after their parents
+        d = dist[i]
+        if d != d:  # nan
+            d = default if i > 0 else 0
+        h[i] = d + h_children[i]
+        if i > 0:
+            p = parent[i]
+            h_children[p] = max(h_children[p], h[i])
+
+    return heights
+
+
+def get_sparse_table(depth):
+    """Return table with the shallowest node in all ranges of size 2**k."""
+    n = len(depth)
+    nlevels = max(1, int(n).bit_length())
+
+    table = np.empty((nlevels, n), dtype=np.int32)
+    table[0] = np.arange(n)
+    for k in range(1, nlevels):
+        half = 1 << (k - 1)
+        a, b = table[k-1, :n-half], table[k-1, half:]
+        table[k, :n-half] = np.where(depth[a] <= depth[b], a, b)
+        table[k, n-half:] = table[k-1, n-half:]  # (never used in queries)
+
+    return table
+
+
+def stretch(const long[:] parent, const double[:] dist,
+            const double[:] heights, double dist_full):
+    """Return the dists changed to make all leaves at dist_full from root."""
+    cdef long i, n = len(parent)
+
+    new_dists = np.array(dist)
+    cdef double[:] new = new_dists
+    cdef double[:] above = np.zeros(n)  # sum of new dists of the ancestors
+
+    for i in range(n):
+        if i > 0:
+            above[i] = above[parent[i]] + new[parent[i]]
+        if new[i] > 0:
+            new[i] *= (dist_full - above[i]) / heights[i]
+
+    return new_dists
+
+
+cdef class LcaIndex:
+    """Index to find common ancestors and distances between nodes in O(1).
+
+    It is updated automatically when it is used after a tree changes.
+
+    Example::
+
+      index = tree.get_lca_index()
+      index.common_ancestor(n1, n2)  # same as tree.common_ancestor([n1, n2])
+      index.get_distance(n1, n2)  # same as tree.get_distance(n1, n2)
+    """
+
+    cdef public object tree, flat
+    cdef public dict positions
+    cdef long edits
+    cdef const int[:, :] table
+    cdef const long[:] parent, depth, log2
+    cdef const double[:] root_dists
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.update()
+
+    def update(self):
+        """Recompute the index for the current state of the tree."""
+        self.flat = FlatTree(self.tree)
+        self.positions = {node: i for i, node in enumerate(self.flat.nodes)}
+
+        self.table = self.flat.sparse_table()
+        self.parent = self.flat.parent
+        self.depth = self.flat.depth
+        self.log2 = self.flat._log2
+        self.root_dists = self.flat.root_distances()
+
+        self.edits = get_edits(self.tree)
+
+    def position(self, node):
+        """Return the position of the node in the index (updating if needed)."""
+        if self.edits != get_edits(self.tree):
+            self.update()
+
+        try:
+            return self.positions[node]
+        except KeyError:
+            from .tree import TreeError  # not at the top: circular import
+            raise TreeError(f'node not in tree: {node}')
+
+    def common_ancestor(self, node1, node2):
+        """Return the last node common to the lineages of node1 and node2."""
+        i = self.position(node1)
+        return self.flat.nodes[self.lca(i, self.position(node2))]
+
+    def get_distance(self, node1, node2, topological=False):
+        """Return the distance between the given nodes.
+
+        :param topological: If True, the distance is the number of
+            branches between the nodes (instead of the sum of their dists).
+        """
+        cdef long i = self.position(node1), j = self.position(node2)
+        cdef long k = self.lca(i, j)
+
+        if topological:
+            return self.depth[i] + self.depth[j] - 2 * self.depth[k]
+        else:
+            return self.root_dists[i] + self.root_dists[j] - 2 * self.root_dists[k]
+
+    cpdef long lca(self, long i, long j):
+        """Return the position of the lowest common ancestor of nodes i and j."""
+        if i == j:
+            return i
+        elif j < i:
+            i, j = j, i
+
+        cdef long lo = i + 1, k = self.log2[j - i]
+        cdef long a = self.table[k, lo], b = self.table[k, j - (1 << k) + 1]
+
+        return self.parent[a if self.depth[a] <= self.depth[b] else b]
+
+    def common_ancestors(self, nodes1, nodes2):
+        """Return array with the positions of the lcas of the pairs (batched).
+
+        :param nodes1: Array with the positions of the first node of each pair.
+        :param nodes2: Array with the positions of the second node of each pair.
+        """
+        if self.edits != get_edits(self.tree):
+            self.update()
+
+        return self.flat.lca(nodes1, nodes2)
+
+    def distances(self, nodes1, nodes2, topological=False):
+        """Return array with the distances between the pairs (batched)."""
+        nodes1 = np.asarray(nodes1, dtype=np.int_).ravel()
+        nodes2 = np.asarray(nodes2, dtype=np.int_).ravel()
+        lcas = self.common_ancestors(nodes1, nodes2)
+
+        d = np.asarray(self.depth) if topological else np.asarray(self.root_dists)
+        return d[nodes1] + d[nodes2] - 2 * d[lcas]
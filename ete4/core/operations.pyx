@@ -7,11 +7,15 @@ Sorting, changing the root to a node, moving branches, removing (prunning)...
 import random
 from collections import namedtuple, deque
 
+from .flat_tree import FlatTree, mark_edit
+
 
 def sort(tree, key=None, reverse=False):
     """Sort the tree in-place."""
     key = key or (lambda node: (node.size[1], node.size[0], node.name))
 
+    mark_edit(tree)  # the order of the nodes changes
+
     for node in tree.traverse('postorder'):
         node.children.sort(key=key, reverse=reverse)
 
@@ -42,7 +46,9 @@ def root_at(node, bprops=None):
         current_root = rehang(current_root, child_pos, bprops)
 
     if len(old_root.children) == 1:
-        join_branch(old_root, bprops)
+        join_branch(old_root, bprops)  # also updates the sizes
+    else:
+        update_sizes_from(old_root)  # old_root is the end of the changed path
 
 
 def interchange_references(node1, node2):
@@ -53,14 +59,18 @@ def interchange_references(node1, node2):
     if node1 is node2:
         return
 
+    mark_edit(node1)
+    mark_edit(node2)  # (in case they are in different trees)
+
     # Interchange properties.
     node1.props, node2.props = node2.props, node1.props
 
-    # Interchange children.
-    children1 = node1.remove_children()
-    children2 = node2.remove_children()
-    node1.add_children(children2)
-    node2.add_children(children1)
+    # Interchange children (directly, since the tree can have cycles meanwhile).
+    node1._children, node2._children = node2._children, node1._children
+    for child in node1.children:
+        child.up = node1
+    for child in node2.children:
+        child.up = node2
 
     # Interchange parents.
     up1 = node1.up
@@ -79,6 +89,8 @@ def interchange_references(node1, node2):
     node1.up = up2
     node2.up = up1
 
+    update_sizes_of([node1, node2])
+
 
 def set_outgroup(node, bprops=None, dist=None):
     """Change tree so the given node is set as outgroup.
@@ -125,6 +137,9 @@ def rehang(root, child_pos, bprops=None):
 
 def swap_props(n1, n2, props):
     """Swap properties between nodes n1 and n2."""
+    mark_edit(n1)
+    mark_edit(n2)
+
     for pname in props:
         p1 = n1.props.pop(pname, None)
         p2 = n2.props.pop(pname, None)
@@ -137,6 +152,8 @@ def swap_props(n1, n2, props):
 def insert_intermediate(node, intermediate, bprops=None, dist=None):
     """Insert, between node and its parent, an intermediate node."""
     # == up ======= node  ->  == up === intermediate === node
+    mark_edit(node)
+
     up = node.up
 
     pos_in_parent = up.children.index(node)  # save its position in parent
@@ -157,12 +174,16 @@ def insert_intermediate(node, intermediate, bprops=None, dist=None):
     up.children.insert(pos_in_parent, intermediate)  # put new where old was
     intermediate.up = up
 
+    update_sizes_from(node)
+
 
 def join_branch(node, bprops=None):
     """Substitute node for its only child."""
     # == node ==== child  ->  ====== child
     assert len(node.children) == 1, 'cannot join branch with multiple children'
 
+    mark_edit(node)
+
     child = node.children[0]
 
     for pname in ['support'] + (bprops or []):
@@ -179,6 +200,8 @@ def join_branch(node, bprops=None):
     up.children.insert(pos_in_parent, child)  # put child where the old node was
     child.up = up
 
+    update_sizes_from(child)
+
 
 def unroot(tree, bprops=None):
     """Unroot the tree (make the root not have 2 children).
@@ -201,6 +224,8 @@ def move(node, shift=1):
     #     ╰╴sibling          ╰╴node
     assert node.up, 'cannot move the root'
 
+    mark_edit(node)
+
     siblings = node.up.children
 
     pos_old = siblings.index(node)
@@ -216,6 +241,70 @@ def remove(node):
     parent = node.up
     parent.remove_child(node)
 
+    update_sizes_from(parent)
+
+
+def prune(tree, nodes, preserve_branch_length=False):
+    """Prune the tree conserving only the given nodes (and its root).
+
+    The nodes that join two or more of the conserved ones are conserved
+    too, except if they would be the only child of a conserved node.
+    The tree is traversed only once (and sizes updated), in O(n) time.
+
+    :param tree: Tree (or subtree) to prune.
+    :param nodes: Nodes of the tree that should be kept.
+    :param preserve_branch_length: If True, the dists of removed nodes
+        are added to the branches that replace them.
+    """
+    keep = set(nodes)
+    cdef dict tops = {}  # node -> conserved nodes that will hang from its parent
+    cdef list below
+    cdef bint changed
+
+    mark_edit(tree)
+
+    for node in list(tree.traverse('postorder')):
+        below = []  # conserved nodes that will hang from node
+        changed = False  # will node have different children than now?
+        for child in node.children:
+            child_tops = tops.pop(child)
+            below += child_tops
+            changed = changed or len(child_tops) != 1 or child_tops[0] is not child
+
+        if node in keep or node is tree:
+            if len(below) == 1 and below[0] not in keep and len(below[0].children) > 1:
+                # It only joins nodes below, so we take its place.
+                joined = below[0]
+                if preserve_branch_length and node.dist is not None and joined.dist is not None:
+                    node.dist += joined.dist
+                below = joined.children
+                changed = True
+        elif len(below) == 1:  # a node that we remove, leaving its branch
+            if preserve_branch_length and node.dist is not None and below[0].dist is not None:
+                below[0].dist += node.dist
+            tops[node] = below
+            node.up = None
+            continue
+        elif not below:  # a node with nothing to conserve below
+            tops[node] = below
+            node.up = None
+            continue
+
+        # We conserve node (it was given or joins several conserved nodes).
+        if changed:
+            node._children = below  # not with add_children(), to stay O(n)
+            for child in below:
+                child.up = node
+
+        if preserve_branch_length:  # their dists may have changed
+            for child in below:
+                update_size(child)
+        update_size(node)
+
+        tops[node] = [node]
+
+    update_sizes_from(tree.up)
+
 
 # Functions that used to be defined inside tree.pyx.
 
@@ -332,7 +421,7 @@ def add_branch_values(root, dist_fn, support_fn):
     # Make sure the children of root have the same support.
     if any(node.support is None for node in root.children):
         for node in root.children:
-            node.props.pop('support', None)
+            node.support = None
     else:
         for node in root.children[1:]:
             node.support = root.children[0].support
@@ -387,6 +476,8 @@ def ladderize(tree, topological=False, reverse=False):
       #            ╰──┬╴a
       #               ╰╴b
     """
+    mark_edit(tree)  # the order of the nodes changes
+
     sizes = {}  # sizes of the nodes
 
     # Key function for the sort order. Sort by size, then by # of children.
@@ -410,30 +501,15 @@ def ladderize(tree, topological=False, reverse=False):
 
 def to_dendrogram(tree):
     """Convert tree to dendrogram (remove all distance values)."""
+    mark_edit(tree)
+
     for node in tree.traverse():
         node.props.pop('dist', None)
 
 
 def to_ultrametric(tree, topological=False):
     """Convert tree to ultrametric (all leaves equidistant from root)."""
-    tree.dist = tree.dist or 0  # covers common case of not having dist set
-
-    update_sizes_all(tree)  # so node.size[0] are distances to leaves
-
-    dist_full = tree.size[0]  # original distance from root to furthest leaf
-
-    if (topological or dist_full <= 0 or
-        any(node.dist is None for node in tree.traverse())):
-        # Ignore original distances and just use the tree topology.
-        for node in tree.traverse():
-            node.dist = 1 if node.up else 0
-        update_sizes_all(tree)
-        dist_full = dist_full if dist_full > 0 else tree.size[0]
-
-    for node in tree.traverse():
-        if node.dist > 0:
-            d = sum(n.dist for n in node.ancestors())
-            node.dist *= (dist_full - d) / node.size[0]
+    FlatTree(tree).to_ultrametric(topological)  # computed with arrays
 
 
 def resolve_polytomy(tree, descendants=True):
@@ -608,6 +684,11 @@ class Walker:
         node, nch = self.visiting[-1]
         self.visiting.append(TreePos(node=node.children[nch], nch=0))
 
+    def skip_siblings(self, n):
+        """Make the traversal skip the next n siblings of the current node."""
+        node, nch = self.visiting[-2]
+        self.visiting[-2] = TreePos(node, nch + n)
+
 
 def walk(tree):
     """Yield an iterator as it traverses the tree."""
@@ -628,6 +709,10 @@ def walk(tree):
 
 
 # Size-related functions.
+#
+# The editing operations above keep the sizes consistent by updating only
+# the nodes in the paths from the changed nodes to the root (the "dirty"
+# paths), so an edit costs O(depth) instead of the O(n) of update_sizes_all().
 
 def update_sizes_all(tree):
     """Update sizes of all the nodes in the tree."""
@@ -642,6 +727,30 @@ def update_sizes_from(node):
         node = node.up
 
 
+def update_sizes_of(nodes):
+    """Update the sizes of the given nodes and of all their ancestors.
+
+    Every node in the union of their paths to the root is updated only
+    once, and after all its (possibly changed) descendants.
+    """
+    cdef dict depths = {}  # dirty node -> depth
+    cdef list path
+    cdef long base, i
+
+    for node in nodes:
+        path = []  # nodes from node up to the first ancestor already seen
+        while node is not None and node not in depths:
+            path.append(node)
+            node = node.up
+
+        base = 0 if node is None else depths[node] + 1  # depth of path[-1]
+        for i in range(len(path)):
+            depths[path[i]] = base + len(path) - 1 - i
+
+    for node in sorted(depths, key=depths.get, reverse=True):
+        update_size(node)
+
+
 def update_size(node):
     """Update the size of the given node."""
     sumdists, nleaves = get_size(node.children)
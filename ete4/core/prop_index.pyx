@@ -0,0 +1,218 @@
+"""
+Indexes from the values of a node property to the nodes that have them.
+
+An index lives in the root of a tree (see Tree.create_index()), and
+lets searches like tree['A'] or tree.search_nodes(name='A') find the
+nodes without traversing the tree.
+
+The indexes are kept up to date by the tree methods that change
+properties (add_prop, del_prop, setting name, dist or support) or that
+add and remove nodes (add_child, detach, remove_child, delete...). Other
+changes in the topology (like set_outgroup or prune) make them be
+rebuilt the next time they are used. Changes made directly to
+node.props are not seen by the indexes.
+"""
+
+from weakref import WeakSet
+
+from . import flat_tree
+
+
+indexed = {}  # pname -> indexes of that property in any tree (for a quick check)
+
+
+def active():
+    """Return True if some index exists (and may need to be kept up to date)."""
+    return any(indexed.values())
+
+
+class PropIndex:
+    """Index of the nodes of a tree by the value of one of their properties.
+
+    Like LcaIndex, it is rebuilt when used after a change in the topology
+    (one that the tree methods could not follow).
+
+    Example::
+
+      index = tree.create_index('name')
+      index.get('A')  # list of nodes named 'A'
+    """
+
+    def __init__(self, tree, pname, build=True):
+        self.tree = tree
+        self.pname = pname
+        self.nodes = {}  # value -> {node: None} (an ordered set of nodes)
+        self.edits = -1  # stamp of the tree (flat_tree.get_edits()) when updated
+
+        indexed.setdefault(pname, WeakSet()).add(self)
+
+        if build:
+            self.update()
+
+    def __reduce__(self):
+        return PropIndex, (self.tree, self.pname, False)  # rebuilt when used
+
+    def update(self):
+        """Rebuild the index for the current state of the tree."""
+        self.nodes = {}
+        for node in self.tree.traverse():
+            self.add(node)
+
+        self.edits = flat_tree.get_edits(self.tree)
+
+    @property
+    def up_to_date(self):
+        return self.edits == flat_tree.get_edits(self.tree)
+
+    def get(self, value):
+        """Return the list of nodes with the given value (or None if unindexable)."""
+        if value is None:
+            return None  # nodes without the property are not indexed
+
+        if not self.up_to_date:
+            self.update()
+
+        try:
+            return list(self.nodes.get(value, ()))
+        except TypeError:
+            return None  # an unhashable value, which cannot be in the index
+
+    def add(self, node):
+        """Add node to the index (with its current value of the property)."""
+        value = node.props.get(self.pname)
+        if value is not None:
+            try:
+                self.nodes.setdefault(value, {})[node] = None
+            except TypeError:
+                pass  # unhashable values are not indexed
+
+    def remove(self, node):
+        """Remove node from the index (with its current value of the property)."""
+        value = node.props.get(self.pname)
+        try:
+            nodes = self.nodes.get(value)
+        except TypeError:
+            return  # unhashable values are not indexed
+
+        if nodes is not None:
+            nodes.pop(node, None)
+            if not nodes:
+                del self.nodes[value]
+
+    def add_subtree(self, tree):
+        for node in subtree(tree):
+            self.add(node)
+
+    def remove_subtree(self, tree):
+        for node in subtree(tree):
+            self.remove(node)
+
+
+def subtree(tree):
+    """Yield the nodes of tree, skipping the children that now hang elsewhere."""
+    # A node may still list as children nodes that were moved to another
+    # parent (like when deleting it), which are not part of its subtree.
+    pending = [tree]
+    while pending:
+        node = pending.pop()
+        yield node
+        pending.extend(child for child in node.children if child.up is node)
+
+
+def get_index(node, pname):
+    """Return the up-to-date index of pname in the tree of node, or None."""
+    if not indexed.get(pname):
+        return None
+
+    indexes = node.root._indexes
+    index = indexes.get(pname) if indexes else None
+    return index if index is not None and index.up_to_date else None
+
+
+def forget(index):
+    """Stop considering index as one that may need to be kept up to date."""
+    indexes = indexed.get(index.pname)
+    if indexes is not None:
+        indexes.discard(index)
+        if not indexes:
+            del indexed[index.pname]
+
+
+def get_indexes(root):
+    """Return the up-to-date indexes of the tree with the given root."""
+    indexes = root._indexes
+    return [index for index in indexes.values() if index.up_to_date] if indexes else []
+
+
+def attaching(node, parent):
+    """Update the indexes for node (and descendants) going to hang from parent.
+
+    Return the indexes that were updated, to be marked as up to date
+    (with stamp()) once the topology changes.
+    """
+    old_root = node.up.root if node.up is not None else node
+    new_root = parent.root
+
+    if old_root is new_root:
+        return get_indexes(new_root)  # moving within a tree changes no values
+
+    if old_root is node:
+        old = []  # its own indexes (if any) are not used while it is not a root
+    else:
+        old = get_indexes(old_root)
+        for index in old:
+            index.remove_subtree(node)
+
+    new = get_indexes(new_root)
+    for index in new:
+        index.add_subtree(node)
+
+    return old + new
+
+
+def detaching(node):
+    """Update the indexes for node (and descendants) leaving their tree.
+
+    Return the indexes that were updated, to be marked as up to date
+    (with stamp()) once the topology changes.
+    """
+    indexes = get_indexes(node.root)
+    for index in indexes:
+        index.remove_subtree(node)
+    return indexes
+
+
+def stamp(indexes):
+    """Mark the given indexes as up to date."""
+    for index in indexes:
+        index.edits = flat_tree.get_edits(index.tree)
+
+
+def set_prop(node, pname, value, keep_none=False):
+    """Set property pname of node to value, keeping its index up to date.
+
+    If value is None, the property is removed (unless keep_none is True).
+    """
+    index = get_index(node, pname)
+    if index:
+        index.remove(node)
+
+    if value is not None or keep_none:
+        node.props[pname] = value
+    else:
+        node.props.pop(pname, None)
+
+    flat_tree.mark_edit(node, topology=(pname == 'dist'))
+
+    if index:
+        index.add(node)
+        stamp([index])
+
+
+def descends(node, ancestor):
+    """Return True if node is ancestor or one of its descendants."""
+    while node is not None:
+        if node is ancestor:
+            return True
+        node = node.up
+    return False
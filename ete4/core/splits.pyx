@@ -0,0 +1,185 @@
+"""
+Splits of trees as bitsets, to compute Robinson-Foulds distances fast.
+
+Each leaf value (its name, or another property) gets a position in an
+index shared by all the trees, and the set of leaves under each node
+is then an int with those bits set. The (nontrivial) splits of a tree
+are computed once, and comparing two trees is just a few set operations.
+
+Example::
+
+  rf = rf_matrix(trees)  # all-vs-all Robinson-Foulds distances
+  nrf = rf_matrix(trees, normalized=True, processes=4)  # normalized, parallel
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .tree import TreeError
+
+
+if hasattr(int, 'bit_count'):  # python >= 3.10
+    popcount = int.bit_count
+else:
+    def popcount(x):
+        return bin(x).count('1')
+
+
+def rf_matrix(trees, trees2=None, prop='name', unrooted=False,
+              normalized=False, processes=None):
+    """Return a matrix with the Robinson-Foulds distances between trees.
+
+    The distances are the same as the ones from Tree.robinson_foulds(),
+    considering for each pair only the leaves they have in common.
+
+    :param trees: List of trees to compare (all against all).
+    :param trees2: If given, compare each tree in trees against these.
+    :param prop: Leaf property used to identify leaves across trees.
+    :param unrooted: If True, consider the trees as unrooted.
+    :param normalized: If True, divide each distance by its maximum
+        possible value (the number of splits of both trees).
+    :param processes: Number of processes to use (no extra ones if None).
+    """
+    index = {}  # leaf value -> position in the bitsets
+    splits1 = [get_splits(t, index, prop, unrooted) for t in trees]
+    splits2 = (splits1 if trees2 is None else
+               [get_splits(t, index, prop, unrooted) for t in trees2])
+
+    symmetric = trees2 is None
+    args = (splits1, splits2, unrooted, symmetric)
+
+    if processes is None:
+        set_comparison(*args)
+        rows = map(compare_row, range(len(splits1)))
+        return fill_matrix(rows, len(splits1), len(splits2), symmetric, normalized)
+    else:
+        with ProcessPoolExecutor(processes, initializer=set_comparison,
+                                 initargs=args) as pool:
+            chunksize = max(1, len(splits1) // (4 * processes))
+            rows = pool.map(compare_row, range(len(splits1)), chunksize=chunksize)
+            return fill_matrix(rows, len(splits1), len(splits2), symmetric, normalized)
+
+
+def fill_matrix(rows, n1, n2, symmetric, normalized):
+    """Return the matrix of distances with the values from the rows."""
+    rf = np.zeros((n1, n2), dtype=np.int_)
+    rf_max = np.zeros((n1, n2), dtype=np.int_)
+
+    for i, (rf_row, rf_max_row) in enumerate(rows):
+        start = i + 1 if symmetric else 0
+        rf[i, start:] = rf_row
+        rf_max[i, start:] = rf_max_row
+
+    if symmetric:  # copy the upper triangle into the lower one
+        rf += rf.T
+        rf_max += rf_max.T
+
+    if not normalized:
+        return rf
+    else:
+        return np.divide(rf, rf_max, out=np.zeros((n1, n2)), where=(rf_max > 0))
+
+
+# Splits to compare (set per process by set_comparison()).
+comparison = None
+
+def set_comparison(splits1, splits2, unrooted, symmetric):
+    global comparison
+    comparison = (splits1, splits2, unrooted, symmetric)
+
+
+def compare_row(long i):
+    """Return the rf distances (and maximum ones) of tree i to the others."""
+    splits1, splits2, unrooted, symmetric = comparison
+
+    start = i + 1 if symmetric else 0
+
+    rf_row, rf_max_row = [], []
+    for j in range(start, len(splits2)):
+        rf, rf_max = robinson_foulds(splits1[i], splits2[j], unrooted)
+        rf_row.append(rf)
+        rf_max_row.append(rf_max)
+
+    return rf_row, rf_max_row
+
+
+def robinson_foulds(splits1, splits2, unrooted=False):
+    """Return the rf distance and its maximum possible value.
+
+    :param splits1: Tuple (leaves, splits) of the first tree, as returned
+        by get_splits().
+    :param splits2: Same for the second tree.
+    """
+    leaves1, s1 = splits1
+    leaves2, s2 = splits2
+
+    common = leaves1 & leaves2  # leaves in common
+
+    if leaves1 != common:
+        s1 = nontrivial([x & common for x in s1], common, unrooted)
+    if leaves2 != common:
+        s2 = nontrivial([x & common for x in s2], common, unrooted)
+
+    return len(s1 ^ s2), len(s1) + len(s2)
+
+
+def get_splits(tree, dict index, prop='name', unrooted=False):
+    """Return the leaves and the nontrivial splits of tree, as bitsets.
+
+    :param tree: Tree whose splits we want.
+    :param index: Dict that maps leaf values to positions in the bitsets
+        (extended with new values when they appear).
+    :param prop: Leaf property used to identify leaves across trees.
+    :param unrooted: If True, consider the tree as unrooted.
+    """
+    if not unrooted and len(tree.children) > 2:
+        raise TreeError('Unrooted tree found! You may want to set unrooted=True.')
+
+    cdef list masks = []  # leaves under each node, as bitsets
+    cdef dict pending = {}  # node -> bitset, of nodes whose parent is not done
+    cdef long nleaves = 0
+
+    for node in tree.traverse('postorder'):
+        if node.is_leaf:
+            value = node.get_prop(prop)
+            if value is None:
+                mask = 0
+            else:
+                mask = 1 << index.setdefault(value, len(index))
+                nleaves += 1
+        else:
+            mask = 0
+            for child in node.children:
+                mask |= pending.pop(child)
+
+        pending[node] = mask
+        masks.append(mask)
+
+    leaves = pending[tree]
+
+    if popcount(leaves) != nleaves:
+        raise TreeError(f'Duplicated items found in tree: {tree}')
+
+    return leaves, nontrivial(masks, leaves, unrooted)
+
+
+def nontrivial(masks, leaves, unrooted):
+    """Return the set of nontrivial splits (as bitsets) from the leaf masks.
+
+    Trivial splits are the ones that separate only one leaf (or none).
+    If unrooted, each split is represented by its side that does not
+    contain the first leaf.
+    """
+    cdef set splits = set()
+
+    first = leaves & -leaves  # bitset with only the first leaf
+    cdef int min_other = 2 if unrooted else 1  # min leaves on the other side
+
+    for mask in masks:
+        if unrooted and mask & first:
+            mask = leaves ^ mask  # use the other side
+        if popcount(mask) > 1 and popcount(leaves ^ mask) >= min_other:
+            splits.add(mask)
+
+    return splits
@@ -1,13 +1,15 @@
 import copy
 import itertools
 from hashlib import md5
-from functools import cmp_to_key
 import pickle
 import logging
 import math
 
 from . import text_viz
 from . import operations as ops
+from .flat_tree import FlatTree, LcaIndex, mark_edit, join_stamps
+from . import prop_index
+from .prop_index import PropIndex
 from .. import utils
 from ete4.parser import newick
 from ..parser import ete_format
@@ -49,6 +51,9 @@ cdef class Tree(object):
 
     cdef public (double, double) size
 
+    cdef public dict _indexes  # pname -> PropIndex (only in roots that have them)
+    cdef public object _stamps  # flat_tree.Stamps of its tree's changes, or None
+
     # All these members below should go away.
     cdef public object _img_style
     cdef public object _sm_style
@@ -60,8 +65,8 @@ cdef class Tree(object):
     def __init__(self, data=None, children=None, parser=None):
         """
         :param data: A string or file object with the description of
-            the tree as a newick, or a dict with the contents of a
-            single node.
+            the tree as a newick (or bytes in ete format), or a dict
+            with the contents of a single node.
         :param children: List of nodes to add as children of this one.
         :param parser: A description of how to parse a newick to
             create a tree. It can be a single number specifying the
@@ -74,6 +79,7 @@ cdef class Tree(object):
             t2 = Tree({'name': 'A'})
             t3 = Tree('(A:1,(B:1,(C:1,D:1):0.5):0.5);')
             t4 = Tree(open('/home/user/my-tree.nw'))
+            t5 = Tree(open('/home/user/my-tree.ete', 'rb'))
         """
         self.children = children or []
 
@@ -96,11 +102,15 @@ cdef class Tree(object):
             assert (type(parser) in [dict, int] or
                     parser in [None, 'newick', 'ete', 'auto']), 'bad parser'
 
-            data = data.strip()
-
             if parser is None or parser == 'auto':
-                guess_format = lambda x: 'newick'  # TODO
-                parser = guess_format(data)
+                parser = ('ete' if type(data) == bytes and
+                          data.startswith(ete_format.MAGIC) else 'newick')
+
+            if parser == 'ete':
+                self.init_from_ete(data)
+                return
+
+            data = (data.decode() if type(data) == bytes else data).strip()
 
             if parser == 'newick':
                 self.init_from_newick(data)
@@ -108,8 +118,6 @@ cdef class Tree(object):
                 self.init_from_newick(data, parser)
             elif parser in newick.INT_PARSERS:
                 self.init_from_newick(data, newick.INT_PARSERS[parser])
-            elif parser == 'ete':
-                self.init_from_ete(data)
 
     def init_from_newick(self, data, parser=None):
         tree = newick.loads(data, parser, self.__class__)
@@ -117,11 +125,9 @@ cdef class Tree(object):
         self.props = tree.props
 
     def init_from_ete(self, data):
-        t = ete_format.loads(data)
-        self.name = t.name
-        self.dist = t.dist
-        self.support = t.support
-        self.children = t.children
+        tree = ete_format.loads(data, self.__class__)
+        self.children = tree.children
+        self.props = tree.props
 
     @property
     def name(self):
@@ -129,10 +135,7 @@ cdef class Tree(object):
 
     @name.setter
     def name(self, value):
-        if value is not None:
-            self.props['name'] = str(value)
-        else:
-            self.props.pop('name', None)
+        prop_index.set_prop(self, 'name', str(value) if value is not None else None)
 
     @property
     def dist(self):
@@ -140,10 +143,7 @@ cdef class Tree(object):
 
     @dist.setter
     def dist(self, value):
-        if value is not None:
-            self.props['dist'] = float(value)
-        else:
-            self.props.pop('dist', None)
+        prop_index.set_prop(self, 'dist', float(value) if value is not None else None)
 
     @property
     def support(self):
@@ -151,10 +151,7 @@ cdef class Tree(object):
 
     @support.setter
     def support(self, value):
-        if value is not None:
-            self.props['support'] = float(value)
-        else:
-            self.props.pop('support', None)
+        prop_index.set_prop(self, 'support', float(value) if value is not None else None)
 
     @property
     def children(self):
@@ -162,6 +159,7 @@ cdef class Tree(object):
 
     @children.setter
     def children(self, value):
+        mark_edit(self)
         self._children = []
         self.add_children(value)
 
@@ -283,7 +281,9 @@ cdef class Tree(object):
         """Return the node that matches the given node_id."""
         try:
             if type(node_id) == str:    # node_id can be the name of a node
-                return next(n for n in self.traverse() if n.name == node_id)
+                nodes = self._indexed_nodes({'name': node_id})
+                return next(n for n in (nodes if nodes is not None else self.traverse())
+                            if n.name == node_id)
             elif type(node_id) == int:  # or the index of a child
                 return self.children[node_id]
             else:                       # or a list/tuple of a descendant
@@ -333,7 +333,9 @@ cdef class Tree(object):
         if isinstance(item, self.__class__):
             return item in self.descendants()
         elif type(item) == str:
-            return any(n.name == item for n in self.traverse())
+            nodes = self._indexed_nodes({'name': item})
+            return any(n.name == item
+                       for n in (nodes if nodes is not None else self.traverse()))
         else:
             raise TreeError("Invalid item type")
 
@@ -347,7 +349,7 @@ cdef class Tree(object):
 
     def add_prop(self, name, value):
         """Add or update node's property to the given value."""
-        self.props[name] = value
+        prop_index.set_prop(self, name, value, keep_none=True)
 
     def add_props(self, **props):
         """Add or update several properties."""
@@ -356,7 +358,7 @@ cdef class Tree(object):
 
     def del_prop(self, prop_name):
         """Permanently delete a node's property."""
-        self.props.pop(prop_name, None)
+        prop_index.set_prop(self, prop_name, None)
 
     # DEPRECATED #
     def add_feature(self, pr_name, pr_value):
@@ -399,9 +401,19 @@ cdef class Tree(object):
         if support is not None:
             child.support = support
 
+        indexes = prop_index.attaching(child, self) if prop_index.active() else ()
+
+        if child.up is not None:  # moving a node (not just adding a new one)
+            mark_edit(child)  # its old tree changes too
+
+        join_stamps(child, self)
+
         child.up = self
         self.children.append(child)
 
+        mark_edit(self)
+        prop_index.stamp(indexes)
+
         return child
 
     def add_children(self, nodes):
@@ -412,10 +424,19 @@ cdef class Tree(object):
 
     def pop_child(self, child_idx=-1):
         try:
-            child = self.children.pop(child_idx)  # parent removes child
+            child = self.children[child_idx]
+
+            indexes = (prop_index.detaching(child)
+                       if prop_index.active() and child.up == self else ())
+
+            mark_edit(self)
+            self.children.pop(child_idx)  # parent removes child
 
             if child.up == self:  # (it may point to another already!)
                 child.up = None  # child removes parent
+                mark_edit(child)  # now the root of its own tree
+
+            prop_index.stamp(indexes)
 
             return child
         except ValueError as e:
@@ -431,10 +452,18 @@ cdef class Tree(object):
             if type(child) == str:  # translate into a node
                 child = next(n for n in self.children if n.name == child)
 
+            indexes = (prop_index.detaching(child)
+                       if prop_index.active() and child.up == self and
+                          child in self.children else ())
+
+            mark_edit(self)
             self.children.remove(child)  # parent removes child
 
             if child.up == self:  # (it may point to another already!)
                 child.up = None  # child removes parent
+                mark_edit(child)  # now the root of its own tree
+
+            prop_index.stamp(indexes)
 
             return child
         except (StopIteration, ValueError) as e:
@@ -526,8 +555,14 @@ cdef class Tree(object):
         function. This mechanism can be seen as a "cut and paste".
         """
         if self.up:
+            indexes = prop_index.detaching(self) if prop_index.active() else ()
+
+            mark_edit(self)
             self.up.children.remove(self)
             self.up = None
+            mark_edit(self)  # now the root of its own tree
+
+            prop_index.stamp(indexes)
 
         return self
 
@@ -589,63 +624,11 @@ cdef class Tree(object):
           # ╴root╶╌╴H╶╌╴F╶┤
           #               ╰╴B
         """
-        def cmp_nodes(x, y):
-            # if several nodes are in the same path of two kept nodes,
-            # only one should be maintained. This prioritize internal
-            # nodes that are already in the to_keep list and then
-            # deeper nodes (closer to the leaves).
-            if n2depth[x] > n2depth[y]:
-                return -1
-            elif n2depth[x] < n2depth[y]:
-                return 1
-            else:
-                return 0
-
-        to_keep = set(self._translate_nodes(nodes))
-        start = self.common_ancestor(to_keep)
-        node2path = {n: n.lineage() for n in to_keep}
-        to_keep.add(self)
-
-        # Calculate which kept nodes are visiting the same nodes in
-        # their path to the common ancestor.
-        n2count = {}
-        n2depth = {}
-        for seed, path in node2path.items():
-            for visited_node in path:
-                if visited_node not in n2depth:
-                    depth = visited_node.get_distance(visited_node, start,
-                                                      topological=True)
-                    n2depth[visited_node] = depth
-                if visited_node is not seed:
-                    n2count.setdefault(visited_node, set()).add(seed)
-
-        # if several internal nodes are in the path of exactly the same kept
-        # nodes, only one (the deepest) should be maintain.
-        visitors2nodes = {}
-        for node, visitors in n2count.items():
-            # keep nodes connection at least two other nodes
-            if len(visitors)>1:
-                visitor_key = frozenset(visitors)
-                visitors2nodes.setdefault(visitor_key, set()).add(node)
-
-        for visitors, nodes in visitors2nodes.items():
-            if not (to_keep & nodes):
-                sorted_nodes = sorted(nodes, key=cmp_to_key(cmp_nodes))
-                to_keep.add(sorted_nodes[0])
-
-        for n in self.descendants('postorder'):
-            if n not in to_keep:
-                if preserve_branch_length and n.dist is not None:
-                    if len(n.children) == 1:
-                        if n.children[0].dist is not None:
-                            n.children[0].dist += n.dist
-                    elif len(n.children) > 1 and n.up and n.up.dist is not None:
-                        n.up.dist += n.dist
-
-                n.delete(prevent_nondicotomic=False)
+        ops.prune(self, self._translate_nodes(nodes), preserve_branch_length)
 
     def reverse_children(self):
         """Reverse current children order."""
+        mark_edit(self)
         self.children.reverse()
 
     def swap_children(self):
@@ -653,6 +636,7 @@ cdef class Tree(object):
         n = len(self.children)
         assert n == 2, f'Node has {n} children. Use reverse_children() instead?'
 
+        mark_edit(self)
         self.children.reverse()
 
     # #####################
@@ -795,6 +779,8 @@ cdef class Tree(object):
         :param list props: Properties to write for all nodes using the Extended
             Newick Format. If None, write all available properties.
         :param parser: Parser used to encode the tree in newick format.
+            If 'ete', encode it instead in the (binary) ete format, with
+            all the properties.
         :param bool format_root_node: If True, write content of the root node
             too. For compatibility reasons, this is False by default.
 
@@ -802,6 +788,14 @@ cdef class Tree(object):
 
           t.write(props=['species', 'sci_name'])
         """
+        if parser == 'ete':
+            if not outfile:
+                return ete_format.dumps(self)
+            else:
+                with open(outfile, 'wb') as fp:
+                    ete_format.dump(self, fp)
+                return
+
         parser = newick.INT_PARSERS[parser] if type(parser) == int else parser
 
         if not outfile:
@@ -832,11 +826,76 @@ cdef class Tree(object):
           for node in tree.search_nodes(dist=0.0, name='human'):
               print(node.prop['support'])
         """
-        for n in self.traverse():
+        nodes = self._indexed_nodes(conditions)
+        for n in (nodes if nodes is not None else self.traverse()):
             if all(n.props.get(key) == value or getattr(n, key, None) == value
                    for key, value in conditions.items()):
                 yield n
 
+    def _indexed_nodes(self, conditions):
+        """Return the nodes that may satisfy conditions using an index, or None.
+
+        The nodes are the ones under this node with a value of an indexed
+        property equal to the one in the conditions (None if no property
+        in conditions is indexed, and the whole tree must be traversed).
+        """
+        if not prop_index.active():
+            return None
+
+        root = self.root
+        if not root._indexes:
+            return None
+
+        for pname, value in conditions.items():
+            index = root._indexes.get(pname)
+            nodes = index.get(value) if index is not None else None
+            if nodes is not None:
+                if self is root:
+                    return nodes
+                else:
+                    return [n for n in nodes if prop_index.descends(n, self)]
+
+        return None
+
+    def create_index(self, pname='name'):
+        """Create an index of the nodes by their value of property pname.
+
+        With it, searching for nodes by that property (as in
+        ``tree.search_nodes(name='A')`` or ``tree['A']``) does not need to
+        traverse the tree. The index is kept up to date when using the
+        tree methods that change nodes (add_prop, add_child, detach,
+        delete, prune...), but not with changes made directly to
+        node.props. It can only be created on the root of a tree, and
+        for properties stored in node.props (not for attributes like
+        is_leaf, which search_nodes() also looks at).
+
+        Example::
+
+          t.create_index('name')
+          t['A']  # uses the index (and is fast even for a big tree)
+        """
+        if self.up is not None:
+            raise TreeError('indexes can only be created on the root of a tree')
+
+        if (pname not in ['name', 'dist', 'support'] and
+            hasattr(type(self), pname)):  # like is_leaf, not in node.props
+            raise TreeError(f'cannot index attribute {pname!r} (not a property)')
+
+        if self._indexes is None:
+            self._indexes = {}
+        elif pname in self._indexes:
+            prop_index.forget(self._indexes[pname])
+
+        index = self._indexes[pname] = PropIndex(self, pname)
+
+        return index
+
+    def drop_index(self, pname='name'):
+        """Remove the index of the nodes by their value of property pname."""
+        index = self._indexes.pop(pname, None) if self._indexes else None
+        if index is not None:
+            prop_index.forget(index)
+
     def search_descendants(self, **conditions):
         """Yield descendant nodes matching the given conditions."""
         for n in self.search_nodes(**conditions):
@@ -1614,6 +1673,22 @@ cdef class Tree(object):
 
         return md5(str(sorted(edge_keys)).encode('utf-8')).hexdigest()
 
+    def to_arrays(self):
+        """Return a FlatTree, with the tree's topology and dists as arrays.
+
+        It is useful for fast (vectorized) computations over all the
+        nodes, like root distances, leaf counts or common ancestors.
+        """
+        return FlatTree(self)
+
+    def get_lca_index(self):
+        """Return an index to find common ancestors and distances in O(1).
+
+        Useful to make many queries on the same tree. The index is
+        updated automatically if the tree changes.
+        """
+        return LcaIndex(self)
+
     def to_ultrametric(self, topological=False):
         """Convert tree to ultrametric (all leaves equidistant from root)."""
         ops.to_ultrametric(self, topological)
@@ -1754,104 +1829,41 @@ cdef class Tree(object):
         """
         ops.resolve_polytomy(self, descendants)
 
-    def cophenetic_matrix(self):
-        """Return a cophenetic distance matrix of the tree.
+    def cophenetic_matrix(self, leaves=None, dtype=float, condensed=False,
+                          out=None):
+        """Return the cophenetic matrix of the tree, and the leaf names.
 
         The `cophenetic matrix
-        <https://en.wikipedia.org/wiki/Cophenetic>`_ is a matrix
-        representation of the distance between each node.
-
-        If we have a tree like::
-
-                 ╭╴A
-             ╭╴y╶┤
-             │   ╰╴B
-          ╴z╶┤
-             │   ╭╴C
-             ╰╴x╶┤
-                 │   ╭╴D
-                 ╰╴w╶┤
-                     ╰╴E
-
-        where w, x, y, z are internal nodes, then::
-
-          d(A,B) = d(y,A) + d(y,B)
+        <https://en.wikipedia.org/wiki/Cophenetic>`_ has the distances
+        between each pair of leaves. It is returned as a numpy array,
+        together with the names of the leaves (the rows and columns).
 
-        and::
+        The distance between leaves a and b is computed as::
 
-          d(A,E) = d(z,A) + d(z,E)
-                 = (d(z,y) + d(y,A)) + (d(z,x) + d(x,w) + d(w,E))
+          d(a,b) = d(root,a) + d(root,b) - 2 * d(root,lca(a,b))
 
-        To compute it, we use an idea from
-        https://gist.github.com/jhcepas/279f9009f46bf675e3a890c19191158b
+        where lca(a,b) is their last common ancestor, which is found as
+        the shallowest of the lcas of consecutive leaves between them.
 
-        First, for each node we find its path to the root. For example::
-
-          A -> A, y, z
-          E -> E, w, x, z
-
-        and make these orderless sets. Then we XOR the two sets to
-        only find the elements that are in one or other sets but not
-        both. In this case A, E, y, x, w.
-
-        The distance between the two nodes is the sum of the distances
-        from each of those nodes to the parent
-
-        One more optimization: since the distances are symmetric, and
-        distance to itself is zero we user itertools.combinations
-        rather than itertools.permutations. This cuts our computes
-        from theta(n^2) 1/2n^2 - n (= O(n^2), which is still not
-        great, but in reality speeds things up for large trees).
-
-        For this tree, we will return the two dimensional array::
-
-                    A                B                C                D                E
-          A         0         d(A,y) + d(B,y)  d(A,z) + d(C,z)  d(A,z) + d(D,z)  d(A,z) + d(E,z)
-          B  d(B,y) + d(A,y)         0         d(B,z) + d(C,z)  d(B,z) + d(D,z)  d(B,z) + d(E,z)
-          C  d(C,z) + d(A,z)  d(C,z) + d(B,z)         0         d(C,x) + d(D,x)  d(C,x) + d(E,x)
-          D  d(D,z) + d(A,z)  d(D,z) + d(B,z)  d(D,x) + d(C,x)         0         d(D,w) + d(E,w)
-          E  d(E,z) + d(A,z)  d(E,z) + d(B,z)  d(E,x) + d(C,x)  d(E,w) + d(D,w)         0
-
-        We will also return the one dimensional array with the leaves
-        in the order in which they appear in the matrix (i.e. the
-        column and/or row headers).
+        :param leaves: Leaves (or names) to use, and in which order. If
+            None, use all the leaves sorted by name.
+        :param dtype: Type of the values of the matrix (like np.float32,
+            which uses half the memory).
+        :param condensed: If True, return only the upper triangle of the
+            matrix (without the diagonal) as a 1D array, like scipy's pdist().
+        :param out: Array where to write the matrix. It can be a np.memmap
+            for matrices that do not fit in memory.
         """
-        leaves = list(self.leaves())
-        paths = {x: set() for x in leaves}
-
-        # get the paths going up the tree
-        # we get all the nodes up to the last one and store them in a set
-
-        for n in leaves:
-            if n.is_root:
-                continue
-            movingnode = n
-            while not movingnode.is_root:
-                paths[n].add(movingnode)
-                movingnode = movingnode.up
-
-        # now we want to get all pairs of nodes using itertools combinations. We need AB AC etc but don't need BA CA
-
-        leaf_distances = {x.name: {} for x in leaves}
-
-        for (leaf1, leaf2) in itertools.combinations(leaves, 2):
-            # figure out the unique nodes in the path
-            uniquenodes = paths[leaf1] ^ paths[leaf2]
-            distance = sum(x.dist for x in uniquenodes)
-            leaf_distances[leaf1.name][leaf2.name] = leaf_distances[leaf2.name][leaf1.name] = distance
-
-        allleaves = sorted(leaf_distances.keys()) # the leaves in order that we will return
+        if leaves is None:
+            leaves = sorted(self.leaves(), key=lambda leaf: leaf.name or '')
+        else:
+            leaves = self._translate_nodes(list(leaves))
 
-        output = [] # the two dimensional array that we will return
+        ft = self.to_arrays()
+        matrix = ft.cophenetic_matrix([ft.index(leaf) for leaf in leaves],
+                                      dtype, condensed, out)
 
-        for i, n in enumerate(allleaves):
-            output.append([])
-            for m in allleaves:
-                if m == n:
-                    output[i].append(0) # distance to ourself = 0
-                else:
-                    output[i].append(leaf_distances[n][m])
-        return output, allleaves
+        return matrix, [leaf.name for leaf in leaves]
 
     # TODO: All the following "face and style functions" should go away.
 
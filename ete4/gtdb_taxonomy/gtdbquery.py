@@ -3,8 +3,7 @@
 import sys
 import os
 
-import pickle
-from collections import defaultdict, Counter
+from collections import defaultdict
 
 from hashlib import md5
 
@@ -15,6 +14,8 @@ import warnings
 import requests
 
 from ete4 import ETE_DATA_HOME, update_ete_data
+from ..ncbi_taxonomy.taxonomy import Taxonomy, build_db
+from ..parser.ete_format import build_tree
 
 
 __all__ = ["GTDBTaxa", "is_taxadb_up_to_date"]
@@ -41,7 +42,7 @@ def is_taxadb_up_to_date(dbfile=DEFAULT_GTDBTAXADB):
     return True
 
 
-class GTDBTaxa:
+class GTDBTaxa(Taxonomy):
     """
     Local transparent connector to the GTDB taxonomy database.
     """
@@ -67,17 +68,11 @@ class GTDBTaxa:
         if not os.path.exists(self.dbfile):
             raise ValueError("Cannot open taxonomy database: %s" % self.dbfile)
 
-        self.db = None
-        self._connect()
-
         if not is_taxadb_up_to_date(self.dbfile):
             print('GTDB database format is outdated. Upgrading', file=sys.stderr)
             self.update_taxonomy_database(taxdump_file)
 
-        if memory:
-            filedb = self.db
-            self.db = sqlite3.connect(':memory:')
-            filedb.backup(self.db)
+        self.memory = memory  # connections to a copy of the database in memory
 
     def update_taxonomy_database(self, taxdump_file=None):
         """Update the GTDB taxonomy database.
@@ -88,22 +83,7 @@ class GTDBTaxa:
         :param taxdump_file: Alternative location of gtdbtaxdump.tar.gz.
         """
         update_db(self.dbfile, targz_file=taxdump_file)
-
-    def _connect(self):
-        self.db = sqlite3.connect(self.dbfile)
-
-    def _translate_merged(self, all_taxids):
-        conv_all_taxids = set((list(map(int, all_taxids))))
-        cmd = 'select taxid_old, taxid_new FROM merged WHERE taxid_old IN (%s)' %','.join(map(str, all_taxids))
-
-        result = self.db.execute(cmd)
-        conversion = {}
-        for old, new in result.fetchall():
-            conv_all_taxids.discard(int(old))
-            conv_all_taxids.add(int(new))
-            conversion[int(old)] = int(new)
-        return conv_all_taxids, conversion
-
+        self._reload()
 
     # def get_fuzzy_name_translation(self, name, sim=0.9):
     #     '''
@@ -153,9 +133,7 @@ class GTDBTaxa:
 
         Note: Numeric taxids are not recognized by the official GTDB taxonomy database, only for internal usage.
         """
-        ids = ','.join('"%s"' % v for v in set(internal_taxids) - {None, ''})
-        result = self.db.execute('SELECT taxid, rank FROM species WHERE taxid IN (%s)' % ids)
-        return {tax: spname for tax, spname in result.fetchall()}
+        return self._get_ranks(internal_taxids)
 
     def get_rank(self, taxids):
         """Give a list of GTDB string taxids, return a dictionary with their corresponding ranks.
@@ -165,30 +143,17 @@ class GTDBTaxa:
         {'c__Thorarchaeia': 'class', 'RS_GCF_001477695.1': 'subspecies'}
         """
 
-        taxid2rank = {}
         name2ids = self._get_name_translator(taxids)
-        overlap_ids = name2ids.values()
-        taxids = [item for sublist in overlap_ids for item in sublist]
-        ids = ','.join('"%s"' % v for v in set(taxids) - {None, ''})
-        result = self.db.execute('SELECT taxid, rank FROM species WHERE taxid IN (%s)' % ids)
-        for tax, rank in result.fetchall():
-            taxid2rank[list(self._get_taxid_translator([tax]).values())[0]] = rank
+        id2rank = self._get_id2rank(tid for ids in name2ids.values() for tid in ids)
+        id2name = self._get_taxid_translator(id2rank)
 
-        return taxid2rank
+        return {id2name[tax]: rank for tax, rank in id2rank.items()}
 
     def _get_lineage_translator(self, taxids):
         """Given a valid taxid number, return its corresponding lineage track as a
         hierarchically sorted list of parent taxids.
         """
-        all_ids = set(taxids)
-        all_ids.discard(None)
-        all_ids.discard("")
-        query = ','.join(['"%s"' %v for v in all_ids])
-        result = self.db.execute('SELECT taxid, track FROM species WHERE taxid IN (%s);' %query)
-        id2lineages = {}
-        for tax, track in result.fetchall():
-            id2lineages[tax] = list(map(int, reversed(track.split(","))))
-        return id2lineages
+        return self._get_lineages(taxids)
 
     def get_name_lineage(self, taxnames):
         """Given a valid taxname, return its corresponding lineage track as a
@@ -210,33 +175,26 @@ class GTDBTaxa:
         if not taxid:
             return None
         taxid = int(taxid)
-        result = self.db.execute('SELECT track FROM species WHERE taxid=%s' %taxid)
-        raw_track = result.fetchone()
-        if not raw_track:
+        lineage = self._get_lineage_translator([taxid]).get(taxid)
+        if not lineage:
             #perhaps is an obsolete taxid
             _, merged_conversion = self._translate_merged([taxid])
             if taxid in merged_conversion:
-                result = self.db.execute('SELECT track FROM species WHERE taxid=%s' %merged_conversion[taxid])
-                raw_track = result.fetchone()
+                new_taxid = merged_conversion[taxid]
+                lineage = self._get_lineage_translator([new_taxid]).get(new_taxid)
             # if not raise error
-            if not raw_track:
-                #raw_track = ["1"]
+            if not lineage:
                 raise ValueError("%s taxid not found" %taxid)
             else:
                 warnings.warn("taxid %s was translated into %s" %(taxid, merged_conversion[taxid]))
 
-        track = list(map(int, raw_track[0].split(",")))
-        return list(reversed(track))
+        return lineage
 
     def get_common_names(self, taxids):
-        query = ','.join(['"%s"' %v for v in taxids])
-        cmd = "select taxid, common FROM species WHERE taxid IN (%s);" %query
-        result = self.db.execute(cmd)
-        id2name = {}
-        for tax, common_name in result.fetchall():
-            if common_name:
-                id2name[tax] = common_name
-        return id2name
+        id2name = self._get_commons(taxids)
+
+        return {tax: common_name for tax, common_name in id2name.items()
+                if common_name}
 
     def _get_taxid_translator(self, taxids, try_synonyms=True):
         """Given a list of taxids, returns a dictionary with their corresponding
@@ -244,14 +202,8 @@ class GTDBTaxa:
         """
 
         all_ids = set(map(int, taxids))
-        all_ids.discard(None)
-        all_ids.discard("")
-        query = ','.join(['"%s"' %v for v in all_ids])
-        cmd = "select taxid, spname FROM species WHERE taxid IN (%s);" %query
-        result = self.db.execute(cmd)
-        id2name = {}
-        for tax, spname in result.fetchall():
-            id2name[tax] = spname
+
+        id2name = self._get_names(all_ids)
 
         # any taxid without translation? lets tray in the merged table
         # if len(all_ids) != len(id2name) and try_synonyms:
@@ -274,29 +226,24 @@ class GTDBTaxa:
         Exact name match is required for translation.
         """
 
-        name2id = {}
-        #name2realname = {}
         name2origname = {}
         for n in names:
             name2origname[n.lower()] = n
 
-        names = set(name2origname.keys())
-
-        query = ','.join(['"%s"' %n for n in name2origname.keys()])
-        cmd = 'select spname, taxid from species where spname IN (%s)' %query
-        result = self.db.execute('select spname, taxid from species where spname IN (%s)' %query)
-        for sp, taxid in result.fetchall():
-            oname = name2origname[sp.lower()]
-            name2id.setdefault(oname, []).append(taxid)
-            #name2realname[oname] = sp
-        missing =  names - set([n.lower() for n in name2id.keys()])
-        if missing:
-            query = ','.join(['"%s"' %n for n in missing])
-            result = self.db.execute('select spname, taxid from synonym where spname IN (%s)' %query)
-            for sp, taxid in result.fetchall():
-                oname = name2origname[sp.lower()]
-                name2id.setdefault(oname, []).append(taxid)
-                #name2realname[oname] = sp
+        name2id = {}
+        for table in ['species', 'synonym']:  # look in synonyms if not found
+            missing = [n for n in name2origname if name2origname[n] not in name2id]
+            if not missing:
+                break
+
+            result = self._query(
+                'SELECT spname, taxid FROM %s WHERE spname IN ({})' % table,
+                missing, normalize=str.lower)
+
+            for name in missing:
+                if result.get(name):
+                    name2id[name2origname[name]] = list(result[name])
+
         return name2id
 
     def _translate_to_names(self, taxids):
@@ -328,38 +275,25 @@ class GTDBTaxa:
         if conversion:
             taxid = conversion[taxid]
 
-        with open(self.dbfile+".traverse.pkl", "rb") as CACHED_TRAVERSE:
-            prepostorder = pickle.load(CACHED_TRAVERSE)
-        descendants = {}
-        found = 0
-        for tid in prepostorder:
-            if tid == taxid:
-                found += 1
-            elif found == 1:
-                descendants[tid] = descendants.get(tid, 0) + 1
-            elif found == 2:
-                break
+        descendants = self.index.descendants(taxid, intermediate_nodes=True)
 
-        if not found:
-            raise ValueError("taxid not found:%s" %taxid)
-        elif found == 1:
+        if len(descendants) == 0:
             return [taxid]
         if rank_limit or collapse_subspecies or return_tree:
-            descendants_spnames = self._get_taxid_translator(list(descendants.keys()))
+            descendants_spnames = self._get_taxid_translator(descendants.tolist())
             #tree = self.get_topology(list(descendants.keys()), intermediate_nodes=intermediate_nodes, collapse_subspecies=collapse_subspecies, rank_limit=rank_limit)
             tree = self.get_topology(list(descendants_spnames.values()), intermediate_nodes=intermediate_nodes, collapse_subspecies=collapse_subspecies, rank_limit=rank_limit)
             if return_tree:
                 return tree
             elif intermediate_nodes:
-                return [n.name for n in tree.get_descendants()]
+                return [n.name for n in tree.descendants()]
             else:
                 return [n.name for n in tree]
 
         elif intermediate_nodes:
-            return self._translate_to_names([tid for tid, count in descendants.items()])
+            return self._translate_to_names(descendants.tolist())
         else:
-            self._translate_to_names([tid for tid, count in descendants.items() if count == 1])
-            return self._translate_to_names([tid for tid, count in descendants.items() if count == 1])
+            return self._translate_to_names(self.index.descendants(taxid).tolist())
 
     def get_topology(self, taxnames, intermediate_nodes=False, rank_limit=None,
                      collapse_subspecies=False, annotate=True):
@@ -382,97 +316,17 @@ class GTDBTaxa:
         tax2id = self._get_name_translator(taxnames) #{'f__Korarchaeaceae': [2174], 'o__Peptococcales': [205487], 'p__Huberarchaeota': [610]}
         taxids = [i[0] for i in tax2id.values()]
 
-        if len(taxids) == 1:
-            root_taxid = int(list(taxids)[0])
-            with open(self.dbfile+".traverse.pkl", "rb") as CACHED_TRAVERSE:
-                prepostorder = pickle.load(CACHED_TRAVERSE)
-            descendants = {}
-            found = 0
-            nodes = {}
-            hit = 0
-            visited = set()
-            start = prepostorder.index(root_taxid)
-            try:
-            	end = prepostorder.index(root_taxid, start+1)
-            	subtree = prepostorder[start:end+1]
-            except ValueError:
-                # If root taxid is not found in postorder, must be a tip node
-            	subtree = [root_taxid]
-            leaves = set([v for v, count in Counter(subtree).items() if count == 1])
-            tax2name = self._get_taxid_translator(list(subtree))
-            name2tax ={spname:taxid for taxid,spname in tax2name.items()}
-            nodes[root_taxid] = PhyloTree({'name': str(root_taxid)})
-            current_parent = nodes[root_taxid]
-            for tid in subtree:
-                if tid in visited:
-                    current_parent = nodes[tid].up
-                else:
-                    visited.add(tid)
-                    nodes[tid] = PhyloTree({'name': tax2name.get(tid, '')})
-                    current_parent.add_child(nodes[tid])
-                    if tid not in leaves:
-                        current_parent = nodes[tid]
-            root = nodes[root_taxid]
-        else:
-            taxids = set(map(int, taxids))
-            sp2track = {}
-            elem2node = {}
-            id2lineage = self._get_lineage_translator(taxids)
-            all_taxids = set()
-            for lineage in id2lineage.values():
-                all_taxids.update(lineage)
-            id2rank = self._get_id2rank(all_taxids)
+        positions, parents = self._get_topology_nodes(
+            taxids, intermediate_nodes, rank_limit, collapse_subspecies)
 
-            tax2name = self._get_taxid_translator(taxids)
-            all_taxid_codes = set([_tax for _lin in list(id2lineage.values()) for _tax in _lin])
-            extra_tax2name = self._get_taxid_translator(list(all_taxid_codes - set(tax2name.keys())))
-            tax2name.update(extra_tax2name)
-            name2tax ={spname:taxid for taxid,spname in tax2name.items()}
-
-            for sp in taxids:
-                track = []
-                lineage = id2lineage[sp]
-
-                for elem in lineage:
-                    spanme = tax2name[elem]
-                    if elem not in elem2node:
-                        node = elem2node.setdefault(elem, PhyloTree())
-                        node.name = str(tax2name[elem])
-                        node.taxid = str(tax2name[elem])
-                        node.add_prop("rank", str(id2rank.get(int(elem), "no rank")))
-                    else:
-                        node = elem2node[elem]
-                    track.append(node)
-                sp2track[sp] = track
-            # generate parent child relationships
-            for sp, track in sp2track.items():
-                parent = None
-                for elem in track:
-                    if parent and elem not in parent.children:
-                        parent.add_child(elem)
-                    if rank_limit and elem.props.get('rank') == rank_limit:
-                        break
-                    parent = elem
-            root = elem2node[1]
-        #remove onechild-nodes
-
-        if not intermediate_nodes:
-            for n in root.descendants():
-                if len(n.children) == 1 and int(name2tax.get(n.name, n.name)) not in taxids:
-                    n.delete(prevent_nondicotomic=False)
-
-        if len(root.children) == 1:
-            tree = root.children[0].detach()
-        else:
-            tree = root
+        index = self.index
+        node_taxids = index.taxids[positions].tolist()
+        ranks = [index.ranks[r] for r in index.rank[positions].tolist()]
+        tax2name = self._get_taxid_translator(node_taxids)
 
-        if collapse_subspecies:
-            to_detach = []
-            for node in tree.traverse():
-                if node.props.get('rank') == 'species':
-                    to_detach.extend(node.children)
-            for n in to_detach:
-                n.detach()
+        tree = build_tree(PhyloTree, parents,
+                          [{'name': tax2name.get(taxid, ''), 'rank': rank}
+                           for taxid, rank in zip(node_taxids, ranks)])
 
         if annotate:
             self.annotate_tree(tree, ignore_unclassified=False)
@@ -689,92 +543,6 @@ class GTDBTaxa:
     #     return self.annotate_tree(t, tax2name, tax2track, attr_name="taxid")
 
 
-def load_gtdb_tree_from_dump(tar):
-    from .. import Tree
-    # Download: gtdbdump/gtdbr202dump.tar.z
-    parent2child = {}
-    name2node = {}
-    node2taxname = {}
-    synonyms = set()
-    name2rank = {}
-    node2common = {}
-    print("Loading node names...")
-    unique_nocase_synonyms = set()
-    for line in tar.extractfile("names.dmp"):
-        line = str(line.decode())
-        fields =  [_f.strip() for _f in line.split("|")]
-        nodename = fields[0]
-        name_type = fields[3].lower()
-        taxname = fields[1]
-
-        # Clean up tax names so we make sure the don't include quotes. See https://github.com/etetoolkit/ete/issues/469
-        taxname = taxname.rstrip('"').lstrip('"')
-
-        if name_type == "scientific name":
-            node2taxname[nodename] = taxname
-        if name_type == "genbank common name":
-            node2common[nodename] = taxname
-        elif name_type in set(["synonym", "equivalent name", "genbank equivalent name",
-                               "anamorph", "genbank synonym", "genbank anamorph", "teleomorph"]):
-
-            # Keep track synonyms, but ignore duplicate case-insensitive names. See https://github.com/etetoolkit/ete/issues/469
-            synonym_key = (nodename, taxname.lower())
-            if synonym_key not in unique_nocase_synonyms:
-                unique_nocase_synonyms.add(synonym_key)
-                synonyms.add((nodename, taxname))
-
-    print(len(node2taxname), "names loaded.")
-    print(len(synonyms), "synonyms loaded.")
-
-    print("Loading nodes...")
-    for line in tar.extractfile("nodes.dmp"):
-        line = str(line.decode())
-        fields =  line.split("|")
-        nodename = fields[0].strip()
-        parentname = fields[1].strip()
-        try:
-            n = Tree()
-        except:
-            from .. import Tree
-            n = Tree()
-        n.name = nodename
-        #n.taxname = node2taxname[nodename]
-        n.add_prop('taxname', node2taxname[nodename])
-        if nodename in node2common:
-            n.add_prop('common_name', node2taxname[nodename])
-        n.add_prop('rank', fields[2].strip())
-        parent2child[nodename] = parentname
-        name2node[nodename] = n
-    print(len(name2node), "nodes loaded.")
-
-    print("Linking nodes...")
-    for node in name2node:
-       if node == "1":
-           t = name2node[node]
-       else:
-           parent = parent2child[node]
-           parent_node = name2node[parent]
-           parent_node.add_child(name2node[node])
-    print("Tree is loaded.")
-    return t, synonyms
-
-def generate_table(t):
-    OUT = open("taxa.tab", "w")
-    for j, n in enumerate(t.traverse()):
-        if j%1000 == 0:
-            print("\r",j,"generating entries...", end=' ')
-        temp_node = n
-        track = []
-        while temp_node:
-            track.append(temp_node.name)
-            temp_node = temp_node.up
-        if n.up:
-            print('\t'.join([n.name, n.up.name, n.props.get('taxname'), n.props.get("common_name", ''), n.props.get("rank"), ','.join(track)]), file=OUT)
-        else:
-            print('\t'.join([n.name, "", n.props.get('taxname'), n.props.get("common_name", ''), n.props.get("rank"), ','.join(track)]), file=OUT)
-    OUT.close()
-
-
 def update_db(dbfile, targz_file=None):
     basepath = os.path.split(dbfile)[0]
     if basepath and not os.path.exists(basepath):
@@ -785,20 +553,8 @@ def update_db(dbfile, targz_file=None):
         update_local_taxdump(DEFAULT_GTDBTAXADUMP)
         targz_file = DEFAULT_GTDBTAXADUMP
 
-    tar = tarfile.open(targz_file, 'r')
-    t, synonyms = load_gtdb_tree_from_dump(tar)
-
-    prepostorder = [int(node.name) for post, node in t.iter_prepostorder()]
-
-    with open(dbfile+'.traverse.pkl', 'wb') as fout:
-        pickle.dump(prepostorder, fout, 2)
-
-    print("Updating database: %s ..." %dbfile)
-    generate_table(t)
-
-    upload_data(dbfile)
-
-    os.system("rm taxa.tab")
+    with tarfile.open(targz_file, 'r') as tar:
+        build_db(dbfile, tar, DB_VERSION, synonyms=False, merged=False)
 
 def update_local_taxdump(fname=DEFAULT_GTDBTAXADUMP):
     # latest version of gtdb taxonomy dump
@@ -819,62 +575,6 @@ def update_local_taxdump(fname=DEFAULT_GTDBTAXADUMP):
         else:
             print(f'File {fname} is already up-to-date with {url} .')
 
-def upload_data(dbfile):
-    print()
-    print('Uploading to', dbfile)
-    basepath = os.path.split(dbfile)[0]
-    if basepath and not os.path.exists(basepath):
-        os.mkdir(basepath)
-
-    db = sqlite3.connect(dbfile)
-
-    create_cmd = """
-    DROP TABLE IF EXISTS stats;
-    DROP TABLE IF EXISTS species;
-    DROP TABLE IF EXISTS synonym;
-    DROP TABLE IF EXISTS merged;
-    CREATE TABLE stats (version INT PRIMARY KEY);
-    CREATE TABLE species (taxid INT PRIMARY KEY, parent INT, spname VARCHAR(50) COLLATE NOCASE, common VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT);
-    CREATE TABLE synonym (taxid INT,spname VARCHAR(50) COLLATE NOCASE, PRIMARY KEY (spname, taxid));
-    CREATE TABLE merged (taxid_old INT, taxid_new INT);
-    CREATE INDEX spname1 ON species (spname COLLATE NOCASE);
-    CREATE INDEX spname2 ON synonym (spname COLLATE NOCASE);
-    """
-    for cmd in create_cmd.split(';'):
-        db.execute(cmd)
-    print()
-
-    db.execute("INSERT INTO stats (version) VALUES (%d);" %DB_VERSION)
-    db.commit()
-
-    # for i, line in enumerate(open("syn.tab")):
-    #     if i%5000 == 0 :
-    #         print('\rInserting synonyms:     % 6d' %i, end=' ', file=sys.stderr)
-    #         sys.stderr.flush()
-    #     taxid, spname = line.strip('\n').split('\t')
-    #     db.execute("INSERT INTO synonym (taxid, spname) VALUES (?, ?);", (taxid, spname))
-    # print()
-    # db.commit()
-    # for i, line in enumerate(open("merged.tab")):
-    #     if i%5000 == 0 :
-    #         print('\rInserting taxid merges: % 6d' %i, end=' ', file=sys.stderr)
-    #         sys.stderr.flush()
-    #     taxid_old, taxid_new = line.strip('\n').split('\t')
-    #     db.execute("INSERT INTO merged (taxid_old, taxid_new) VALUES (?, ?);", (taxid_old, taxid_new))
-    # print()
-    # db.commit()
-
-    with open('taxa.tab') as f_taxa:
-        for i, line in enumerate(f_taxa):
-            if i % 5000 == 0:
-                print('\rInserting taxids: %8d' % i, end=' ', file=sys.stderr)
-                sys.stderr.flush()
-            taxid, parentid, spname, common, rank, lineage = line.strip('\n').split('\t')
-            db.execute(('INSERT INTO species          (taxid, parent, spname, common, rank, track) '
-                        'VALUES (?, ?, ?, ?, ?, ?)'), (taxid, parentid, spname, common, rank, lineage))
-    print()
-    db.commit()
-
 if __name__ == "__main__":
     #from .. import PhyloTree
     gtdb = GTDBTaxa()
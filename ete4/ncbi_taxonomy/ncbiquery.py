@@ -2,8 +2,7 @@
 
 import sys
 import os
-import pickle
-from collections import defaultdict, Counter
+from collections import defaultdict
 import requests
 from hashlib import md5
 
@@ -11,8 +10,11 @@ import sqlite3
 import math
 import tarfile
 import warnings
+import gc
 
 from ete4 import ETE_DATA_HOME, update_ete_data
+from .taxonomy import Taxonomy, build_db
+from ..parser.ete_format import build_tree
 
 
 __all__ = ["NCBITaxa", "is_taxadb_up_to_date"]
@@ -39,7 +41,7 @@ def is_taxadb_up_to_date(dbfile=DEFAULT_TAXADB):
     return version == DB_VERSION
 
 
-class NCBITaxa:
+class NCBITaxa(Taxonomy):
     """
     A local transparent connector to the NCBI taxonomy database.
     """
@@ -65,18 +67,12 @@ class NCBITaxa:
         if not os.path.exists(self.dbfile):
             raise ValueError("Cannot open taxonomy database: %s" % self.dbfile)
 
-        self.db = None
-        self._connect()
-
         if not is_taxadb_up_to_date(self.dbfile) and update:
             print('NCBI database format is outdated. Upgrading',
                   file=sys.stderr)
             self.update_taxonomy_database(taxdump_file)
 
-        if memory:
-            filedb = self.db
-            self.db = sqlite3.connect(':memory:')
-            filedb.backup(self.db)
+        self.memory = memory  # connections to a copy of the database in memory
 
     def update_taxonomy_database(self, taxdump_file=None):
         """Update the ncbi taxonomy database.
@@ -88,26 +84,7 @@ class NCBITaxa:
             taxdump.tax.gz file.
         """
         update_db(self.dbfile, taxdump_file)
-
-    def _connect(self):
-        self.db = sqlite3.connect(self.dbfile)
-
-    def _translate_merged(self, all_taxids):
-        conv_all_taxids = set((list(map(int, all_taxids))))
-
-        cmd = ('SELECT taxid_old, taxid_new '
-               'FROM merged WHERE taxid_old IN (%s)' %
-               ','.join(map(str, all_taxids)))
-
-        result = self.db.execute(cmd)
-
-        conversion = {}
-        for old, new in result.fetchall():
-            conv_all_taxids.discard(int(old))
-            conv_all_taxids.add(int(new))
-            conversion[int(old)] = int(new)
-
-        return conv_all_taxids, conversion
+        self._reload()
 
     def get_fuzzy_name_translation(self, name, sim=0.9):
         """Return taxid, species name and match score from the NCBI database.
@@ -157,38 +134,14 @@ class NCBITaxa:
 
     def get_rank(self, taxids):
         """Return dict with NCBI taxonomy ranks for each list of taxids."""
-        all_ids = set(taxids)
-        all_ids.discard(None)
-        all_ids.discard("")
-
-        query = ','.join('"%s"' % v for v in all_ids)
-        cmd = 'SELECT taxid, rank FROM species WHERE taxid IN (%s);' % query
-        result = self.db.execute(cmd)
-
-        id2rank = {}
-        for tax, spname in result.fetchall():
-            id2rank[tax] = spname
-
-        return id2rank
+        return self._get_ranks(taxids)
 
     def get_lineage_translator(self, taxids):
         """Return dict with lineage tracks corresponding to the given taxids.
 
         The lineage tracks are a hierarchically sorted list of parent taxids.
         """
-        all_ids = set(taxids)
-        all_ids.discard(None)
-        all_ids.discard("")
-
-        query = ','.join('"%s"' % v for v in all_ids)
-        cmd = 'SELECT taxid, track FROM species WHERE taxid IN (%s);' % query
-        result = self.db.execute(cmd)
-
-        id2lineages = {}
-        for tax, track in result.fetchall():
-            id2lineages[tax] = list(map(int, reversed(track.split(','))))
-
-        return id2lineages
+        return self._get_lineages(taxids)
 
     def get_lineage(self, taxid):
         """Return lineage track corresponding to the given taxid.
@@ -199,51 +152,33 @@ class NCBITaxa:
             return None
 
         taxid = int(taxid)
-        result = self.db.execute(f'SELECT track FROM species WHERE taxid={taxid}')
-        raw_track = result.fetchone()
-        if not raw_track:
+        lineage = self.get_lineage_translator([taxid]).get(taxid)
+        if not lineage:
             #perhaps is an obsolete taxid
             _, merged_conversion = self._translate_merged([taxid])
             if taxid in merged_conversion:
-                result = self.db.execute(
-                    'SELECT track FROM species WHERE taxid=%s' %
-                    merged_conversion[taxid])
-                raw_track = result.fetchone()
+                new_taxid = merged_conversion[taxid]
+                lineage = self.get_lineage_translator([new_taxid]).get(new_taxid)
 
-            if not raw_track:
+            if not lineage:
                 raise ValueError(f'Could not find taxid: {taxid}')
             else:
                 warnings.warn('taxid %s was translated into %s' %
                               (taxid, merged_conversion[taxid]))
 
-        track = list(map(int, raw_track[0].split(',')))
-        return list(reversed(track))
+        return lineage
 
     def get_common_names(self, taxids):
-        query = ','.join('"%s"' % v for v in taxids)
-        cmd = 'SELECT taxid, common FROM species WHERE taxid IN (%s);' % query
-        result = self.db.execute(cmd)
+        id2name = self._get_commons(taxids)
 
-        id2name = {}
-        for tax, common_name in result.fetchall():
-            if common_name:
-                id2name[tax] = common_name
-
-        return id2name
+        return {tax: common_name for tax, common_name in id2name.items()
+                if common_name}
 
     def get_taxid_translator(self, taxids, try_synonyms=True):
         """Return dict with the scientific names corresponding to the taxids."""
         all_ids = set(map(int, taxids))
-        all_ids.discard(None)
-        all_ids.discard("")
-
-        query = ','.join('"%s"' % v for v in all_ids)
-        cmd = 'SELECT taxid, spname FROM species WHERE taxid IN (%s);' % query
-        result = self.db.execute(cmd)
 
-        id2name = {}
-        for tax, spname in result.fetchall():
-            id2name[tax] = spname
+        id2name = self._get_names(all_ids)
 
         # Any taxid without translation? Let's try in the merged table.
         if len(all_ids) != len(id2name) and try_synonyms:
@@ -251,12 +186,8 @@ class NCBITaxa:
             taxids, old2new = self._translate_merged(not_found_taxids)
             new2old = {v: k for k,v in old2new.items()}
 
-            if old2new:
-                query = ','.join('"%s"' % v for v in new2old)
-                cmd = 'SELECT taxid, spname FROM species WHERE taxid IN (%s);' % query
-                result = self.db.execute(cmd)
-                for tax, spname in result.fetchall():
-                    id2name[new2old[tax]] = spname
+            for tax, spname in self._get_names(new2old).items():
+                id2name[new2old[tax]] = spname
 
         return id2name
 
@@ -265,30 +196,24 @@ class NCBITaxa:
 
         Exact name match is required for translation.
         """
-        name2id = {}
-        #name2realname = {}
         name2origname = {}
         for n in names:
             name2origname[n.lower()] = n
 
-        names = set(name2origname.keys())
-
-        query = ','.join('"%s"' % n for n in name2origname.keys())
-        cmd = 'SELECT spname, taxid FROM species WHERE spname IN (%s)' % query
-        result = self.db.execute('SELECT spname, taxid FROM species WHERE spname IN (%s)' % query)
-        for sp, taxid in result.fetchall():
-            oname = name2origname[sp.lower()]
-            name2id.setdefault(oname, []).append(taxid)
-            #name2realname[oname] = sp
-        missing =  names - set([n.lower() for n in name2id.keys()])
-        if missing:
-            query = ','.join('"%s"' % n for n in missing)
-            result = self.db.execute('SELECT spname, taxid FROM synonym '
-                                     'WHERE spname IN (%s)' % query)
-            for sp, taxid in result.fetchall():
-                oname = name2origname[sp.lower()]
-                name2id.setdefault(oname, []).append(taxid)
-                #name2realname[oname] = sp
+        name2id = {}
+        for table in ['species', 'synonym']:  # look in synonyms if not found
+            missing = [n for n in name2origname if name2origname[n] not in name2id]
+            if not missing:
+                break
+
+            result = self._query(
+                'SELECT spname, taxid FROM %s WHERE spname IN ({})' % table,
+                missing, normalize=str.lower)
+
+            for name in missing:
+                if result.get(name):
+                    name2id[name2origname[name]] = list(result[name])
+
         return name2id
 
     def translate_to_names(self, taxids):
@@ -321,36 +246,24 @@ class NCBITaxa:
         if conversion:
             taxid = conversion[taxid]
 
-        with open(self.dbfile+".traverse.pkl", "rb") as CACHED_TRAVERSE:
-            prepostorder = pickle.load(CACHED_TRAVERSE)
-        descendants = {}
-        found = 0
-        for tid in prepostorder:
-            if tid == taxid:
-                found += 1
-            elif found == 1:
-                descendants[tid] = descendants.get(tid, 0) + 1
-            elif found == 2:
-                break
+        descendants = self.index.descendants(taxid, intermediate_nodes=True)
 
-        if not found:
-            raise ValueError("taxid not found:%s" %taxid)
-        elif found == 1:
+        if len(descendants) == 0:
             return [taxid]
 
         if rank_limit or collapse_subspecies or return_tree:
-            tree = self.get_topology(list(descendants.keys()), intermediate_nodes=intermediate_nodes, collapse_subspecies=collapse_subspecies, rank_limit=rank_limit)
+            tree = self.get_topology(descendants.tolist(), intermediate_nodes=intermediate_nodes, collapse_subspecies=collapse_subspecies, rank_limit=rank_limit)
             if return_tree:
                 return tree
             elif intermediate_nodes:
-                return list(map(int, [n.name for n in tree.get_descendants()]))
+                return list(map(int, [n.name for n in tree.descendants()]))
             else:
                 return list(map(int, [n.name for n in tree]))
 
         elif intermediate_nodes:
-            return [tid for tid, count in descendants.items()]
+            return descendants.tolist()
         else:
-            return [tid for tid, count in descendants.items() if count == 1]
+            return self.index.descendants(taxid).tolist()
 
     def get_topology(self, taxids, intermediate_nodes=False, rank_limit=None,
                      collapse_subspecies=False, annotate=True):
@@ -370,92 +283,38 @@ class NCBITaxa:
         """
         from .. import PhyloTree
         taxids, merged_conversion = self._translate_merged(taxids)
-        if len(taxids) == 1:
-            root_taxid = int(list(taxids)[0])
-            with open(self.dbfile+".traverse.pkl", "rb") as CACHED_TRAVERSE:
-                prepostorder = pickle.load(CACHED_TRAVERSE)
-            descendants = {}
-            found = 0
-            nodes = {}
-            hit = 0
-            visited = set()
-            start = prepostorder.index(root_taxid)
-            try:
-                end = prepostorder.index(root_taxid, start+1)
-                subtree = prepostorder[start:end+1]
-            except ValueError:
-                # If root taxid is not found in postorder, must be a tip node
-                subtree = [root_taxid]
-            leaves = set(v for v, count in Counter(subtree).items() if count == 1)
-            nodes[root_taxid] = PhyloTree({'name': str(root_taxid)})
-            current_parent = nodes[root_taxid]
-            for tid in subtree:
-                if tid in visited:
-                    current_parent = nodes[tid].up
-                else:
-                    visited.add(tid)
-                    nodes[tid] = PhyloTree({'name': str(tid)})
-                    current_parent.add_child(nodes[tid])
-                    if tid not in leaves:
-                        current_parent = nodes[tid]
-            root = nodes[root_taxid]
-        else:
-            taxids = set(map(int, taxids))
-            sp2track = {}
-            elem2node = {}
-            id2lineage = self.get_lineage_translator(taxids)
-            all_taxids = set()
-            for lineage in id2lineage.values():
-                all_taxids.update(lineage)
-            id2rank = self.get_rank(all_taxids)
-            for sp in taxids:
-                track = []
-                lineage = id2lineage[sp]
-
-                for elem in lineage:
-                    if elem not in elem2node:
-                        node = elem2node.setdefault(elem, PhyloTree())
-                        node.name = str(elem)
-                        node.taxid = elem
-                        node.add_prop("rank", str(id2rank.get(int(elem), "no rank")))
-                    else:
-                        node = elem2node[elem]
-                    track.append(node)
-                sp2track[sp] = track
-            # generate parent child relationships
-            for sp, track in sp2track.items():
-                parent = None
-                for elem in track:
-                    if parent and elem not in parent.children:
-                        parent.add_child(elem)
-                    if rank_limit and elem.props.get('rank') == rank_limit:
-                        break
-                    parent = elem
-            root = elem2node[1]
-
-        #remove onechild-nodes
-        if not intermediate_nodes:
-            for n in root.descendants():
-                if len(n.children) == 1 and int(n.name) not in taxids:
-                    n.delete(prevent_nondicotomic=False)
-
-        if len(root.children) == 1:
-            tree = root.children[0].detach()
-        else:
-            tree = root
 
-        if collapse_subspecies:
-            to_detach = []
-            for node in tree.traverse():
-                if node.props.get('rank') == "species":
-                    to_detach.extend(node.children)
-            for n in to_detach:
-                n.detach()
+        positions, parents = self._get_topology_nodes(
+            taxids, intermediate_nodes, rank_limit, collapse_subspecies)
 
-        if annotate:
-            self.annotate_tree(tree)
+        index = self.index
+        node_taxids = index.taxids[positions].tolist()
+        ranks = [index.ranks[r] for r in index.rank[positions].tolist()]
 
-        return tree
+        gc_enabled = gc.isenabled()
+        gc.disable()  # avoid that the garbage collector visits all the new objects
+        try:
+            if not annotate:
+                props = [{'name': str(taxid), 'rank': rank}
+                         for taxid, rank in zip(node_taxids, ranks)]
+            else:  # with the ranks we have, and lineages computed together
+                lineages, named_lineages = self._get_named_lineages(positions)
+                tax2common_name = self.get_common_names(node_taxids)
+
+                props = [{'name': str(taxid),
+                          'taxid': taxid,
+                          'sci_name': named_lineage[-1],
+                          'common_name': tax2common_name.get(taxid, ''),
+                          'lineage': lineage,
+                          'rank': rank,
+                          'named_lineage': named_lineage}
+                         for taxid, rank, lineage, named_lineage
+                         in zip(node_taxids, ranks, lineages, named_lineages)]
+
+            return build_tree(PhyloTree, parents, props)
+        finally:
+            if gc_enabled:
+                gc.enable()
 
     def annotate_tree(self, t, taxid_attr="name", tax2name=None,
                       tax2track=None, tax2rank=None, ignore_unclassified=False):
@@ -587,89 +446,6 @@ class NCBITaxa:
         return broken_branches, broken_clades, broken_clade_sizes
 
 
-def load_ncbi_tree_from_dump(tar):
-    from .. import Tree
-    parent2child = {}
-    name2node = {}
-    node2taxname = {}
-    synonyms = set()
-    name2rank = {}
-    node2common = {}
-    print("Loading node names...")
-    unique_nocase_synonyms = set()
-    for line in tar.extractfile("names.dmp"):
-        line = str(line.decode())
-        fields =  [_f.strip() for _f in line.split("|")]
-        nodename = fields[0]
-        name_type = fields[3].lower()
-        taxname = fields[1]
-
-        # Clean up tax names so we make sure the don't include quotes. See https://github.com/etetoolkit/ete/issues/469
-        taxname = taxname.rstrip('"').lstrip('"')
-
-        if name_type == "scientific name":
-            node2taxname[nodename] = taxname
-        if name_type == "genbank common name":
-            node2common[nodename] = taxname
-        elif name_type in set(["synonym", "equivalent name", "genbank equivalent name",
-                               "anamorph", "genbank synonym", "genbank anamorph", "teleomorph"]):
-
-            # Keep track synonyms, but ignore duplicate case-insensitive names. See https://github.com/etetoolkit/ete/issues/469
-            synonym_key = (nodename, taxname.lower())
-            if synonym_key not in unique_nocase_synonyms:
-                unique_nocase_synonyms.add(synonym_key)
-                synonyms.add((nodename, taxname))
-
-    print(len(node2taxname), "names loaded.")
-    print(len(synonyms), "synonyms loaded.")
-
-    print("Loading nodes...")
-    for line in tar.extractfile("nodes.dmp"):
-        line = str(line.decode())
-        fields =  line.split("|")
-        nodename = fields[0].strip()
-        parentname = fields[1].strip()
-        n = Tree()
-        n.name = nodename
-        #n.taxname = node2taxname[nodename]
-        n.add_prop('taxname', node2taxname[nodename])
-        if nodename in node2common:
-            n.add_prop('common_name', node2taxname[nodename])
-        n.add_prop('rank', fields[2].strip())
-        parent2child[nodename] = parentname
-        name2node[nodename] = n
-    print(len(name2node), "nodes loaded.")
-
-    print("Linking nodes...")
-    for node in name2node:
-       if node == "1":
-           t = name2node[node]
-       else:
-           parent = parent2child[node]
-           parent_node = name2node[parent]
-           parent_node.add_child(name2node[node])
-    print("Tree is loaded.")
-    return t, synonyms
-
-def generate_table(t):
-    with open("taxa.tab", "w") as out:
-        for j, n in enumerate(t.traverse()):
-            if j % 1000 == 0:
-                print("\r",j,"generating entries...", end=' ')
-            temp_node = n
-            track = []
-            while temp_node:
-                track.append(temp_node.name)
-                temp_node = temp_node.up
-
-            n_up_name = n.up.name if n.up else ""
-
-            row = '\t'.join([n.name, n_up_name, n.props.get('taxname'),
-                             n.props.get("common_name", ''), n.props.get("rank"),
-                             ','.join(track)])
-
-            print(row, file=out)
-
 def update_db(dbfile, targz_file=None):
     basepath = os.path.split(dbfile)[0]
     if basepath and not os.path.exists(basepath):
@@ -679,26 +455,8 @@ def update_db(dbfile, targz_file=None):
         update_local_taxdump(DEFAULT_TAXDUMP)
         targz_file = DEFAULT_TAXDUMP
 
-    tar = tarfile.open(targz_file, 'r')
-    t, synonyms = load_ncbi_tree_from_dump(tar)
-    prepostorder = [int(node.name) for post, node in t.iter_prepostorder()]
-    pickle.dump(prepostorder, open(dbfile+'.traverse.pkl', "wb"), 2)
-
-    print("Updating database: %s ..." %dbfile)
-    generate_table(t)
-
-    with open("syn.tab", "w") as SYN:
-        SYN.write('\n'.join(["%s\t%s" %(v[0],v[1]) for v in synonyms]))
-
-    with open("merged.tab", "w") as merged:
-        for line in tar.extractfile("merged.dmp"):
-            line = str(line.decode())
-            out_line = '\t'.join([_f.strip() for _f in line.split('|')[:2]])
-            merged.write(out_line+'\n')
-
-    upload_data(dbfile)
-
-    os.system("rm syn.tab merged.tab taxa.tab")
+    with tarfile.open(targz_file, 'r') as tar:
+        build_db(dbfile, tar, DB_VERSION)
 
 
 def update_local_taxdump(fname=DEFAULT_TAXDUMP):
@@ -721,64 +479,6 @@ def update_local_taxdump(fname=DEFAULT_TAXDUMP):
             print(f'File {fname} is already up-to-date with {url} .')
 
 
-def upload_data(dbfile):
-    print()
-    print('Uploading to', dbfile)
-    basepath = os.path.split(dbfile)[0]
-    if basepath and not os.path.exists(basepath):
-        os.mkdir(basepath)
-
-    db = sqlite3.connect(dbfile)
-
-    create_cmd = """
-    DROP TABLE IF EXISTS stats;
-    DROP TABLE IF EXISTS species;
-    DROP TABLE IF EXISTS synonym;
-    DROP TABLE IF EXISTS merged;
-    CREATE TABLE stats (version INT PRIMARY KEY);
-    CREATE TABLE species (taxid INT PRIMARY KEY, parent INT, spname VARCHAR(50) COLLATE NOCASE, common VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT);
-    CREATE TABLE synonym (taxid INT,spname VARCHAR(50) COLLATE NOCASE, PRIMARY KEY (spname, taxid));
-    CREATE TABLE merged (taxid_old INT, taxid_new INT);
-    CREATE INDEX spname1 ON species (spname COLLATE NOCASE);
-    CREATE INDEX spname2 ON synonym (spname COLLATE NOCASE);
-    """
-    for cmd in create_cmd.split(';'):
-        db.execute(cmd)
-    print()
-
-    db.execute("INSERT INTO stats (version) VALUES (%d);" %DB_VERSION)
-    db.commit()
-
-    for i, line in enumerate(open("syn.tab")):
-        if i % 5000 == 0 :
-            print('\rInserting synonyms:     %6d' % i, end=' ', file=sys.stderr)
-            sys.stderr.flush()
-        taxid, spname = line.strip('\n').split('\t')
-        db.execute("INSERT INTO synonym (taxid, spname) VALUES (?, ?);",
-                   (taxid, spname))
-    print()
-    db.commit()
-    for i, line in enumerate(open("merged.tab")):
-        if i % 5000 == 0 :
-            print('\rInserting taxid merges: %6d' % i, end=' ', file=sys.stderr)
-            sys.stderr.flush()
-        taxid_old, taxid_new = line.strip('\n').split('\t')
-        db.execute("INSERT INTO merged (taxid_old, taxid_new) VALUES (?, ?);",
-                   (taxid_old, taxid_new))
-    print()
-    db.commit()
-    for i, line in enumerate(open("taxa.tab")):
-        if i % 5000 == 0 :
-            print('\rInserting taxids:      %6d' % i, end=' ', file=sys.stderr)
-            sys.stderr.flush()
-        taxid, parentid, spname, common, rank, lineage = line.strip('\n').split('\t')
-        db.execute('INSERT INTO species (taxid, parent, spname, common, rank, track) '
-                   'VALUES (?, ?, ?, ?, ?, ?);',
-                   (taxid, parentid, spname, common, rank, lineage))
-    print()
-    db.commit()
-
-
 if __name__ == "__main__":
     ncbi = NCBITaxa()
 
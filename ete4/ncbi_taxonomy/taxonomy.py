@@ -0,0 +1,819 @@
+"""
+Common parts of the taxonomy databases (NCBI and GTDB).
+
+It has the creation of a database from a taxdump (the files names.dmp,
+nodes.dmp and merged.dmp in a tar file), an index of the taxonomy in
+preorder, stored as numpy arrays, and the connections to the database.
+
+The nodes of the taxonomy are kept in preorder in the index, so the
+descendants of any node form a contiguous slice of the arrays, and
+queries like "all the descendants of a taxid" do not need the database
+or a traversal.
+
+The index is saved next to the database (in the directory
+<dbfile>.index) when the database is created, and memory-mapped when
+loaded, so only the parts that are used are read from disk. It also has
+the names of the taxa, so it is a snapshot of the most used tables of
+the database: processes (like forked workers) that load it share its
+memory, and can answer most lookups without going to the database.
+"""
+
+import os
+import sys
+import io
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import itertools
+from urllib.parse import quote
+from collections import OrderedDict
+
+import numpy as np
+
+
+COLUMNS = ['taxids', 'end', 'parent', 'rank', 'position']  # saved arrays
+STRING_COLUMNS = ['names', 'commons']  # saved as StringArrays (optional)
+
+
+class TaxonomyIndex:
+    """Taxonomy in preorder, as arrays over the preorder positions.
+
+    For the node at preorder position i:
+      taxids[i]  -- its taxid
+      end[i]     -- position after its last descendant
+      parent[i]  -- position of its parent (-1 for the root)
+      rank[i]    -- index of its rank in the list ranks
+
+    And position[taxid] is the preorder position of taxid (-1 if absent).
+
+    It may also have the scientific and common names of the nodes
+    (names[i] and commons[i]), as StringArrays.
+    """
+
+    def __init__(self, taxids, end, parent, rank, position, ranks,
+                 names=None, commons=None):
+        self.taxids = taxids
+        self.end = end
+        self.parent = parent
+        self.rank = rank
+        self.position = position
+        self.ranks = ranks
+        self.names = names
+        self.commons = commons
+
+    def __len__(self):
+        return len(self.taxids)
+
+    def find(self, taxid):
+        """Return the preorder position of taxid, or None if not in the index."""
+        taxid = int(taxid)
+        if 0 <= taxid < len(self.position):
+            pos = int(self.position[taxid])
+            if pos >= 0:
+                return pos
+        return None
+
+    def span(self, taxid):
+        """Return the positions (start, end) of the subtree of taxid."""
+        start = self.find(taxid)
+        if start is None:
+            raise ValueError('taxid not found:%s' % taxid)
+        return start, int(self.end[start])
+
+    def descendants(self, taxid, intermediate_nodes=False):
+        """Return array with the descendant taxids of taxid, in preorder.
+
+        If intermediate_nodes=False, only the leaves are included.
+        """
+        start, end = self.span(taxid)
+        taxids = self.taxids[start+1:end]
+        if intermediate_nodes:
+            return taxids
+        else:
+            is_leaf = self.end[start+1:end] == np.arange(start+2, end+1)
+            return taxids[is_leaf]
+
+    def subtree(self, taxid):
+        """Return arrays (taxids, parents) for the subtree of taxid, in preorder.
+
+        The parents are the indices of the parent of each node in the
+        returned arrays (-1 for taxid, the first one).
+        """
+        start, end = self.span(taxid)
+        parents = self.parent[start:end] - start
+        parents[0] = -1
+        return self.taxids[start:end], parents
+
+    def get_rank(self, taxid):
+        """Return the rank of taxid (or None if it is not in the index)."""
+        pos = self.find(taxid)
+        return self.ranks[self.rank[pos]] if pos is not None else None
+
+    def positions(self, taxids):
+        """Return dict {taxid: position} for the given taxids in the index."""
+        taxids = np.fromiter(taxids, dtype=np.int64)
+        taxids = taxids[(0 <= taxids) & (taxids < len(self.position))]
+        pos = self.position[taxids]
+        found = pos >= 0
+        return dict(zip(taxids[found].tolist(), pos[found].tolist()))
+
+    def induced(self, positions):
+        """Return the tree induced by the lineages of the given positions.
+
+        It is returned as a sorted array with the given positions and all
+        their ancestors (so in preorder), and a list with their parents
+        (as indices in that array, -1 for the root).
+        """
+        marked = np.zeros(len(self.taxids), dtype=bool)
+        current = np.unique(np.array(positions, dtype=np.int64))
+        while len(current) > 0:  # go up, only from nodes not seen before
+            marked[current] = True
+            parents = np.unique(self.parent[current])
+            current = parents[(parents >= 0) & ~marked[parents]]
+
+        nodes = np.flatnonzero(marked)
+        parents = np.searchsorted(nodes, self.parent[nodes])
+        parents[self.parent[nodes] < 0] = -1
+        return nodes, parents.tolist()
+
+    def lineages(self, positions):
+        """Return the lineages (lists of taxids from the root) of the given positions."""
+        nodes, parents = self.induced(positions)
+        lineages = tree_paths(parents, self.taxids[nodes].tolist())
+        return [lineages[i] for i in np.searchsorted(nodes, positions).tolist()]
+
+    def save(self, path, stamp=None):
+        """Save the arrays of the index in directory path.
+
+        :param stamp: Stamp of the database the index comes from (see
+            db_stamp()), saved to know later if it still corresponds.
+        """
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        if stamp is not None:
+            np.save(os.path.join(tmp_path, 'stamp.npy'), np.array(stamp, dtype=np.int64))
+
+        for name in COLUMNS:
+            np.save(os.path.join(tmp_path, name + '.npy'), getattr(self, name))
+        np.save(os.path.join(tmp_path, 'ranks.npy'), np.array(self.ranks, dtype=str))
+
+        for name in STRING_COLUMNS:
+            strings = getattr(self, name)
+            if strings is not None:
+                np.save(os.path.join(tmp_path, name + '.npy'), strings.data)
+                np.save(os.path.join(tmp_path, name + '_offsets.npy'), strings.offsets)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load_stamp(path):
+        """Return the stamp of the database saved with the index in path (or None)."""
+        try:
+            return np.load(os.path.join(path, 'stamp.npy')).tolist()
+        except (OSError, ValueError):
+            return None  # no index, or saved without a stamp
+
+    @classmethod
+    def load(cls, path):
+        """Return the index saved in directory path, with its arrays memory-mapped."""
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        columns = {name: load(name) for name in COLUMNS}
+
+        for name in STRING_COLUMNS:
+            if os.path.exists(os.path.join(path, name + '.npy')):
+                columns[name] = StringArray(load(name), load(name + '_offsets'))
+
+        ranks = np.load(os.path.join(path, 'ranks.npy')).tolist()
+
+        return cls(ranks=ranks, **columns)
+
+
+def tree_paths(parents, values):
+    """Return list with the values from the root to each node of a tree.
+
+    The nodes are in preorder, with parents[i] the index of the parent
+    of node i (-1 for the root), and values[i] its value.
+    """
+    paths = []
+    for parent, value in zip(parents, values):
+        paths.append((paths[parent] if parent >= 0 else []) + [value])
+    return paths
+
+
+def below(index, nodes, cut):
+    """Return mask of the nodes that descend from nodes where cut is True.
+
+    The nodes are sorted positions in index, so the descendants of a
+    node are the ones that follow it, up to the end of its subtree.
+    """
+    starts = np.flatnonzero(cut) + 1
+    ends = np.searchsorted(nodes, index.end[nodes[cut]])
+    counts = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.add.at(counts, starts, 1)
+    np.add.at(counts, ends, -1)
+    return np.cumsum(counts[:-1]) > 0
+
+
+def select_nodes(nodes, parents, keep):
+    """Return the nodes and parents of the tree with only the nodes to keep.
+
+    Each kept node hangs from its closest kept ancestor.
+    """
+    new_parents = []  # parents of the kept nodes, as indices in them
+    closest = []  # closest[i] is the index in the kept nodes of i or its closest kept ancestor
+    for parent, kept in zip(parents, keep.tolist()):
+        ancestor = closest[parent] if parent >= 0 else -1
+        if kept:
+            closest.append(len(new_parents))
+            new_parents.append(ancestor)
+        else:
+            closest.append(ancestor)
+
+    return nodes[keep], new_parents
+
+
+class StringArray:
+    """Array of strings, stored as their concatenated utf-8 bytes and offsets."""
+
+    def __init__(self, data, offsets):
+        self.data = data  # array of bytes (uint8)
+        self.offsets = offsets  # string i is data[offsets[i]:offsets[i+1]]
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [(s or '').encode() for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes().decode()
+
+    def take(self, positions):
+        """Return list of the strings at the given positions."""
+        starts = self.offsets[positions].tolist()
+        ends = self.offsets[np.asarray(positions, dtype=np.int64) + 1].tolist()
+        data = memoryview(self.data)
+        return [str(data[a:b], 'utf-8') for a, b in zip(starts, ends)]
+
+
+def build_index(taxids, parents, ranks, names=None, commons=None):
+    """Return a TaxonomyIndex for the nodes with the given taxids.
+
+    :param taxids: Taxids of all the nodes (non-negative ints).
+    :param parents: Taxids of their parents (the root can have itself
+        as parent, or a taxid not in taxids, like 0).
+    :param ranks: Names of their ranks.
+    :param names: Their scientific names (optional).
+    :param commons: Their common names (optional).
+    """
+    taxids = np.asarray(taxids, dtype=np.int32)
+    parents = np.asarray(parents, dtype=np.int64)
+    n = len(taxids)
+
+    position = np.full(int(taxids.max()) + 1, -1, dtype=np.int32)
+    position[taxids] = np.arange(n, dtype=np.int32)  # input index for now
+
+    # Index of the parent of each node (-1 for roots).
+    known = (0 <= parents) & (parents < len(position))
+    iparent = np.full(n, -1, dtype=np.int64)
+    iparent[known] = position[parents[known]]
+    iparent[iparent == np.arange(n)] = -1  # the root may be its own parent
+
+    # Children of each node, contiguous and in their input order.
+    order = np.argsort(iparent, kind='stable')
+    nroots = int(np.count_nonzero(iparent < 0))
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(iparent[iparent >= 0], minlength=n), out=offsets[1:])
+    roots, children = order[:nroots].tolist(), order[nroots:].tolist()
+    offsets = offsets.tolist()
+
+    preorder = []  # input index of the node at each preorder position
+    pending = roots[::-1]
+    while pending:
+        node = pending.pop()
+        preorder.append(node)
+        pending.extend(reversed(children[offsets[node]:offsets[node+1]]))
+    preorder = np.array(preorder, dtype=np.int64)
+
+    pos = np.empty(n, dtype=np.int32)  # preorder position of each input node
+    pos[preorder] = np.arange(n, dtype=np.int32)
+
+    parent = iparent[preorder]
+    parent[parent >= 0] = pos[parent[parent >= 0]]
+
+    sizes = [1] * n  # number of nodes in the subtree at each position
+    for i, p in zip(range(n - 1, 0, -1), parent[:0:-1].tolist()):
+        if p >= 0:
+            sizes[p] += sizes[i]
+    end = np.arange(n, dtype=np.int32) + np.array(sizes, dtype=np.int32)
+
+    rank_codes = {}
+    codes = [rank_codes.setdefault(r, len(rank_codes)) for r in ranks]
+    rank = np.array(codes, dtype=np.int16)[preorder]
+
+    position[taxids] = pos
+
+    in_preorder = lambda strings: (StringArray.from_strings([strings[i] for i in preorder.tolist()])
+                                   if strings is not None else None)
+
+    return TaxonomyIndex(taxids=taxids[preorder], end=end,
+                         parent=parent.astype(np.int32), rank=rank,
+                         position=position, ranks=list(rank_codes),
+                         names=in_preorder(names), commons=in_preorder(commons))
+
+
+def index_path(dbfile):
+    """Return the path to the directory of the index of database dbfile."""
+    return dbfile + '.index'
+
+
+def db_stamp(dbfile):
+    """Return the stamp of the database file, to tell if an index is from it."""
+    stat = os.stat(dbfile)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+loaded_indexes = {}  # (path, stamp) -> index, shared in the process
+loading_lock = threading.Lock()
+
+
+def load_index(dbfile):
+    """Return the index of the taxonomy in dbfile.
+
+    The index is loaded only once per process (while the database is
+    not modified) and shared by all the objects that use it.
+
+    If it does not exist, or it is not from the current database file
+    (like for databases created before there were indexes, or copied
+    over an older one), it is built from the database and saved if
+    possible.
+    """
+    with loading_lock:
+        path = index_path(os.path.realpath(dbfile))
+        stamp = db_stamp(dbfile)
+        key = (path, tuple(stamp))
+
+        if key not in loaded_indexes:
+            if TaxonomyIndex.load_stamp(path) == stamp:
+                loaded_indexes[key] = TaxonomyIndex.load(path)
+            else:
+                loaded_indexes[key] = create_index(dbfile, path, stamp)
+
+        return loaded_indexes[key]
+
+
+def create_index(dbfile, path, stamp=None):
+    """Return the index for database dbfile, built from it and saved in path."""
+    db = sqlite3.connect(dbfile)
+    rows = db.execute('SELECT taxid, parent, rank, spname, common FROM species').fetchall()
+    db.close()
+
+    taxids, parents, ranks, names, commons = zip(*rows)
+    parents = [int(p) if p not in (None, '') else -1 for p in parents]
+    index = build_index(taxids, parents, ranks, names, commons)
+
+    try:
+        index.save(path, stamp)
+    except OSError as e:
+        print(f'Cannot save taxonomy index in {path}: {e}', file=sys.stderr)
+
+    return index
+
+
+class Taxonomy:
+    """Base for the connectors to taxonomy databases (NCBITaxa, GTDBTaxa).
+
+    It has the index of the taxonomy and the queries to its database.
+    The queries look for many keys at once (in chunks of up to
+    MAX_VARIABLES keys), and remember their results (the last
+    CACHE_SIZE of them).
+
+    The same object can be used from several threads, and from forked
+    processes: each thread (of each process) gets its own read-only
+    connection to the database. Objects can be pickled too (without
+    their connections, cache or index).
+    """
+
+    dbfile = None
+    memory = False  # if True, use a copy of the database in memory
+    _index = None
+    _cache = None
+    _local = None  # thread-local data, with the connection of each thread
+    _pid = None  # process that created _local
+    _memdb = None  # connection that keeps the in-memory database alive
+
+    @property
+    def index(self):
+        """Index of the taxonomy in preorder (loaded once, when first used)."""
+        if self._index is None:
+            self._index = load_index(self.dbfile)
+        return self._index
+
+    @property
+    def db(self):
+        """Connection to the database for the current thread."""
+        local = self._get_local()
+        if not hasattr(local, 'db'):
+            local.db = self._connect()
+        return local.db
+
+    def _get_local(self):
+        with connecting_lock:
+            if self._local is None or self._pid != os.getpid():
+                # Connections (and locks) cannot be used across a fork.
+                self._local = threading.local()
+                self._pid = os.getpid()
+                self._memdb = None
+            return self._local
+
+    def _connect(self):
+        """Return a new read-only connection to the database."""
+        # Not opened as immutable: the file may be overwritten in place (by
+        # a copy, for example), and then sqlite would return stale data.
+        uri = 'file:%s?mode=ro' % quote(os.path.abspath(self.dbfile))
+
+        if not self.memory:
+            return sqlite3.connect(uri, uri=True)
+
+        # Copy the database once to memory, shared by all the threads.
+        with connecting_lock:
+            if self._memdb is None:
+                self._memuri = 'file:taxonomy-%d-%d?mode=memory&cache=shared' % (
+                    os.getpid(), next(memory_ids))
+                self._memdb = sqlite3.connect(self._memuri, uri=True,
+                                              check_same_thread=False)
+                filedb = sqlite3.connect(uri, uri=True)
+                filedb.backup(self._memdb)
+                filedb.close()
+            memuri = self._memuri
+
+        return sqlite3.connect(memuri, uri=True)
+
+    def _reload(self):
+        """Forget the index, connections and cached results (after updating the database)."""
+        with connecting_lock:
+            self._index = None
+            self._cache = None
+            self._local = None
+            self._memdb = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['_index', '_cache', '_local', '_pid', '_memdb', '_memuri']:
+            state.pop(name, None)  # recreated when used
+        return state
+
+    def _query(self, sql, keys, normalize=None):
+        """Return dict {key: [values]} with the rows (key, value) of sql for keys.
+
+        The query has a "{}" where the placeholders for the keys go,
+        like "SELECT taxid, rank FROM species WHERE taxid IN ({})".
+        Keys without rows get an empty list.
+
+        :param normalize: Function to apply to the keys returned by the
+            query to make them equal to the given keys (like str.lower).
+        """
+        if self._cache is None:
+            self._cache = LRUCache(CACHE_SIZE)
+        cache = self._cache
+
+        results = {}
+        missing = []
+        for key in keys:
+            values = cache.get((sql, key))
+            if values is not None:
+                results[key] = values
+            else:
+                missing.append(key)
+
+        size = min(MAX_VARIABLES, get_max_variables(self.db))
+        for i in range(0, len(missing), size):
+            chunk = missing[i:i+size]
+            found = {key: [] for key in chunk}
+            rows = self.db.execute(sql.format(','.join(['?'] * len(chunk))), chunk)
+            for key, value in rows:
+                found.setdefault(normalize(key) if normalize else key, []).append(value)
+
+            for key, values in found.items():
+                cache[(sql, key)] = values
+            results.update(found)
+
+        return results
+
+    def _query_one(self, sql, keys):
+        """Return dict {key: value} with the first value of sql for the keys found."""
+        return {key: values[0]
+                for key, values in self._query(sql, keys).items() if values}
+
+    def _get_ranks(self, taxids):
+        """Return dict {taxid: rank} for the given taxids (those found)."""
+        index = self.index
+        positions = index.positions(as_taxids(taxids))
+        ranks = index.rank[list(positions.values())].tolist()
+        return {taxid: index.ranks[r] for taxid, r in zip(positions, ranks)}
+
+    def _get_lineages(self, taxids):
+        """Return dict {taxid: lineage} for the given taxids (those found)."""
+        positions = self.index.positions(as_taxids(taxids))
+        return dict(zip(positions, self.index.lineages(list(positions.values()))))
+
+    def _get_topology_nodes(self, taxids, intermediate_nodes=False,
+                            rank_limit=None, collapse_subspecies=False):
+        """Return the positions and parents of the nodes of the topology for taxids.
+
+        The positions (in the index) are in preorder, and the parents
+        are given as indices in the returned positions (-1 for the root).
+        For a single taxid, the topology is its subtree, and for several
+        ones, the tree of their lineages. The arguments are the ones in
+        get_topology().
+        """
+        index = self.index
+        taxids = set(map(int, taxids))
+
+        if len(taxids) == 1:
+            start, end = index.span(list(taxids)[0])
+            nodes = np.arange(start, end)
+            parents = (index.parent[nodes] - start).tolist()
+            parents[0] = -1
+        else:
+            positions = index.positions(taxids)
+            if len(positions) < len(taxids) or not positions:
+                missing = taxids - set(positions)
+                raise ValueError('taxids not found: %s' % ', '.join(map(str, missing)))
+            nodes, parents = index.induced(list(positions.values()))
+
+        if rank_limit in index.ranks:  # cut the nodes below the rank limit
+            cut = index.rank[nodes] == index.ranks.index(rank_limit)
+            nodes, parents = select_nodes(nodes, parents, ~below(index, nodes, cut))
+
+        if not intermediate_nodes:  # remove the nodes with a single child
+            nchildren = np.bincount(parents[1:], minlength=len(nodes))
+            keep = (nchildren != 1) | np.isin(index.taxids[nodes], list(taxids))
+            keep[0] = True
+            nodes, parents = select_nodes(nodes, parents, keep)
+
+        if parents.count(0) == 1:  # the root has a single child
+            keep = np.ones(len(nodes), dtype=bool)
+            keep[0] = False
+            nodes, parents = select_nodes(nodes, parents, keep)
+
+        if collapse_subspecies and 'species' in index.ranks:
+            cut = index.rank[nodes] == index.ranks.index('species')
+            nodes, parents = select_nodes(nodes, parents, ~below(index, nodes, cut))
+
+        return nodes, parents
+
+    def _get_named_lineages(self, positions):
+        """Return the lineages of the given positions, as lists of taxids and names."""
+        nodes, parents = self.index.induced(positions)
+        taxids = self.index.taxids[nodes].tolist()
+        tax2name = self._get_names(taxids)
+
+        lineages = tree_paths(parents, taxids)
+        named_lineages = tree_paths(parents, [tax2name.get(tax, str(tax)) for tax in taxids])
+
+        at = np.searchsorted(nodes, positions).tolist()
+        return [lineages[i] for i in at], [named_lineages[i] for i in at]
+
+    def _get_names(self, taxids):
+        """Return dict {taxid: scientific name} for the given taxids (those found)."""
+        return self._get_strings('names', 'spname', taxids)
+
+    def _get_commons(self, taxids):
+        """Return dict {taxid: common name} for the given taxids (those found)."""
+        return self._get_strings('commons', 'common', taxids)
+
+    def _get_strings(self, name, column, taxids):
+        strings = getattr(self.index, name)
+
+        if strings is None:  # an index without them: ask the database
+            return self._query_one(
+                'SELECT taxid, %s FROM species WHERE taxid IN ({})' % column,
+                as_taxids(taxids))
+
+        positions = self.index.positions(as_taxids(taxids))
+        return dict(zip(positions, strings.take(list(positions.values()))))
+
+    def _translate_merged(self, all_taxids):
+        conv_all_taxids = as_taxids(all_taxids)
+
+        # Only taxids that are not in the taxonomy can be old (merged) ones.
+        current = self.index.positions(conv_all_taxids)
+        conversion = self._query_one(
+            'SELECT taxid_old, taxid_new FROM merged WHERE taxid_old IN ({})',
+            [taxid for taxid in conv_all_taxids if taxid not in current])
+
+        for old, new in conversion.items():
+            conv_all_taxids.discard(old)
+            conv_all_taxids.add(new)
+
+        return conv_all_taxids, conversion
+
+
+connecting_lock = threading.Lock()
+memory_ids = itertools.count()  # to give unique names to in-memory databases
+
+MAX_VARIABLES = 30000  # keys per query (SQLite allows 32766 by default)
+CACHE_SIZE = 500000  # results remembered by each Taxonomy instance
+
+
+def get_max_variables(db):
+    """Return the maximum number of variables in a query to database db."""
+    try:
+        return db.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    except AttributeError:  # python < 3.11
+        return 999  # the lowest limit, for old versions of SQLite
+
+
+def as_taxids(values):
+    """Return the set of values that are taxids, as ints."""
+    taxids = set()
+    for value in values:
+        try:
+            taxids.add(int(value))
+        except (ValueError, TypeError):
+            pass  # not a taxid (like None or '')
+    return taxids
+
+
+class LRUCache(OrderedDict):
+    """Dict that keeps only its maxsize most recently used items."""
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+        self.lock = threading.Lock()  # it can be used from several threads
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self[key]
+            except KeyError:
+                return default
+            self.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            if len(self) > self.maxsize:
+                self.popitem(last=False)
+
+
+# Creation of the database.
+
+SYNONYM_TYPES = {'synonym', 'equivalent name', 'genbank equivalent name',
+                 'anamorph', 'genbank synonym', 'genbank anamorph', 'teleomorph'}
+
+CREATE_TABLES = """
+CREATE TABLE stats (version INT PRIMARY KEY);
+CREATE TABLE species (taxid INT, parent INT, spname VARCHAR(50) COLLATE NOCASE, common VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT);
+CREATE TABLE synonym (taxid INT, spname VARCHAR(50) COLLATE NOCASE);
+CREATE TABLE merged (taxid_old INT, taxid_new INT);
+"""
+
+CREATE_INDEXES = """
+CREATE UNIQUE INDEX taxid ON species (taxid);
+CREATE INDEX spname1 ON species (spname COLLATE NOCASE);
+CREATE UNIQUE INDEX spname2 ON synonym (spname COLLATE NOCASE, taxid);
+CREATE INDEX taxid_old ON merged (taxid_old);
+"""
+
+
+def build_db(dbfile, tar, version, synonyms=True, merged=True):
+    """Create the database dbfile (and its index) from the taxdump in tar.
+
+    The database is written in a temporary directory, with all its rows
+    inserted in a single transaction and its indexes created at the
+    end, and then it replaces dbfile.
+
+    :param tar: Open tar file with the taxdump.
+    :param version: Version number of the database format.
+    :param synonyms: If True, fill the table of synonyms from names.dmp.
+    :param merged: If True, fill the table of merged taxids from merged.dmp.
+    """
+    t0 = time.time()
+
+    print('Loading node names...')
+    names, commons, synonym_rows = read_names(read_dump(tar, 'names.dmp'))
+    print(len(names), 'names loaded.')
+    print(len(synonym_rows), 'synonyms loaded.')
+
+    print('Loading nodes...')
+    taxids, parents, ranks = read_nodes(read_dump(tar, 'nodes.dmp'))
+    print(len(taxids), 'nodes loaded.')
+
+    index = build_index(taxids, parents, ranks,
+                        [names.get(taxid) for taxid in taxids],
+                        [commons.get(taxid) for taxid in taxids])
+
+    print('Updating database: %s ...' % dbfile)
+    basepath = os.path.dirname(os.path.abspath(dbfile))
+    with tempfile.TemporaryDirectory(dir=basepath) as tmpdir:
+        tmpfile = os.path.join(tmpdir, os.path.basename(dbfile))
+
+        db = sqlite3.connect(tmpfile)
+        db.execute('PRAGMA journal_mode = OFF')  # a new file, replaced only
+        db.execute('PRAGMA synchronous = OFF')   # once it is complete
+
+        with db:  # a single transaction
+            db.executescript(CREATE_TABLES)
+            db.execute('INSERT INTO stats (version) VALUES (?)', (version,))
+            db.executemany('INSERT INTO species (taxid, parent, spname, common, rank, track) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           species_rows(index, names, commons))
+            if synonyms:
+                db.executemany('INSERT INTO synonym (taxid, spname) VALUES (?, ?)',
+                               synonym_rows)
+            if merged:
+                db.executemany('INSERT INTO merged (taxid_old, taxid_new) VALUES (?, ?)',
+                               read_merged(read_dump(tar, 'merged.dmp')))
+            db.executescript(CREATE_INDEXES)
+
+        db.close()
+
+        os.replace(tmpfile, dbfile)
+
+    index.save(index_path(dbfile), db_stamp(dbfile))
+
+    print('Database built in %.1f s: %s' % (time.time() - t0, dbfile))
+
+
+def read_dump(tar, fname):
+    """Yield the (unstripped) fields of each line of file fname (a .dmp) in tar."""
+    with io.TextIOWrapper(tar.extractfile(fname), encoding='utf-8') as f:
+        for line in f:
+            yield line.split('|')
+
+
+def read_names(rows):
+    """Return the scientific names, common names and synonyms in names.dmp.
+
+    The names are dicts {taxid: name}, and the synonyms a list of
+    (taxid, name) pairs.
+    """
+    names = {}
+    commons = {}
+    synonyms = {}  # (taxid, lowercase name) -> (taxid, name)
+
+    for fields in rows:
+        taxid = int(fields[0])
+        name = fields[1].strip().strip('"')  # see https://github.com/etetoolkit/ete/issues/469
+        name_type = fields[3].strip().lower()
+
+        if name_type == 'scientific name':
+            names[taxid] = name
+        elif name_type == 'genbank common name':
+            commons[taxid] = name
+        elif name_type in SYNONYM_TYPES:
+            # Ignore duplicate case-insensitive names (also issue 469).
+            synonyms.setdefault((taxid, name.lower()), (taxid, name))
+
+    return names, commons, list(synonyms.values())
+
+
+def read_nodes(rows):
+    """Return lists with the taxids, parents and ranks in nodes.dmp."""
+    taxids, parents, ranks = [], [], []
+
+    for fields in rows:
+        taxids.append(int(fields[0]))
+        parents.append(int(fields[1]))
+        ranks.append(fields[2].strip())
+
+    return taxids, parents, ranks
+
+
+def read_merged(rows):
+    """Yield the pairs (old taxid, new taxid) in merged.dmp."""
+    for fields in rows:
+        yield int(fields[0]), int(fields[1])
+
+
+def species_rows(index, names, commons):
+    """Yield the rows of the species table for the nodes in index."""
+    taxids = index.taxids.tolist()
+    ranks = [index.ranks[r] for r in index.rank.tolist()]
+
+    path = []  # (position, track) of the ancestors of the current node
+    for pos, parent in enumerate(index.parent.tolist()):
+        while path and path[-1][0] != parent:
+            path.pop()
+
+        taxid = taxids[pos]
+        track = str(taxid) + (',' + path[-1][1] if path else '')
+        path.append((pos, track))
+
+        yield (taxid, taxids[parent] if parent >= 0 else '',
+               names.get(taxid), commons.get(taxid, ''), ranks[pos], track)
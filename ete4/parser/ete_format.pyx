@@ -0,0 +1,686 @@
+"""
+Binary format to store trees with their topology and all their properties.
+
+The nodes are stored in preorder, and the tree as a set of columns (arrays)
+with values for the nodes: one with the position of each node's parent (the
+topology), and one per property, with a type that depends on its values.
+
+A file looks like::
+
+  MAGIC | version (1 byte) | compression (1 byte) | padding (2 bytes) | content
+
+and its (possibly compressed) content::
+
+  header size (8 bytes) | header (json) | arrays (each 8-byte aligned)
+
+The header describes the number of nodes, and the type and location of the
+arrays for all the columns. It also has the position of the first child and
+next sibling of each node (0 if there is none), so the tree can be navigated
+directly from the arrays (see :func:`open_tree`).
+"""
+
+import gc
+import json
+import gzip
+import mmap
+import pickle
+
+import numpy as np
+
+from ete4.core.tree import Tree
+
+
+class EteFormatError(Exception):
+    pass
+
+
+MAGIC = b'ETE\x00'
+VERSION = 1
+
+COMPRESSIONS = {None: b'n', 'gzip': b'g', 'zstd': b'z'}
+
+
+# Writing.
+
+def dump(tree, fp, compression=None):
+    """Write the tree to the file object fp (opened in binary mode)."""
+    fp.write(dumps(tree, compression))
+
+
+def dumps(tree, compression=None):
+    """Return bytes with the tree encoded in ete format.
+
+    :param tree: Tree to encode.
+    :param compression: Can be None, 'gzip' or 'zstd' (needs the
+        "zstandard" module).
+    """
+    if compression not in COMPRESSIONS:
+        raise EteFormatError(f'unknown compression: {compression}')
+
+    content = encode(tree)
+
+    return (MAGIC + bytes([VERSION]) + COMPRESSIONS[compression] + b'\0\0' +
+            compress(content, compression))
+
+
+def encode(tree):
+    """Return bytes with the header and arrays describing the tree."""
+    cdef long i, n
+    cdef list nodes, parents, inodes
+    cdef dict node_props, prop_nodes, prop_values
+
+    nodes, parents = get_nodes_and_parents(tree)
+    n = len(nodes)
+
+    # Properties: for each one, the nodes that have it and its values.
+    prop_nodes = {}  # {pname: [i0, i1, ...]}
+    prop_values = {}  # {pname: [v0, v1, ...]}
+    for i in range(n):
+        node_props = nodes[i].props
+        for pname, value in node_props.items():
+            inodes = prop_nodes.get(pname)
+            if inodes is None:
+                inodes = prop_nodes[pname] = []
+                prop_values[pname] = []
+            inodes.append(i)
+            prop_values[pname].append(value)
+
+    arrays = []  # what we will write after the header, in order
+
+    def add(array):  # add array and return its description for the header
+        arrays.append(array)
+        return {'dtype': array.dtype.str, 'size': len(array)}
+
+    columns = []
+    for pname in prop_nodes:
+        column = {'name': pname}
+
+        if len(prop_nodes[pname]) < n:  # only some nodes have the property
+            mask = np.zeros(n, dtype=bool)
+            mask[prop_nodes[pname]] = True
+            column['mask'] = add(np.packbits(mask))
+
+        column.update(encode_values(prop_values[pname], add))
+
+        columns.append(column)
+
+    first_child, next_sibling = get_links(parents)
+
+    header = {'nodes': n,
+              'parents': add(np.array(parents, dtype=index_dtype(n))),
+              'first_child': add(np.array(first_child, dtype=index_dtype(n))),
+              'next_sibling': add(np.array(next_sibling, dtype=index_dtype(n))),
+              'columns': columns}
+
+    return join(header, arrays)
+
+
+def get_nodes_and_parents(tree):
+    """Return the nodes in preorder, and the positions of their parents."""
+    cdef long i, j
+    cdef list nodes = [], parents = [], pending = [tree], pending_parents = [-1]
+    cdef list children
+
+    while pending:
+        i = len(nodes)
+        node = pending.pop()
+        nodes.append(node)
+        parents.append(pending_parents.pop())
+
+        children = node.children
+        for j in range(len(children) - 1, -1, -1):
+            pending.append(children[j])
+            pending_parents.append(i)
+
+    return nodes, parents
+
+
+def get_links(list parents):
+    """Return the positions of the first child and next sibling of each node."""
+    cdef long i, p, n = len(parents)
+    cdef list first_child = [0] * n, next_sibling = [0] * n
+
+    # Going backwards, the last child we see of each node is its first.
+    for i in range(n - 1, 0, -1):
+        p = parents[i]
+        next_sibling[i] = first_child[p]
+        first_child[p] = i
+
+    return first_child, next_sibling
+
+
+def encode_values(list values, add):
+    """Return a description of the values, adding the needed arrays."""
+    vtypes = set(map(type, values))
+    vtype = vtypes.pop() if len(vtypes) == 1 else None
+
+    if vtype in [float, int, bool]:
+        array = np.array(values)
+        if array.dtype != object:  # it could be for ints too big for int64
+            return {'type': vtype.__name__, 'values': add(array)}
+    elif vtype == str:
+        categories = set(values)
+        if len(categories) <= len(values) // 2:  # many repeated values
+            categories = {x: i for i, x in enumerate(categories)}
+            codes = [categories[x] for x in values]
+            return {'type': 'category',
+                    'codes': add(np.array(codes, dtype=index_dtype(len(categories)))),
+                    'values': add_strings(list(categories), add)}
+        else:
+            return {'type': 'str', 'values': add_strings(values, add)}
+
+    return {'type': 'pickle',  # anything else
+            'values': add_blobs([pickle.dumps(x) for x in values], add)}
+
+
+def add_strings(list strings, add):
+    """Add the strings (as utf-8 blobs) and return a description."""
+    data = ''.join(strings).encode()
+    lengths = get_lengths(strings)
+
+    if len(data) != lengths.sum():  # not all ascii, so lengths are different
+        return add_blobs([x.encode() for x in strings], add)
+
+    return add_data(lengths, data, add)
+
+
+def add_blobs(list blobs, add):
+    """Add the blobs (as their offsets and content) and return a description."""
+    return add_data(get_lengths(blobs), b''.join(blobs), add)
+
+
+def get_lengths(list xs):
+    return np.fromiter(map(len, xs), dtype=np.int64, count=len(xs))
+
+
+def add_data(lengths, data, add):
+    """Add the offsets and data of some blobs and return a description."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    return {'offsets': add(offsets),
+            'data': add(np.frombuffer(data, dtype=np.uint8))}
+
+
+def index_dtype(long n):
+    """Return the smallest signed integer type that can index n elements."""
+    return np.int32 if n < 2**31 else np.int64
+
+
+def join(header, arrays):
+    """Return the bytes of the header and (aligned) arrays together."""
+    # Compute the positions where all the arrays will be.
+    offset = 0
+    descriptions = get_descriptions(header)
+    for desc, array in zip(descriptions, arrays):
+        desc['offset'] = offset
+        offset = align(offset + array.nbytes)
+
+    header_bytes = json.dumps(header).encode()
+    start = align(8 + len(header_bytes))  # where the arrays start
+
+    content = bytearray(start + offset)
+    content[:8] = len(header_bytes).to_bytes(8, 'little')
+    content[8:8+len(header_bytes)] = header_bytes
+    for desc, array in zip(descriptions, arrays):
+        pos = start + desc['offset']
+        content[pos:pos+array.nbytes] = array.tobytes()
+
+    return bytes(content)
+
+
+def get_descriptions(header):
+    """Return the array descriptions in the header, in the order of the arrays."""
+    # The order is the same as in encode(), when calling add().
+    descriptions = []
+    for column in header['columns']:
+        if 'mask' in column:
+            descriptions.append(column['mask'])
+        if column['type'] == 'category':
+            descriptions.append(column['codes'])
+        if column['type'] in ['category', 'str', 'pickle']:
+            descriptions += [column['values']['offsets'],
+                             column['values']['data']]
+        else:
+            descriptions.append(column['values'])
+    descriptions += [header['parents'],
+                     header['first_child'], header['next_sibling']]
+    return descriptions
+
+
+def align(long n, long alignment=8):
+    """Return the smallest number >= n that is a multiple of alignment."""
+    return (n + alignment - 1) // alignment * alignment
+
+
+def compress(data, compression):
+    if compression is None:
+        return data
+    elif compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    elif compression == 'zstd':
+        import zstandard  # optional dependency
+        return zstandard.ZstdCompressor().compress(data)
+
+
+def decompress(data, compression):
+    if compression is None:
+        return data
+    elif compression == 'gzip':
+        return gzip.decompress(data)
+    elif compression == 'zstd':
+        import zstandard  # optional dependency
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+# Reading.
+
+def load(fp, tree_class=Tree):
+    """Return the tree read from the file object fp (opened in binary mode)."""
+    return loads(fp.read(), tree_class)
+
+
+def loads(data, tree_class=Tree):
+    """Return the tree encoded in data (bytes in ete format)."""
+    header, content = read_content(data)
+
+    gc_enabled = gc.isenabled()
+    gc.disable()  # avoid that the garbage collector visits all the new objects
+    try:
+        n = header['nodes']
+        parents = get_array(content, header['parents'])
+
+        # Properties of each node. We start with all the properties that all
+        # nodes have (so their dicts do not need to be resized later).
+        template = dict.fromkeys(c['name'] for c in header['columns']
+                                 if 'mask' not in c)
+        props = [template.copy() for _ in range(n)]
+        for column in header['columns']:
+            add_column(props, content, column)
+
+        return build_tree(tree_class, parents.tolist(), props)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def read_content(data):
+    """Return the header and content of data (bytes in ete format)."""
+    data = memoryview(data)  # so we do not copy it if it is not compressed
+
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise EteFormatError('data does not start with the ete format signature')
+
+    version = data[len(MAGIC)]
+    if version > VERSION:
+        raise EteFormatError(f'unsupported ete format version: {version}')
+
+    code = bytes(data[len(MAGIC)+1:len(MAGIC)+2])
+    compressions = {v: k for k, v in COMPRESSIONS.items()}
+    if code not in compressions:
+        raise EteFormatError(f'unknown compression code: {code}')
+
+    content = decompress(data[len(MAGIC)+4:], compressions[code])
+
+    size = int.from_bytes(content[:8], 'little')
+    header = json.loads(bytes(content[8:8+size]))
+    start = align(8 + size)
+
+    return header, memoryview(content)[start:]
+
+
+def get_array(content, desc):
+    """Return the array described by desc that is in the content."""
+    return np.frombuffer(content, dtype=np.dtype(desc['dtype']),
+                         count=desc['size'], offset=desc['offset'])
+
+
+def add_column(list props, content, dict column):
+    """Add to the node props the values of the given column."""
+    pname, ctype = column['name'], column['type']
+
+    cdef long i, n = len(props)
+    cdef list inodes, values
+    cdef dict node_props
+
+    if 'mask' in column:
+        mask = np.unpackbits(get_array(content, column['mask']))[:n]
+        inodes = np.flatnonzero(mask).tolist()
+    else:
+        inodes = None  # all the nodes
+
+    if ctype in ['float', 'int', 'bool']:
+        values = get_array(content, column['values']).tolist()
+    elif ctype == 'str':
+        values = [x.decode() for x in get_blobs(content, column['values'])]
+    elif ctype == 'category':
+        categories = [x.decode() for x in get_blobs(content, column['values'])]
+        values = [categories[i] for i in get_array(content, column['codes']).tolist()]
+    elif ctype == 'pickle':
+        values = [pickle.loads(x) for x in get_blobs(content, column['values'])]
+    else:
+        raise EteFormatError(f'unknown column type: {ctype}')
+
+    for i in range(len(values)):
+        node_props = props[inodes[i] if inodes is not None else i]
+        node_props[pname] = values[i]
+
+
+def get_blobs(content, desc):
+    """Return a list with the blobs (as bytes) described by desc."""
+    offsets = get_array(content, desc['offsets']).tolist()
+    data = get_array(content, desc['data']).tobytes()
+    return [data[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
+
+def build_tree(tree_class, list parents, list props):
+    """Return the tree with the given parents and props (nodes in preorder)."""
+    cdef long i, n = len(parents)
+
+    if n == 0:
+        raise EteFormatError('no nodes in tree')
+
+    if tree_class is Tree:  # shortcut: create the nodes without __init__()
+        nodes = [Tree.__new__(Tree) for i in range(n)]
+        for i in range(n):
+            node = nodes[i]
+            node.props = props[i]
+            node._children = []
+    else:
+        nodes = [tree_class(props[i]) for i in range(n)]
+
+    for i in range(1, n):
+        child, parent = nodes[i], nodes[parents[i]]
+        child.up = parent
+        parent._children.append(child)
+
+    return nodes[0]
+
+
+# Memory-mapped trees.
+
+def open_tree(path):
+    """Return a read-only tree with the contents of the ete file at path.
+
+    The file (which must not be compressed) is memory-mapped, and the
+    nodes are only created when they are accessed. That way huge trees
+    can be explored without loading them, and several processes can
+    share the same file in memory.
+    """
+    return MappedData(path).node(0)
+
+
+class MappedTree(Tree):
+    """Read-only tree whose nodes are created from a mapped file when accessed.
+
+    Changes to the props of the nodes are not saved in the file (and are
+    lost if the nodes are pickled).
+    """
+
+    __slots__ = ['_data', '_index', '_kids']
+
+    def __reduce__(self):
+        return get_mapped_node, (self._data, self._index)
+
+    @property
+    def children(self):
+        if self._kids is None:
+            self._kids = self._data.get_children(self)
+        return self._kids
+
+    @children.setter
+    def children(self, value):
+        read_only()
+
+    @property
+    def is_leaf(self):
+        return self._data.first_child.item(self._index) == 0
+
+    def get_children(self):
+        return list(self.children)
+
+    def add_child(self, *args, **kwargs):
+        read_only()
+
+    def remove_child(self, *args, **kwargs):
+        read_only()
+
+    def detach(self, *args, **kwargs):
+        read_only()
+
+    def delete(self, *args, **kwargs):
+        read_only()
+
+    def update_sizes(self):
+        """Update the sizes of all the nodes, without creating them."""
+        self._data.update_sizes()
+
+
+def read_only():
+    from ete4.core.tree import TreeError  # not at the top: circular import
+    raise TreeError('cannot modify a read-only tree')
+
+
+def get_mapped_node(data, i):
+    return data.node(i)
+
+
+class MappedData:
+    """Arrays of a memory-mapped file in ete format, and the nodes created."""
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if bytes(self.mm[len(MAGIC)+1:len(MAGIC)+2]) != COMPRESSIONS[None]:
+            raise EteFormatError('cannot map a compressed file')
+
+        header, content = read_content(self.mm)
+
+        self.parents = get_array(content, header['parents'])
+        self.first_child = get_array(content, header['first_child'])
+        self.next_sibling = get_array(content, header['next_sibling'])
+        self.columns = [MappedColumn(content, column, header['nodes'])
+                        for column in header['columns']]
+
+        self.root = None
+        self.sizes = None  # will be (dxs, nleaves) if computed
+
+    def __reduce__(self):
+        return MappedData, (self.path,)
+
+    def node(self, long i):
+        """Return the node at position i (in preorder), creating it if needed."""
+        if self.root is None:
+            self.root = self.create_node(0, None)
+
+        ancestors = []  # positions from node i up to (excluding) the root
+        while i != 0:
+            ancestors.append(i)
+            i = self.parents.item(i)
+
+        node = self.root
+        for i in ancestors[::-1]:
+            node = next(n for n in node.children if n._index == i)
+
+        return node
+
+    def get_children(self, parent):
+        """Return a tuple with the (newly created) children of parent."""
+        cdef long i = self.first_child.item(parent._index)
+
+        children = []
+        while i != 0:
+            children.append(self.create_node(i, parent))
+            i = self.next_sibling.item(i)
+
+        return tuple(children)
+
+    def create_node(self, long i, parent):
+        """Return a new node for position i, with the given parent."""
+        node = MappedTree.__new__(MappedTree)
+        node.up = parent
+        node.props = self.get_props(i)
+        node._data = self
+        node._index = i
+        node._kids = None
+        if self.sizes is not None:
+            node.size = (self.sizes[0].item(i), self.sizes[1].item(i))
+        return node
+
+    def get_props(self, long i):
+        """Return a dict with the properties of the node at position i."""
+        cdef dict props = {}
+        for column in self.columns:
+            value = column.get(i)
+            if value is not MISSING:
+                props[column.name] = value
+        return props
+
+    def update_sizes(self):
+        """Compute the sizes of all the nodes and update the existing ones."""
+        n = len(self.parents)
+
+        dists = np.ones(n)
+        dists[0] = 0  # default dist for the root (like in update_size())
+        for column in self.columns:
+            if column.name == 'dist':
+                column.fill(dists, float)
+
+        self.sizes = get_sizes(self.parents.astype(np.int_), dists)
+
+        if self.root is not None:
+            pending = [self.root]
+            while pending:
+                node = pending.pop()
+                node.size = (self.sizes[0].item(node._index),
+                             self.sizes[1].item(node._index))
+                if node._kids is not None:
+                    pending.extend(node._kids)
+
+
+MISSING = object()  # returned when a node does not have a property
+
+BLOCK = 64  # number of bytes of a mask with a precomputed rank (512 nodes)
+
+
+class MappedColumn:
+    """Values of a property, read for one node at a time."""
+
+    def __init__(self, content, dict column, long n):
+        self.name = column['name']
+        self.ctype = column['type']
+
+        if 'mask' in column:
+            self.mask = get_array(content, column['mask'])
+            self.ranks = get_block_ranks(self.mask)
+        else:
+            self.mask = None
+
+        if self.ctype in ['float', 'int', 'bool']:
+            self.values = get_array(content, column['values'])
+        elif self.ctype in ['str', 'category', 'pickle']:
+            self.offsets = get_array(content, column['values']['offsets'])
+            self.data = get_array(content, column['values']['data'])
+            if self.ctype == 'category':
+                self.codes = get_array(content, column['codes'])
+                self.categories = {}  # cache of the decoded categories
+        else:
+            raise EteFormatError(f'unknown column type: {self.ctype}')
+
+        self.n = n
+
+    def get(self, long i):
+        """Return the value for the node at position i (or MISSING)."""
+        if self.mask is not None:
+            if not has_bit(self.mask, i):
+                return MISSING
+            i = rank(self.mask, self.ranks, i)
+
+        if self.ctype in ['float', 'int', 'bool']:
+            return self.values.item(i)
+        elif self.ctype == 'str':
+            return self.blob(i).decode()
+        elif self.ctype == 'category':
+            code = self.codes.item(i)
+            if code not in self.categories:
+                self.categories[code] = self.blob(code).decode()
+            return self.categories[code]
+        else:  # pickle
+            return pickle.loads(self.blob(i))
+
+    def blob(self, long i):
+        return self.data[self.offsets.item(i):self.offsets.item(i+1)].tobytes()
+
+    def fill(self, array, convert):
+        """Set the values of this column in the array (for the nodes with it)."""
+        cdef long i
+
+        if self.ctype in ['float', 'int', 'bool']:
+            inodes = (np.flatnonzero(np.unpackbits(self.mask)[:self.n])
+                      if self.mask is not None else slice(None))
+            array[inodes] = self.values
+        else:
+            for i in range(self.n):
+                value = self.get(i)
+                if value is not MISSING:
+                    array[i] = convert(value)
+
+
+def get_block_ranks(mask):
+    """Return the number of bits set in mask before each block of it."""
+    counts = np.unpackbits(mask).reshape(-1, 8).sum(axis=1)  # per byte
+    sums = np.add.reduceat(counts, np.arange(0, len(mask), BLOCK))  # per block
+
+    ranks = np.zeros(len(sums), dtype=np.int_)
+    np.cumsum(sums[:-1], out=ranks[1:])
+    return ranks
+
+
+cdef int has_bit(const unsigned char[:] mask, long i):
+    """Return 1 if bit i of mask (packed as in np.packbits) is set, else 0."""
+    return (mask[i // 8] >> (7 - i % 8)) & 1
+
+
+cdef long rank(const unsigned char[:] mask, const long[:] ranks, long i):
+    """Return the number of bits set in mask before bit i."""
+    cdef long j, r = ranks[i // (8 * BLOCK)]
+
+    for j in range(i // (8 * BLOCK) * BLOCK, i // 8):
+        r += popcount(mask[j])
+
+    return r + popcount(mask[i // 8] >> (8 - i % 8))
+
+
+cdef int popcount(unsigned int x):
+    """Return the number of bits set in x."""
+    cdef int n = 0
+    while x:
+        x &= x - 1
+        n += 1
+    return n
+
+
+def get_sizes(const long[:] parents, const double[:] dists):
+    """Return arrays with the sizes (dx, nleaves) of all nodes in preorder.
+
+    The sizes are the same as the ones computed by ops.update_size().
+    """
+    cdef long i, p, n = len(parents)
+
+    dxs = np.zeros(n)
+    nleaves = np.zeros(n)
+    cdef double[:] dx = dxs, nl = nleaves
+    cdef double[:] dx_children = np.zeros(n)  # dist to furthest leaf
+
+    for i in range(n - 1, -1, -1):  # descendants before their ancestors
+        dx[i] = dists[i] + dx_children[i]
+        nl[i] = max(1, nl[i])
+        if i > 0:
+            p = parents[i]
+            dx_children[p] = max(dx_children[p], dx[i])
+            nl[p] += nl[i]
+
+    return dxs, nleaves
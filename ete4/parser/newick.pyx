@@ -4,6 +4,12 @@ Parser for trees represented in newick format.
 
 # See https://en.wikipedia.org/wiki/Newick_format
 
+import os
+import gc
+import bz2
+import zlib
+import codecs
+
 from ete4.core.tree import Tree
 
 
@@ -134,12 +140,14 @@ def content_repr(node, props=None, parser=None):
             (f'[&&NHX:{pairs_str}]' if pairs_str else ''))  # [&&NHX:p2=x:p3=y]
 
 
-def get_props(content, is_leaf, parser=None):
+def get_props(str content, is_leaf, parser=None):
     """Return the properties from the content (as a newick) of a node.
 
     Example (for the default format of a leaf node):
       'abc:123[&&NHX:x=foo]'  ->  {'name': 'abc', 'dist': 123, 'x': 'foo'}
     """
+    cdef long pos
+
     parser = parser or PARSER_DEFAULT
     prop0, prop1 = parser['leaf' if is_leaf else 'internal']
 
@@ -215,98 +223,134 @@ def loads(tree_text, parser=None, tree_class=Tree):
     if type(parser) == int:  # parser is an integer? (old-style/shortcut)
         parser = INT_PARSERS[parser]  # substitute it for the actual parser
 
-    if tree_text[0] == '(':
-        nodes, pos = read_nodes(tree_text, parser, 0, tree_class)
-    else:
-        nodes, pos = [], 0
+    # The nodes that we create are never garbage until the tree is complete,
+    # but the garbage collector would still go through all of them many times.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if tree_text[0] == '(':
+            nodes, pos = read_nodes(tree_text, parser, 0, tree_class)
+        else:
+            nodes, pos = [], 0
 
-    content, pos = read_content(tree_text, pos)
-    if pos != len(tree_text) - 1:
-        raise NewickError(f'root node ends at position {pos}, before tree ends')
+        content, pos = read_content(tree_text, pos)
+        if pos != len(tree_text) - 1:
+            raise NewickError(f'root node ends at position {pos}, before tree ends')
 
-    props = get_props(content, not nodes, parser) if content else {}
+        props = get_props(content, not nodes, parser) if content else {}
 
-    return tree_class(props, nodes)
+        return tree_class(props, nodes)
+    finally:
+        if gc_enabled:
+            gc.enable()
 
 
-def read_nodes(nodes_text, parser, long pos=0, tree_class=Tree):
+def read_nodes(str nodes_text, parser, long pos=0, tree_class=Tree):
     """Return a list of nodes and the position in the text where they end."""
     # nodes_text looks like '(a,b,c)', where any element can be a list of nodes
+    #
+    # Instead of recursing for each nested list of nodes, we keep an explicit
+    # stack with the siblings read so far at each open "(". This way the depth
+    # of the tree is not limited by the recursion limit (or the C stack).
+    cdef long size = len(nodes_text)
+
     if nodes_text[pos] != '(':
         raise NewickError('nodes text starts with no "("')
 
-    nodes = []
-    while nodes_text[pos] != ')':
-        pos += 1
-        if pos >= len(nodes_text):
+    stack = [[]]  # stack of lists of nodes, one per "(" still open
+    while True:
+        pos += 1  # skip the "(" or "," (or ";") before the next element
+        if pos >= size:
             raise NewickError('nodes text ends missing a matching ")"')
 
         pos = skip_spaces_and_comments(nodes_text, pos)
 
         if nodes_text[pos] == '(':  # this element is a list of nodes
-            children, pos = read_nodes(nodes_text, parser, pos, tree_class)
-        else:  # this element is a leaf
-            children = []
+            stack.append([])  # its nodes will go there
+            continue
+
+        children = []  # this element is a leaf
 
-        content, pos = read_content(nodes_text, pos)
+        # Read node contents, closing all the lists of nodes that end here.
+        while True:
+            content, pos = read_content(nodes_text, pos)
 
-        nodes.append(tree_class(get_props(content, not children, parser),
-                                children))
+            stack[-1].append(tree_class(get_props(content, not children, parser),
+                                        children))
 
-    return nodes, pos+1
+            if pos >= size or nodes_text[pos] != ')':
+                break  # more elements in the current list of nodes
 
+            children = stack.pop()  # the list of nodes is complete
+            pos += 1
 
-def skip_spaces_and_comments(text, long pos):
+            if not stack:  # that was the list that we started with
+                return children, pos
+
+
+cpdef long skip_spaces_and_comments(str text, long pos) except -1:
     """Return position in text after pos and all whitespaces and comments."""
     # text = '...  [this is a comment] node1...'
     #            ^-- pos               ^-- pos (returned)
-    while pos < len(text) and text[pos] in ' \t\r\n[':
-        if text[pos] == '[':
+    cdef long start, size = len(text)
+    cdef Py_UCS4 c
+
+    while pos < size:
+        c = text[pos]
+        if c == '[':
             start = pos
-            if text[pos+1] == '&':  # special annotation
+            if pos + 1 < size and text[pos+1] == '&':  # special annotation
                 return pos
             else:
                 pos = text.find(']', pos+1)  # skip comment
                 if pos < 0:
                     raise NewickError(f'unfinished comment at position {start}')
+        elif c not in ' \t\r\n':
+            break
         pos += 1  # skip whitespace and comment endings
 
     return pos
 
 
-def read_content(str text, long pos, endings=',);'):
+def read_content(str text, long pos, str endings=',);'):
     """Return content starting at position pos in text, and where it ends."""
     # text = '...(node_1:0.5[&&NHX:p=a],...'  ->  'node_1:0.5[&&NHX:p=a]'
     #             ^-- pos              ^-- pos (returned)
-    start = pos
+    cdef long start = pos, size = len(text)
+    cdef Py_UCS4 c
 
     pos = skip_spaces_and_comments(text, pos)
 
-    if pos < len(text) and text[pos] in ["'", '"']:
-        pos = skip_quoted_name(text, pos)
+    if pos < size:
+        c = text[pos]
+        if c == "'" or c == '"':
+            pos = skip_quoted_name(text, pos)
 
-    while pos < len(text) and text[pos] not in endings:
+    while pos < size and text[pos] not in endings:
         pos += 1
 
     return text[start:pos], pos
 
 
-def skip_quoted_name(str text, long pos):
+cpdef long skip_quoted_name(str text, long pos) except -1:
     """Return the position where a quoted name ends."""
     # text = "... 'node ''2'' in tree' ..."
     #             ^-- pos             ^-- pos (returned)
-    if pos >= len(text) or text[pos] not in ["'", '"']:
+    cdef long start, size = len(text)
+    cdef Py_UCS4 q
+
+    if pos >= size or text[pos] not in "'\"":
         raise NewickError(f'text at position {pos} does not start with quote')
 
     start = pos
     q = text[start]  # quoting character (can be ' or ")
 
-    while pos+1 < len(text):
+    while pos+1 < size:
         pos += 1
 
         if text[pos] == q:
             # Newick format escapes ' as '' (and we generalize to q -> qq)
-            if pos+1 >= len(text) or text[pos+1] != q:
+            if pos+1 >= size or text[pos+1] != q:
                 return pos+1  # that was the closing quote
             else:
                 pos += 1  # that was an escaped quote - skip
@@ -314,20 +358,179 @@ def skip_quoted_name(str text, long pos):
     raise NewickError('unfinished quoted name: %s' % repr_short(text[start:]))
 
 
-def dumps(tree, props=None, parser=None, format_root_node=True, is_leaf_fn=None):
-    """Return newick representation of the given tree."""
-    node_str = ('' if tree.is_root and not format_root_node else
-                content_repr(tree, props, parser))
-
-    if tree.children and (not is_leaf_fn or not is_leaf_fn(tree)):
-        children_str = ','.join(dumps(node, props, parser,
-                                      format_root_node, is_leaf_fn).rstrip(';')
-                                for node in tree.children)
-        return f'({children_str}){node_str};'
-    else:
-        return f'{node_str};'
+# Reading many trees, one at a time.
+
+CHUNK_SIZE = 2**20  # bytes (or characters) read at a time from files
+
+
+def iter_trees(source, parser=None, skip=0, step=1, tree_class=Tree):
+    """Yield the trees from a file with one or more newicks, one at a time.
+
+    The file is read in chunks, so memory use does not grow with the
+    number of trees. Trees that are skipped are not parsed at all.
+
+    :param source: File object or file name. Its contents can be
+        compressed with gzip or bzip2.
+    :param parser: Parser used to read the newicks.
+    :param skip: Number of initial trees to skip (like a burn-in).
+    :param step: Yield only one tree of every ``step`` (thinning).
+
+    Example::
+
+      for t in newick.iter_trees('posterior.trees.gz', skip=1000, step=10):
+          print(len(t))
+    """
+    assert skip >= 0 and step >= 1, 'invalid skip or step'
+
+    if type(parser) == int:
+        parser = INT_PARSERS[parser]
+
+    for i, text in enumerate(split_newicks(read_chunks(source))):
+        if i >= skip and (i - skip) % step == 0:
+            yield loads(text.strip(), parser, tree_class)
+
+
+def split_newicks(chunks):
+    """Yield texts ending in ";" (outside quotes and comments) from chunks."""
+    # This is a simple scanner that does not parse anything. It is used both
+    # for newicks and for nexus commands (which end in ";" too).
+    cdef str chunk
+    cdef long pos, start
+    cdef Py_UCS4 c, quote = 0  # quote: quoting character if in a quoted name
+    cdef bint in_comment = False
+
+    pieces = []  # parts of the current text, that can span several chunks
+    for chunk in chunks:
+        start = 0
+        for pos in range(len(chunk)):
+            c = chunk[pos]
+            if quote:
+                if c == quote:
+                    quote = 0  # an escaped quote ('') just closes and reopens
+            elif in_comment:
+                if c == ']':
+                    in_comment = False
+            elif c == "'" or c == '"':
+                quote = c
+            elif c == '[':
+                in_comment = True
+            elif c == ';':
+                pieces.append(chunk[start:pos+1])
+                yield ''.join(pieces)
+                pieces = []
+                start = pos + 1
+        pieces.append(chunk[start:])
+
+    rest = ''.join(pieces)
+    if rest.strip():
+        yield rest  # so it gets parsed and the error is properly reported
+
+
+def read_chunks(source, chunk_size=CHUNK_SIZE):
+    """Yield pieces of text from source (file object or file name).
+
+    Files compressed with gzip or bzip2 are decompressed on the fly.
+    """
+    if isinstance(source, (str, os.PathLike)):  # file name
+        with open(source, 'rb') as fp:
+            yield from read_chunks(fp, chunk_size)
+        return
+
+    data = source.read(chunk_size)
+
+    if isinstance(data, str):  # file opened in text mode
+        while data:
+            yield data
+            data = source.read(chunk_size)
+        return
+
+    blocks = read_blocks(source, data, chunk_size)  # raw content
+
+    if data.startswith(b'\x1f\x8b'):  # gzip magic number
+        blocks = decompress(blocks, lambda: zlib.decompressobj(wbits=31))
+    elif data.startswith(b'BZh'):  # bzip2 magic number
+        blocks = decompress(blocks, bz2.BZ2Decompressor)
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for block in blocks:
+        text = decoder.decode(block)
+        if text:
+            yield text
+
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def read_blocks(fp, first, chunk_size):
+    """Yield the bytes of fp in blocks, the first one being the given one."""
+    data = first
+    while data:
+        yield data
+        data = fp.read(chunk_size)
+
+
+def decompress(blocks, new_decompressor):
+    """Yield the decompressed blocks (which can have several streams)."""
+    decompressor = new_decompressor()
+    for data in blocks:
+        while data:
+            yield decompressor.decompress(data)
+            if decompressor.eof:  # a new stream may start (as in "cat a.gz b.gz")
+                data = decompressor.unused_data
+                decompressor = new_decompressor()
+            else:
+                data = b''
 
 
-def dump(tree, fp, props=None, parser=None, format_root_node=True, is_leaf_fn=None):
-    fp.write(dumps(tree, props, parser, format_root_node, is_leaf_fn))
-    fp.write('\n')
+# Writing.
+
+def dumps(tree, props=None, parser=None, format_root_node=True, is_leaf_fn=None):
+    """Return newick representation of the given tree."""
+    return ''.join(iter_newick(tree, props, parser, format_root_node, is_leaf_fn))
+
+
+def dump(tree, fp, props=None, parser=None, format_root_node=True, is_leaf_fn=None,
+         long buffer_size=10000):
+    """Write the newick representation of the given tree to file object fp."""
+    # The text is written as it is produced, in groups of buffer_size pieces.
+    pieces = []
+    for piece in iter_newick(tree, props, parser, format_root_node, is_leaf_fn):
+        pieces.append(piece)
+        if len(pieces) >= buffer_size:
+            fp.write(''.join(pieces))
+            pieces.clear()
+
+    pieces.append('\n')
+    fp.write(''.join(pieces))
+
+
+def iter_newick(tree, props=None, parser=None, format_root_node=True,
+                is_leaf_fn=None):
+    """Yield the pieces of text that form the newick of the given tree."""
+    # It works without recursion, keeping a stack with the nodes still to
+    # write, and the text that closes the nodes that are already open.
+    #   ((a,b)c,d)e;  ->  '(', '(', 'a', ',', 'b', ')c', ',', 'd', ')e', ';'
+    def content(node):
+        return ('' if node.is_root and not format_root_node else
+                content_repr(node, props, parser))
+
+    pending = [tree]  # nodes to write, and strings to write as they are
+    while pending:
+        node = pending.pop()
+
+        if type(node) is str:
+            yield node
+        elif node.children and (not is_leaf_fn or not is_leaf_fn(node)):
+            yield '('
+
+            children = node.children
+            pending.append(')' + content(node))
+            pending.append(children[-1])
+            for i in range(len(children) - 2, -1, -1):
+                pending.append(',')
+                pending.append(children[i])
+        else:
+            yield content(node)
+
+    yield ';'
@@ -5,6 +5,7 @@ Read trees from a file in nexus format.
 # See https://en.wikipedia.org/wiki/Nexus_file
 
 import re
+import itertools
 
 from . import newick as newick_parser
 
@@ -18,6 +19,56 @@ def load(fp, parser=None):
     return loads(fp.read(), parser=parser)
 
 
+def iter_trees(source, parser=None, skip=0, step=1):
+    """Yield (name, tree) for the trees in a nexus file, one at a time.
+
+    The file is read in chunks, so memory use does not grow with the
+    number of trees. Trees that are skipped are not parsed at all.
+
+    :param source: File object or file name. Its contents can be
+        compressed with gzip or bzip2.
+    :param parser: Parser used to read the newicks.
+    :param skip: Number of initial trees to skip (like a burn-in).
+    :param step: Yield only one tree of every ``step`` (thinning).
+    """
+    assert skip >= 0 and step >= 1, 'invalid skip or step'
+
+    chunks = newick_parser.read_chunks(source)
+    commands = newick_parser.split_newicks(chunks)  # they all end in ";" too
+
+    first = next(commands, '')
+    header = re.match(r'^#NEXUS\s*\n', first, flags=re.I)
+    if not header:
+        raise NexusError('text does not start with "#NEXUS"')
+
+    in_trees = False  # are we inside the TREES section?
+    translate = None
+    ntrees = 0  # number of trees seen so far
+    for command in itertools.chain([first[header.end():]], commands):
+        words = command.strip(';\r\n\t ').split(maxsplit=1)
+        if not words:
+            continue  # empty command
+
+        name, args = words[0].upper(), (words[1] if len(words) > 1 else '')
+
+        if name == 'BEGIN':
+            in_trees = (args.strip().upper() == 'TREES')
+            translate = None
+        elif name in ['END', 'ENDBLOCK']:
+            in_trees = False
+        elif in_trees and name == 'TRANSLATE':
+            if translate is not None:
+                raise NexusError('multiple TRANSLATE commands')
+            translate = dict(pair.split(maxsplit=1) for pair in args.split(','))
+        elif in_trees and name == 'TREE':
+            if ntrees >= skip and (ntrees - skip) % step == 0:
+                tree_name, newick = read_tree_command(args)
+                tree = newick_parser.loads(newick, parser=parser)
+                translate_names(tree, translate or {})
+                yield tree_name, tree
+            ntrees += 1
+
+
 def loads(text, parser=None):
     return {name: newick_parser.loads(newick, parser=parser)
             for name, newick in get_trees(text, parser=parser).items()}
@@ -39,17 +90,24 @@ def get_trees(text, parser=None):
 
     trees = {}
     for command in commands.get('TREE', []):
-        name_ugly, newick_ugly = command.split('=', maxsplit=1)
+        name, newick = read_tree_command(command)
+        trees[name] = apply_translations(translate, newick, parser)
+
+    return trees
 
-        name = name_ugly.strip('\t\r\n "\'')
-        newick = newick_ugly.strip() + ';'
 
-        if newick.startswith('['):  # remove possible [&U] or comment
-            newick = newick[newick.find(']')+1:].strip()
+def read_tree_command(args):
+    """Return the name and newick from the arguments of a TREE command."""
+    # Like:  tree1 = [&U] ((A,B),C)  ->  'tree1', '((A,B),C);'
+    name_ugly, newick_ugly = args.split('=', maxsplit=1)
 
-        trees[name] = apply_translations(translate, newick, parser)
+    name = name_ugly.strip('\t\r\n "\'')
+    newick = newick_ugly.strip().rstrip(';') + ';'
 
-    return trees
+    if newick.startswith('['):  # remove possible [&U] or comment
+        newick = newick[newick.find(']')+1:].strip()
+
+    return name, newick
 
 
 def apply_translations(translate, newick, parser=None):
@@ -59,13 +117,18 @@ def apply_translations(translate, newick, parser=None):
 
     t = newick_parser.loads(newick, parser=parser)
 
-    for node in t:
-        if node.name in translate:
-            node.name = translate[node.name]
+    translate_names(t, translate)
 
     return newick_parser.dumps(t, parser=parser)
 
 
+def translate_names(tree, translate):
+    """Change the names of the leaves of tree according to the given dict."""
+    for node in tree:
+        if node.name in translate:
+            node.name = translate[node.name]
+
+
 def get_section(text, section_name):
     """Return commands ({name: [args]}) that correspond to the given section."""
     return get_sections(text).get(section_name.upper(), {})
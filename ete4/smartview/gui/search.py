@@ -0,0 +1,485 @@
+"""
+Searches of nodes, compiled once and with their results cached.
+
+A search is given by a text, like:
+
+  abc             nodes whose name contains "abc" (case-insensitive)
+  Abc             nodes whose name contains "Abc" (case-sensitive)
+  /r ^A.*z$       nodes whose name matches the regular expression
+  /e dist > 0.5   nodes for which the python expression is true
+  /t (a,b)c       nodes that match the topological pattern
+
+When possible, the condition is compiled into operations over columns
+with the values of all the nodes (names, dists, properties...), which
+are done at once with numpy. Otherwise (or if those operations fail,
+like when a property is missing in some node) each node is evaluated
+on its own (in parallel chunks for big trees, if asked for).
+"""
+
+import os
+import re
+import ast
+import operator
+from math import pi
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, get_all_start_methods
+
+import numpy as np
+
+from ete4 import treematcher as tm
+from ete4.parser import newick
+
+
+PARALLEL_MIN_NODES = 100_000  # evaluate in parallel trees with more nodes
+MAX_CACHED_RESULTS = 32  # searches whose results are kept (for each tree)
+
+
+class SearchError(Exception):
+    pass
+
+
+# Values (of a node) and functions that the expressions can use.
+
+NODE_VALUES = {
+    'node': lambda node: node,
+    'parent': lambda node: node.up, 'up': lambda node: node.up,
+    'name': lambda node: node.name,
+    'is_leaf': lambda node: node.is_leaf,
+    'length': lambda node: node.dist, 'dist': lambda node: node.dist,
+    'd': lambda node: node.dist,
+    'props': lambda node: node.props, 'p': lambda node: node.props,
+    'children': lambda node: node.children, 'ch': lambda node: node.children,
+    'size': lambda node: node.size,
+    'dx': lambda node: node.size[0], 'dy': lambda node: node.size[1]}
+
+FUNCTIONS = {
+    'get': dict.get,
+    'regex': re.search,
+    'startswith': str.startswith, 'endswith': str.endswith,
+    'upper': str.upper, 'lower': str.lower, 'split': str.split,
+    'any': any, 'all': all, 'len': len,
+    'sum': sum, 'abs': abs, 'float': float, 'pi': pi}
+
+
+@lru_cache(maxsize=256)
+def get_search(text):
+    """Return the Search corresponding to the given text (compiled once)."""
+    return Search(text)
+
+
+class Search:
+    """Search of nodes given by a text (see the module's description)."""
+
+    def __init__(self, text):
+        self.text = text
+        self.vector = None  # function of the columns (if it can be vectorized)
+
+        if not text.startswith('/'):
+            if text == text.lower():  # case-insensitive search
+                self.func = lambda node: text in node.props.get('name', '').lower()
+                self.vector = lambda cols: elementwise(
+                    lambda name: text in name.lower(), cols.get('name', ''))
+            else:  # case-sensitive search
+                self.func = lambda node: text in node.props.get('name', '')
+                self.vector = lambda cols: elementwise(
+                    lambda name: text in name, cols.get('name', ''))
+            return
+
+        parts = text.split(None, 1)
+        if parts[0] not in ['/r', '/e', '/t']:
+            raise SearchError('invalid command %r' % parts[0])
+        if len(parts) != 2:
+            raise SearchError('missing argument to command %r' % parts[0])
+
+        command, arg = parts
+        if command == '/r':  # regex search
+            try:
+                search = re.compile(arg).search
+            except re.error as e:
+                raise SearchError(f'invalid regular expression: {e}')
+            self.func = lambda node: search(node.props.get('name', ''))
+            self.vector = lambda cols: elementwise(search, cols.get('name', ''))
+        elif command == '/e':  # eval expression
+            self.func = get_eval_function(arg)
+            self.vector = get_vector_function(arg)
+        elif command == '/t':  # topological search
+            try:
+                pattern = tm.TreePattern(arg)
+            except newick.NewickError as e:
+                raise SearchError('invalid pattern %r: %s' % (arg, e))
+            self.func = lambda node: tm.match(pattern, node)
+
+    def mask(self, columns):
+        """Return an array saying which nodes match, or None if not possible."""
+        if self.vector is None:
+            return None
+
+        try:
+            return truth(self.vector(columns))
+        except Exception:
+            return None  # so the nodes are evaluated one by one
+
+
+def get_eval_function(expression):
+    """Return a function of a node that evaluates the given expression."""
+    try:
+        code = compile(expression, '<string>', 'eval')
+    except SyntaxError as e:
+        raise SearchError(f'compiling expression: {e}')
+
+    for name in code.co_names:
+        if name not in NODE_VALUES and name not in FUNCTIONS:
+            raise SearchError('invalid use of %r during evaluation' % name)
+
+    # Only the values and functions used in the expression go in the context.
+    getters = [(name, NODE_VALUES[name])
+               for name in code.co_names if name in NODE_VALUES]
+    functions = {name: FUNCTIONS[name]
+                 for name in code.co_names if name in FUNCTIONS}
+
+    def evaluate(node):
+        context = {name: get(node) for name, get in getters}
+        context.update(functions)
+        return eval(code, {'__builtins__': {}}, context)
+
+    return evaluate
+
+
+# Vectorized evaluation.
+#
+# The expression is turned into a function that takes the columns of values
+# of the nodes and returns an array (of python objects) with the value of
+# the expression for each node. Only simple expressions are supported
+# (comparisons, and/or/not, property access, regex...). Any error when
+# evaluating them falls back to evaluating each node with eval(), which
+# behaves exactly like python (short-circuits, exceptions, etc.).
+
+COLUMN_NAMES = {'name': 'name', 'is_leaf': 'is_leaf',
+                'dist': 'dist', 'd': 'dist', 'length': 'dist',
+                'dx': 'dx', 'dy': 'dy'}
+
+COMPARISONS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne,
+    ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.Is: operator.is_, ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b}
+
+STR_FUNCTIONS = {'lower': str.lower, 'upper': str.upper}
+
+
+class Unsupported(Exception):
+    pass
+
+
+class Constant:
+    def __init__(self, value):
+        self.value = value
+
+
+def get_vector_function(expression):
+    """Return a function of the columns that evaluates expression, or None."""
+    try:
+        return vectorize(ast.parse(expression, mode='eval').body)
+    except (Unsupported, SyntaxError, ValueError):
+        return None
+
+
+def vectorize(node):
+    """Return a function of the columns that evaluates the ast node."""
+    if isinstance(node, ast.BoolOp):
+        fs = [vectorize(v) for v in node.values]
+        combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        return lambda cols: combine.reduce([truth(f(cols)) for f in fs])
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        f = vectorize(node.operand)
+        return lambda cols: ~truth(f(cols))
+    elif isinstance(node, ast.Compare):
+        return vectorize_compare(node)
+    elif isinstance(node, ast.Name) and node.id in COLUMN_NAMES:
+        column = COLUMN_NAMES[node.id]
+        return lambda cols: cols.get(column)
+    elif isinstance(node, ast.Subscript):  # like p['x']
+        pname = get_prop_name(node.value, node.slice)
+        return lambda cols: cols.get_prop(pname)
+    elif isinstance(node, ast.Call):
+        return vectorize_call(node)
+    else:
+        raise Unsupported
+
+
+def vectorize_compare(node):
+    """Return a function of the columns that evaluates the comparison."""
+    operands = [value_or_function(x) for x in [node.left] + node.comparators]
+
+    if all(type(x) == Constant for x in operands):
+        raise Unsupported  # no node values involved (weird, but possible)
+
+    ops = [COMPARISONS[type(op)] for op in node.ops]
+
+    def compare(cols):
+        values = [x.value if type(x) == Constant else x(cols) for x in operands]
+        result = None
+        for op, a, b in zip(ops, values, values[1:]):
+            r = truth(elementwise2(op, a, b))
+            result = r if result is None else result & r
+        return result
+
+    return compare
+
+
+def vectorize_call(node):
+    """Return a function of the columns that evaluates the function call."""
+    f = node.func
+
+    if node.keywords:
+        raise Unsupported
+
+    if isinstance(f, ast.Attribute) and f.attr == 'get':  # like p.get('x')
+        pname, default = get_args(node.args, 1, 2)
+        pname = get_prop_name(f.value, pname)
+        default = get_constant(default) if default else None
+        return lambda cols: cols.get_prop(pname, default)
+    elif isinstance(f, ast.Name) and f.id == 'get':  # like get(p, 'x')
+        props, pname, default = get_args(node.args, 2, 3)
+        pname = get_prop_name(props, pname)
+        default = get_constant(default) if default else None
+        return lambda cols: cols.get_prop(pname, default)
+    elif isinstance(f, ast.Name) and f.id == 'regex':  # like regex('A.*', name)
+        pattern, value = get_args(node.args, 2, 2)
+        search = re.compile(get_constant(pattern)).search
+        g = vectorize(value)
+        return lambda cols: elementwise(search, g(cols))
+    elif isinstance(f, ast.Name) and f.id in ['startswith', 'endswith']:
+        value, arg = get_args(node.args, 2, 2)
+        method = getattr(str, f.id)
+        arg = get_constant(arg)
+        g = vectorize(value)
+        return lambda cols: elementwise(lambda x: method(x, arg), g(cols))
+    elif isinstance(f, ast.Name) and f.id in STR_FUNCTIONS:
+        value, = get_args(node.args, 1, 1)
+        method = STR_FUNCTIONS[f.id]
+        g = vectorize(value)
+        return lambda cols: elementwise(method, g(cols))
+    else:
+        raise Unsupported
+
+
+def value_or_function(node):
+    """Return a Constant if the ast node is one, or its vectorized function."""
+    try:
+        return Constant(ast.literal_eval(node))
+    except ValueError:
+        return vectorize(node)
+
+
+def get_constant(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise Unsupported
+
+
+def get_args(args, nmin, nmax):
+    """Return the list of arguments, padded with None up to nmax."""
+    if not nmin <= len(args) <= nmax:
+        raise Unsupported
+    return list(args) + [None] * (nmax - len(args))
+
+
+def get_prop_name(props, pname):
+    """Return the property name in expressions like p['x'] or props.get('x')."""
+    if not (isinstance(props, ast.Name) and props.id in ['p', 'props']):
+        raise Unsupported
+    pname = get_constant(pname)
+    if type(pname) != str:
+        raise Unsupported
+    return pname
+
+
+def elementwise(f, values):
+    """Return an array with f applied to each of the values."""
+    return np.frompyfunc(f, 1, 1)(values)
+
+
+def elementwise2(op, a, b):
+    """Return an array with op(x, y) for each x in a and y in b."""
+    if type(a) != np.ndarray:
+        return elementwise(lambda y: op(a, y), b)
+    elif type(b) != np.ndarray:
+        return elementwise(lambda x: op(x, b), a)
+    else:
+        return np.frompyfunc(op, 2, 1)(a, b)
+
+
+def truth(values):
+    """Return an array of bools with the truth value of each of the values."""
+    if type(values) != np.ndarray:
+        raise Unsupported  # we need a value per node
+    return values.astype(bool)
+
+
+MISSING = object()  # marks a missing property in a column
+
+
+class Columns:
+    """Values of all the nodes of a (sub)tree, in preorder, as arrays.
+
+    The arrays are made when they are first needed.
+    """
+
+    def __init__(self, tree):
+        self.nodes = list(tree.traverse())  # in preorder
+        self.cache = {}
+
+    def get(self, column, default=MISSING):
+        """Return the array with the given values (name, dist...) of the nodes."""
+        key = (column, default)
+        if key not in self.cache:
+            if column == 'name' and default is not MISSING:
+                values = [node.props.get('name', default) for node in self.nodes]
+            elif column in ['name', 'is_leaf', 'dist']:
+                values = [getattr(node, column) for node in self.nodes]
+            elif column == 'dx':
+                values = [node.size[0] for node in self.nodes]
+            elif column == 'dy':
+                values = [node.size[1] for node in self.nodes]
+            else:
+                raise Unsupported
+
+            self.cache[key] = to_array(values)
+
+        return self.cache[key]
+
+    def get_prop(self, pname, default=MISSING):
+        """Return the array with the values of property pname of the nodes.
+
+        If no default is given, all the nodes must have the property.
+        """
+        key = ('props', pname, default)
+        if key not in self.cache:
+            values = [node.props.get(pname, default) for node in self.nodes]
+            if default is MISSING and any(v is MISSING for v in values):
+                raise Unsupported  # as p['x'] would raise a KeyError
+
+            self.cache[key] = to_array(values)
+
+        return self.cache[key]
+
+
+def to_array(values):
+    """Return a 1-d array of python objects with the given values."""
+    array = np.empty(len(values), dtype=object)
+    array[:] = values  # (so values like tuples are not taken as dimensions)
+    return array
+
+
+# Evaluation node by node.
+
+_job = None  # (nodes, func) to evaluate in a worker process
+
+def set_job(nodes, func):
+    global _job
+    _job = (nodes, func)
+
+
+def evaluate_range(start, end):
+    """Return the positions of the nodes from start to end that match."""
+    nodes, func = _job
+    return [i for i in range(start, end) if func(nodes[i])]
+
+
+def evaluate_nodes(nodes, func, processes=1):
+    """Return the positions of the nodes for which func(node) is true.
+
+    If processes > 1 (or None, for as many as cpus), big lists of nodes
+    are evaluated in parallel chunks, in processes that get the nodes by
+    forking (if the system allows it). Forking from a program that runs
+    threads (like the server) is not safe, so it is only done if asked.
+    """
+    n = len(nodes)
+    processes = processes or os.cpu_count() or 1
+
+    if (n < PARALLEL_MIN_NODES or processes < 2 or
+        'fork' not in get_all_start_methods()):
+        return [i for i, node in enumerate(nodes) if func(node)]
+
+    chunk = -(-n // (4 * processes))  # ceil division, 4 chunks per process
+    starts = range(0, n, chunk)
+    ends = [min(start + chunk, n) for start in starts]
+
+    # With fork, the arguments of the initializer are not pickled.
+    with ProcessPoolExecutor(processes, mp_context=get_context('fork'),
+                             initializer=set_job,
+                             initargs=(nodes, func)) as pool:
+        return sum(pool.map(evaluate_range, starts, ends), [])
+
+
+class Searcher:
+    """Finds the nodes of a tree that match searches, caching the results.
+
+    The results are valid for a given state of the tree (see check()).
+    Searches that cannot be vectorized can use several processes (see
+    evaluate_nodes()).
+    """
+
+    def __init__(self, processes=1):
+        self.processes = processes
+        self.state = None  # state of the tree for the cached contents
+        self.columns = {}  # root -> Columns
+        self.results = OrderedDict()  # (root, text) -> list of nodes
+
+    def __reduce__(self):
+        return Searcher, (self.processes,)  # do not save the cached results
+
+    def check(self, state):
+        """Clear the cached contents if they were not made in the given state."""
+        if state != self.state:
+            self.columns.clear()
+            self.results.clear()
+            self.state = state
+
+    def search(self, root, text):
+        """Return the list of nodes under root (in preorder) matched by text."""
+        key = (root, text)
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+
+        search = get_search(text)
+
+        cols = self.get_columns(root)
+
+        mask = search.mask(cols)
+        if mask is not None:
+            nodes = [cols.nodes[i] for i in np.flatnonzero(mask)]
+        else:
+            nodes = [cols.nodes[i] for i in
+                     evaluate_nodes(cols.nodes, search.func, self.processes)]
+
+        self.results[key] = nodes
+        if len(self.results) > MAX_CACHED_RESULTS:
+            self.results.popitem(last=False)
+
+        return nodes
+
+    def find(self, root, text):
+        """Return the first node under root (in preorder) matched by text."""
+        key = (root, text)
+        if key in self.results:
+            return next(iter(self.results[key]), None)
+
+        search = get_search(text)
+
+        if search.vector is not None:  # it may be fast to do them all
+            return next(iter(self.search(root, text)), None)
+
+        return next((node for node in root.traverse() if search.func(node)), None)
+
+    def get_columns(self, root):
+        if root not in self.columns:
+            self.columns.clear()  # we only keep the ones of a (sub)tree
+            self.columns[root] = Columns(root)
+        return self.columns[root]
@@ -13,20 +13,21 @@ REST call examples:
 """
 
 import os
-import re
 import platform
 from subprocess import Popen, DEVNULL
-from threading import Thread
+from threading import Thread, Lock
 import socket
 from importlib import reload as module_reload
-from math import pi, inf
+from math import pi, inf, floor, ceil, log2
 from time import time, sleep
 from datetime import datetime
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from itertools import chain
 from copy import copy, deepcopy
 from dataclasses import dataclass
 import gzip, bz2, zipfile, tarfile
 import json
+import base64
 import _pickle as pickle
 import shutil
 import logging
@@ -34,7 +35,7 @@ import logging
 import brotli
 
 from bottle import (
-    get, post, put, redirect, static_file,
+    get, post, put, hook, redirect, static_file,
     BaseRequest, request, response, error, abort, HTTPError, run)
 
 BaseRequest.MEMFILE_MAX = 50 * 1024 * 1024  # maximum upload size (in bytes)
@@ -43,9 +44,33 @@ from ete4 import Tree
 from ete4.parser import newick
 from ete4.smartview import TreeStyle, layout_modules
 from ete4.parser import ete_format, nexus
-from ete4.core import operations as ops
+from ete4.core import operations as ops, flat_tree
 from ete4.smartview.renderer import drawer as drawer_module
-from ete4 import treematcher as tm
+from ete4.smartview.renderer.lod import Summaries
+from ete4.smartview.renderer.marks import MarkedNodes
+from ete4.smartview.renderer import binary
+from ete4.smartview.gui.search import Searcher, SearchError
+
+
+DRAW_CACHE_MB = 100  # maximum size of the cached drawings (of all trees)
+DRAW_CHUNK_KB = 64  # approximate size of the chunks streamed when drawing
+DRAW_FORMATS = {'json': 'application/json',  # format -> content type
+                'binary': 'application/octet-stream'}
+
+# Paths /trees/<tree_id>/<path> whose requests do not change any drawing.
+READONLY_TREE_PATHS = {
+    'nodeinfo', 'nodestyle', 'editable_props', 'name', 'newick', 'seq',
+    'nseq', 'all_selections', 'selections', 'selection', 'active',
+    'all_active', 'all_active_leaves', 'searches', 'find', 'draw', 'size',
+    'collapse_size', 'properties', 'nodecount', 'ultrametric'}
+
+# Paths that change how nodes are marked, but not the contents of the tree.
+MARKING_TREE_PATHS = {
+    'select', 'unselect', 'remove_selection', 'change_selection_name',
+    'search_to_selection', 'activate_node', 'deactivate_node',
+    'activate_clade', 'deactivate_clade', 'store_active_nodes',
+    'store_active_clades', 'remove_active_nodes', 'remove_active_clades',
+    'search', 'remove_search'}
 
 
 class GlobalStuff:
@@ -95,9 +120,124 @@ class TreeData:
     timer: float = None
     ultrametric: bool = False
     initialized: bool = False
-    selected: dict = None
+    selected: MarkedNodes = None
     active: namedtuple = None  # active nodes
-    searches: dict = None
+    searches: MarkedNodes = None
+    ids: 'NodeIds' = None  # index of node ids (use get_ids() to access it)
+    version: int = 0  # increased when the drawings of the tree may change
+    tree_version: int = 0  # increased when the contents of the tree may change
+    summaries: Summaries = None  # level-of-detail summaries for the drawers
+    searcher: Searcher = None  # cached searches (use get_searcher())
+
+
+class NodeIds:
+    """Index between the nodes of a tree and their ids (paths from the root).
+
+    The ids (like "0,1,1") are computed when needed, reusing the ones of
+    their ancestors. The index is cleared whenever the tree is edited.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.edits = None
+        self.update()
+
+    def __reduce__(self):
+        return NodeIds, (self.tree,)  # do not save the index, only the tree
+
+    def update(self):
+        """Clear the index if the tree was edited since it was filled."""
+        edits = flat_tree.get_edits(self.tree)
+        if self.edits != edits:
+            self.ids = {self.tree: ''}  # node -> id
+            self.nodes = {(): self.tree}  # path -> node
+            self.positions = {}  # node -> position in its parent's children
+            self.edits = edits
+
+    def id(self, node):
+        """Return the id of the given node (like "0,1,1")."""
+        self.update()
+
+        path = []  # nodes with no id yet, from the given one up
+        while node not in self.ids:
+            if node is None:
+                raise ValueError('node not in tree')
+            path.append(node)
+            node = node.up
+
+        node_id = self.ids[node]
+        for node in reversed(path):
+            pos = str(self.position(node))
+            node_id = self.ids[node] = f'{node_id},{pos}' if node_id else pos
+
+        return node_id
+
+    def position(self, node):
+        """Return the position of node in the list of its parent's children."""
+        if node not in self.positions:
+            for i, child in enumerate(node.up.children):  # save all siblings
+                self.positions[child] = i
+        return self.positions[node]
+
+    def node(self, path):
+        """Return the node at the given path (list of child positions)."""
+        self.update()
+
+        path = tuple(path)
+        if path not in self.nodes:
+            self.nodes[path] = self.tree[path]
+
+        return self.nodes[path]
+
+
+class DrawCache:
+    """LRU cache of the (encoded) drawings of all trees, with a memory budget.
+
+    The drawings of each tree are only valid for a given state of it
+    (see check()).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (tid, key) -> (data, aligned_grid_dxs)
+        self.nbytes = 0  # total size of the cached data
+        self.states = {}  # tid -> state of the tree when drawn
+        self.lock = Lock()  # the requests may come from different threads
+
+    def check(self, tid, state):
+        """Remove the drawings of tree tid if they were not made in state."""
+        if self.states.get(tid) != state:
+            self.forget(tid)
+            self.states[tid] = state
+
+    def forget(self, tid):
+        """Remove all the drawings of tree tid."""
+        with self.lock:
+            for tkey in [tkey for tkey in self.entries if tkey[0] == tid]:
+                data, _ = self.entries.pop(tkey)
+                self.nbytes -= len(data)
+            self.states.pop(tid, None)
+
+    def get(self, tid, key):
+        """Return the entry (data, aligned_grid_dxs) for key, or None."""
+        with self.lock:
+            entry = self.entries.get((tid, key))
+            if entry is not None:
+                self.entries.move_to_end((tid, key))  # mark as recently used
+            return entry
+
+    def put(self, tid, key, data, aligned_grid_dxs):
+        """Save the drawing data (and resulting grid), evicting old ones."""
+        with self.lock:
+            if len(data) > self.max_bytes or (tid, key) in self.entries:
+                return
+
+            self.entries[(tid, key)] = (data, aligned_grid_dxs)
+            self.nbytes += len(data)
+
+            while self.nbytes > self.max_bytes:  # evict the least recent
+                data_old, _ = self.entries.popitem(last=False)[1]
+                self.nbytes -= len(data_old)
 
 
 # Routes.
@@ -233,7 +373,7 @@ def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
 
     props = set()
-    for node in tree_data.tree[subtree].traverse():
+    for node in get_ids(tree_data).node(subtree).traverse():
         props |= {k for k in node.props if not k.startswith('_')}
 
     return {'name': tree_data.name, 'props': list(props)}
@@ -241,19 +381,19 @@ def callback(tree_id):
 @get('/trees/<tree_id>/nodeinfo')
 def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
-    return tree_data.tree[subtree].props
+    return get_ids(tree_data).node(subtree).props
 
 @get('/trees/<tree_id>/nodestyle')
 def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
     response.content_type = 'application/json'
-    return json.dumps(tree_data.tree[subtree].sm_style)
+    return json.dumps(get_ids(tree_data).node(subtree).sm_style)
 
 @get('/trees/<tree_id>/editable_props')
 def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
 
-    return {k: v for k, v in tree_data.tree[subtree].props.items()
+    return {k: v for k, v in get_ids(tree_data).node(subtree).props.items()
             if k not in ['tooltip', 'hyperlink'] and type(v) in [int, float, str]}
     # TODO: Document what the hell is going on here.
 
@@ -274,18 +414,18 @@ def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
 
     def fasta(node):
-        name = node.name if node.name else ','.join(map(str, node.id))
+        name = node.name or get_ids(tree_data).id(node)
         return '>' + name + '\n' + node.props['seq']
 
     response.content_type = 'application/json'
-    return json.dumps('\n'.join(fasta(leaf) for leaf in tree_data.tree[subtree].leaves()
+    return json.dumps('\n'.join(fasta(leaf) for leaf in get_ids(tree_data).node(subtree).leaves()
                       if leaf.props.get('seq')))
 
 @get('/trees/<tree_id>/nseq')
 def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
     response.content_type = 'application/json'
-    return json.dumps(sum(1 for leaf in tree_data.tree[subtree].leaves() if leaf.props.get('seq')))
+    return json.dumps(sum(1 for leaf in get_ids(tree_data).node(subtree).leaves() if leaf.props.get('seq')))
 
 @get('/trees/<tree_id>/all_selections')
 def callback(tree_id):
@@ -335,7 +475,7 @@ def callback(tree_id):
 @get('/trees/<tree_id>/active')
 def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
-    node = tree_data.tree[subtree]
+    node = get_ids(tree_data).node(subtree)
 
     response.content_type = 'application/json'
     if get_active_clade(node, tree_data.active.clades.results):
@@ -393,8 +533,8 @@ def callback(tree_id):
 def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
     return {
-        'nodes': get_nodes_info(tree_data.active.nodes.results, ['*']),
-        'clades': get_nodes_info(tree_data.active.clades.results, ['*']),
+        'nodes': get_nodes_info(tree_data, tree_data.active.nodes.results, ['*']),
+        'clades': get_nodes_info(tree_data, tree_data.active.clades.results, ['*']),
     }
 
 @get('/trees/<tree_id>/all_active_leaves')
@@ -405,7 +545,7 @@ def callback(tree_id):
     for n in tree_data.active.clades.results:
         active_leaves.update(set(n.leaves()))
 
-    return get_nodes_info(active_leaves, ['*'])
+    return get_nodes_info(tree_data, active_leaves, ['*'])
 
 # Searches
 @get('/trees/<tree_id>/searches')
@@ -428,30 +568,31 @@ def callback(tree_id):
 @get('/trees/<tree_id>/find')
 def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
-    node = find_node(tree_data.tree, request.query)
-    node_id = ','.join(map(str, node.id))
-    return {'id': node_id}
+    node = find_node(tree_data, request.query)
+    return {'id': get_ids(tree_data).id(node)}
 
 @get('/trees/<tree_id>/draw')
 def callback(tree_id):
     try:
-        drawer = get_drawer(tree_id, request.query)
+        args = dict(request.query)
+        fmt = args.pop('format', 'json')  # json or binary (see binary.pyx)
+        assert fmt in DRAW_FORMATS, f'invalid format: {fmt}'
 
-        graphics = json.dumps(list(drawer.draw())).encode('utf8')
+        # Start drawing here, so errors are not only found once streaming.
+        chunks = iter(get_drawing(tree_id, args, fmt))
+        first = next(chunks, b'')
 
-        response.content_type = 'application/json'
+        response.content_type = DRAW_FORMATS[fmt]
         if app.compress:
             response.add_header('Content-Encoding', 'br')
-            return brotli.compress(graphics)
-        else:
-            return graphics
+        return chain([first], chunks)
     except (AssertionError, SyntaxError) as e:
         abort(400, f'when drawing: {e}')
 
 @get('/trees/<tree_id>/size')
 def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
-    width, height = tree_data.tree[subtree].size
+    width, height = get_ids(tree_data).node(subtree).size
     return {'width': width, 'height': height}
 
 @get('/trees/<tree_id>/collapse_size')
@@ -465,7 +606,7 @@ def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
 
     props = set()
-    for node in tree_data.tree[subtree].traverse():
+    for node in get_ids(tree_data).node(subtree).traverse():
         props |= node.props.keys()
 
     response.content_type = 'application/json'
@@ -480,7 +621,7 @@ def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
 
     tnodes = tleaves = 0
-    for node in tree_data.tree[subtree].traverse():
+    for node in get_ids(tree_data).node(subtree).traverse():
         tnodes += 1
         if node.is_leaf:
             tleaves += 1
@@ -513,8 +654,7 @@ def callback(tree_id):
         abort(400, 'operation not allowed with subtree')
 
     node_id = req_json()
-    tree_data.tree.set_outgroup(tree_data.tree[node_id])
-    ops.update_sizes_all(tree_data.tree)
+    tree_data.tree.set_outgroup(tree_data.tree[node_id])  # updates sizes
     return {'message': 'ok'}
 
 @put('/trees/<tree_id>/move')
@@ -523,7 +663,7 @@ def callback(tree_id):
 
     try:
         node_id, shift = req_json()
-        ops.move(tree_data.tree[subtree][node_id], shift)
+        ops.move(get_ids(tree_data).node(subtree)[node_id], shift)
         return {'message': 'ok'}
     except AssertionError as e:
         abort(400, f'cannot move {node_id}: {e}')
@@ -534,8 +674,7 @@ def callback(tree_id):
 
     try:
         node_id = req_json()
-        ops.remove(tree_data.tree[subtree][node_id])
-        ops.update_sizes_all(tree_data.tree)
+        ops.remove(get_ids(tree_data).node(subtree)[node_id])  # updates sizes
         return {'message': 'ok'}
     except AssertionError as e:
         abort(400, f'cannot remove {node_id}: {e}')
@@ -545,7 +684,7 @@ def callback(tree_id):
     try:
         tree_data, subtree = touch_and_get(tree_id)
         node_id, name = req_json()
-        tree_data.tree[subtree][node_id].name = name
+        get_ids(tree_data).node(subtree)[node_id].name = name
         return {'message': 'ok'}
     except AssertionError as e:
         abort(400, f'cannot rename {node_id}: {e}')
@@ -555,9 +694,13 @@ def callback(tree_id):
     try:
         tree_data, subtree = touch_and_get(tree_id)
         node_id, content = req_json()
-        node = tree_data.tree[subtree][node_id]
-        node.props = newick.get_props(content, is_leaf=True)
-        ops.update_sizes_all(tree_data.tree)
+        node = get_ids(tree_data).node(subtree)[node_id]
+        props = newick.get_props(content, is_leaf=True)
+        for pname in set(node.props) - set(props):
+            node.del_prop(pname)  # going through the node keeps indexes updated
+        node.add_props(**props)
+        flat_tree.mark_edit(node)  # so summaries and indices are outdated
+        ops.update_sizes_from(node)  # its dist may have changed
         return {'message': 'ok'}
     except (AssertionError, newick.NewickError) as e:
         abort(400, f'cannot edit {node_id}: {e}')
@@ -566,7 +709,7 @@ def callback(tree_id):
 def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
     node_id = req_json()
-    ops.to_dendrogram(tree_data.tree[subtree][node_id])
+    ops.to_dendrogram(get_ids(tree_data).node(subtree)[node_id])
     ops.update_sizes_all(tree_data.tree)
     return {'message': 'ok'}
 
@@ -576,7 +719,7 @@ def callback(tree_id):
 
     try:
         node_id = req_json()
-        ops.to_ultrametric(tree_data.tree[subtree][node_id])
+        ops.to_ultrametric(get_ids(tree_data).node(subtree)[node_id])
         ops.update_sizes_all(tree_data.tree)
         return {'message': 'ok'}
     except AssertionError as e:
@@ -587,7 +730,7 @@ def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
 
     try:
-        node = tree_data.tree[subtree]
+        node = get_ids(tree_data).node(subtree)
         update_node_props(node, req_json())
         return {'message': 'ok'}
     except AssertionError as e:
@@ -598,9 +741,10 @@ def callback(tree_id):
     tree_data, subtree = touch_and_get(tree_id)
 
     try:
-        node = tree_data.tree[subtree]
+        node = get_ids(tree_data).node(subtree)
         update_node_style(node, req_json().copy())
         tree_data.nodestyles[node] = req_json().copy()
+        tree_data.summaries = None  # they depend on the nodes' styles
         return {'message': 'ok'}
     except AssertionError as e:
         abort(400, f'cannot update style of {node_id}: {e}')
@@ -629,6 +773,9 @@ def callback(tree_id):
 # Auxiliary functions.
 
 def initialize_tree_style(tree_data):
+    tree_data.version += 1  # drawings will change with the new style
+    tree_data.summaries = Summaries()  # (they depend on the nodes' styles)
+
     # Save aligned_grid_dxs to add them later.
     aligned_grid_dxs = deepcopy(tree_data.style.aligned_grid_dxs)
 
@@ -657,7 +804,7 @@ def load_tree(tree_id):
             if not tree_data.initialized:
                 initialize_tree_style(tree_data)
 
-                for node in tree_data.tree[subtree].traverse():
+                for node in get_ids(tree_data).node(subtree).traverse():
                     node.is_initialized = False
                     node._smfaces = None
                     node._collapsed_faces = None
@@ -666,7 +813,7 @@ def load_tree(tree_id):
                 for node, args in tree_data.nodestyles.items():
                     update_node_style(node, args.copy())
 
-            return tree_data.tree[subtree]
+            return get_ids(tree_data).node(subtree)
         else:
             tree_data = app.trees[tid] = retrieve_tree_data(tid)
 
@@ -676,7 +823,7 @@ def load_tree(tree_id):
 
             initialize_tree_style(tree_data)
 
-            return tree_data.tree[subtree]
+            return get_ids(tree_data).node(subtree)
 
     except (AssertionError, IndexError):
         abort(404, f'unknown tree id {tree_id}')
@@ -768,6 +915,9 @@ def get_drawer(tree_id, args):
 
         panel = get('panel', 0)
 
+        if viewport and panel in [0, 1]:  # tree and aligned panels
+            viewport = snap_to_tiles(viewport)  # so we can reuse drawings
+
         zoom = (get('zx', 1), get('zy', 1), get('za', 1))
         assert zoom[0] > 0 and zoom[1] > 0 and zoom[2] > 0, 'zoom must be > 0'
 
@@ -816,7 +966,8 @@ def get_drawer(tree_id, args):
         return drawer_class(
             load_tree(tree_id), viewport, panel, zoom,
             limits, collapsed_ids, active, selected, searches,
-            layouts, tree_data.style, tree_data.include_props, tree_data.exclude_props)
+            layouts, tree_data.style, tree_data.include_props, tree_data.exclude_props,
+            get_summaries(tree_data))
     # bypass errors for now...
     except StopIteration as error:
         abort(400, f'not a valid drawer: {drawer_name}')
@@ -824,16 +975,139 @@ def get_drawer(tree_id, args):
         abort(400, str(e))
 
 
-def get_newick(tree_id, max_mb):
-    "Return the newick representation of the given tree"
+def snap_to_tiles(viewport):
+    """Return the viewport enlarged to the borders of a grid of tiles.
 
-    nw = load_tree(tree_id).write()
+    The sides of the tiles are powers of 2, between 1/4 and 1/2 of the
+    sides of the viewport. Nearby viewports (as when panning) share
+    the same enlarged one, which is at most twice as wide and high.
+    """
+    x, y, w, h = viewport
+    tw, th = 2**floor(log2(w / 2)), 2**floor(log2(h / 2))  # tile sizes
+    x0, y0 = floor(x / tw) * tw, floor(y / th) * th
+    x1, y1 = ceil((x + w) / tw) * tw, ceil((y + h) / th) * th
+    return [x0, y0, x1 - x0, y1 - y0]
 
-    size_mb = len(nw) / 1e6
-    if size_mb > max_mb:
-        abort(400, 'newick too big (%.3g MB)' % size_mb)
 
-    return nw
+def get_drawing(tree_id, args, fmt='json'):
+    """Return the encoded graphics of the drawing specified in the args.
+
+    The result is an iterable with the (maybe compressed) chunks of the
+    graphics in the given format (json or binary), which are sent as the
+    drawer produces them. The drawings are cached (in app.drawings, shared
+    by all trees) while nothing that affects them changes, so the same
+    graphics are not computed twice.
+    """
+    drawer = get_drawer(tree_id, args)
+
+    tid = get_tid(tree_id)[0]
+    tree_data = app.trees[tid]
+    style = tree_data.style
+
+    cache = app.drawings
+    cache.check(tid, (tree_data.version,
+                      flat_tree.get_edits(tree_data.tree, props=True)))
+
+    key = (tree_id, type(drawer).__name__, drawer.COLLAPSE_SIZE,
+           tuple(drawer.viewport) if drawer.viewport else None,
+           drawer.panel, drawer.zoom,
+           (drawer.xmin, drawer.xmax, drawer.ymin, drawer.ymax),
+           frozenset(drawer.collapsed_ids), frozenset(map(id, drawer.layouts)),
+           app.compress, fmt,
+           # Drawings in panels other than 0 depend on the aligned grid.
+           tuple(sorted(style.aligned_grid_dxs.items()))
+               if drawer.panel != 0 else None)
+
+    entry = cache.get(tid, key)
+    if entry is not None:
+        data, grid = entry
+        style.aligned_grid_dxs = defaultdict(lambda: 0, grid)  # as if drawn
+        return [data]
+
+    return stream_drawing(drawer, fmt, cache, tid, key)
+
+
+def stream_drawing(drawer, fmt, cache, tid, key):
+    """Yield the chunks of the drawing and save it in the cache at the end."""
+    chunk_size = DRAW_CHUNK_KB * 1024
+
+    if fmt == 'binary':
+        tolerance = 0.01 / max(drawer.zoom)  # in tree units (0.01 pixels)
+        chunks = binary.stream(drawer.draw(), tolerance, chunk_size)
+    else:
+        chunks = json_stream(drawer.draw(), chunk_size)
+
+    compressor = brotli.Compressor() if app.compress else None
+
+    data = []  # all the chunks sent
+    for chunk in chunks:
+        if compressor:  # (flushing, or it would keep it all until the end)
+            chunk = compressor.process(chunk) + compressor.flush()
+        if chunk:
+            data.append(chunk)
+            yield chunk
+
+    if compressor:
+        data.append(compressor.finish())
+        yield data[-1]
+
+    cache.put(tid, key, b''.join(data), dict(drawer.tree_style.aligned_grid_dxs))
+
+
+def json_stream(elements, chunk_size):
+    """Yield the json of the list of elements, in chunks of about chunk_size."""
+    # The result is the same as json.dumps(list(elements)).encode('utf8').
+    out = ['[']
+    size = 1
+    for i, element in enumerate(elements):
+        text = json.dumps(element) if i == 0 else ', ' + json.dumps(element)
+        out.append(text)
+        size += len(text)
+        if size >= chunk_size:
+            yield ''.join(out).encode('utf8')
+            out, size = [], 0
+    out.append(']')
+    yield ''.join(out).encode('utf8')
+
+
+@hook('after_request')
+def update_tree_versions():
+    """Increase the version of the trees whose drawings the request may change.
+
+    The tree_version is increased too if the contents may change.
+    """
+    if not app:
+        return
+
+    parts = request.path.split('/')  # like ['', 'trees', '3,0,1', 'draw']
+    if request.path == '/layouts/update':
+        for tree_data in app.trees.values():
+            tree_data.version += 1
+    elif (len(parts) > 3 and parts[1] == 'trees' and
+          parts[3] not in READONLY_TREE_PATHS):
+        try:
+            tree_data = app.trees.get(int(parts[2].split(',')[0]))
+            if tree_data:
+                tree_data.version += 1
+                if parts[3] not in MARKING_TREE_PATHS:
+                    tree_data.tree_version += 1
+        except ValueError:
+            pass  # not a valid tree id (and nothing changed)
+
+
+def get_newick(tree_id, max_mb):
+    "Return the newick representation of the given tree"
+    # Same as tree.write(), but we stop as soon as it gets too big.
+    pieces = []
+    size = 0
+    for piece in newick.iter_newick(load_tree(tree_id), props=(),
+                                    format_root_node=False):
+        size += len(piece)
+        if size > max_mb * 1e6:
+            abort(400, 'newick too big (more than %.3g MB)' % max_mb)
+        pieces.append(piece)
+
+    return ''.join(pieces)
 
 
 def remove_search(tid, args):
@@ -852,34 +1126,37 @@ def store_search(tree_id, args):
         abort(400, 'missing search text')
 
     text = args.pop('text').strip()
-    func = get_search_function(text)
+
+    tid, subtree = get_tid(tree_id)
+    tree_data = app.trees[tid]
 
     try:
-        results = set(node for node in load_tree(tree_id).traverse() if func(node))
+        results = set(get_searcher(tree_data).search(load_tree(tree_id), text))
 
         if len(results) == 0:
             return 0, 0
 
         parents = get_parents(results)
 
-        tid, _ = get_tid(tree_id)
-        app.trees[tid].searches[text] = (results, parents)
+        tree_data.searches[text] = (results, parents)
 
         return len(results), len(parents)
+    except SearchError as e:
+        abort(400, str(e))
     except Exception as e:
         abort(400, f'evaluating expression: {e}')
 
 
-def find_node(tree, args):
+def find_node(tree_data, args):
     if 'text' not in args:
         abort(400, 'missing search text')
 
     text = args.pop('text').strip()
-    func = get_search_function(text)
 
     try:
-        return next((node for node in tree.traverse() if func(node)), None)
-
+        return get_searcher(tree_data).find(tree_data.tree, text)
+    except SearchError as e:
+        abort(400, str(e))
     except Exception as e:
         abort(400, f'evaluating expression: {e}')
 
@@ -887,7 +1164,7 @@ def find_node(tree, args):
 def get_selections(tree_id):
     tid, subtree = get_tid(tree_id)
     tree_data = app.trees[tid]
-    node = tree_data.tree[subtree]
+    node = get_ids(tree_data).node(subtree)
     return [name for name, (results, _) in tree_data.selected.items() if node in results]
 
 
@@ -925,12 +1202,12 @@ def update_node_style(node, args):
             node.sm_style[key] = value
 
 
-def get_nodes_info(nodes, props):
+def get_nodes_info(tree_data, nodes, props):
     no_props = len(props) == 1 and props[0] == ''
 
     if 'id' in props or no_props or '*' in props:
-        node_ids = [ ",".join(map(str, node.id))
-                for node in nodes ]
+        ids = get_ids(tree_data)
+        node_ids = [ids.id(node) for node in nodes]
     if no_props:
         return node_ids
 
@@ -956,7 +1233,7 @@ def get_selection_info(tree_data, args):
     nodes = tree_data.selected.get(name, [[]])[0]
 
     props = args.pop('props', '').strip().split(',')
-    return get_nodes_info(nodes, props)
+    return get_nodes_info(tree_data, nodes, props)
 
 
 def remove_selection(tid, args):
@@ -985,7 +1262,7 @@ def change_selection_name(tid, args):
 def unselect_node(tree_id, args):
     tid, subtree = get_tid(tree_id)
     tree_data = app.trees[tid]
-    node = tree_data.tree[subtree]
+    node = get_ids(tree_data).node(subtree)
     name = args.pop('text', '').strip()
 
     if name in tree_data.selected.keys():
@@ -995,13 +1272,14 @@ def unselect_node(tree_id, args):
 
     removed = False
     for name, (results, parents) in selections.items():
-        nresults = len(results)
-        results.discard(node)
+        if node not in results:
+            continue
+
+        removed = True
+        results = results - {node}  # a new set (to unindex the old one)
         if len(results) == 0:
-            removed = True
             tree_data.selected.pop(name)
-        elif nresults > len(results):
-            removed = True
+        else:
             parents = get_parents(results)
             tree_data.selected[name] = (results, parents)
 
@@ -1040,9 +1318,7 @@ def prune_by_selection(tid, args):
     if len(selected) == 0:
         abort(400, 'selection does not exist')
 
-    tree_data.tree.prune(selected)
-
-    ops.update_sizes_all(tree_data.tree)
+    tree_data.tree.prune(selected)  # updates sizes
 
     tree_data.initialized = False
 
@@ -1050,7 +1326,8 @@ def prune_by_selection(tid, args):
 def update_selection(tree_data, name, results, parents):
     if name in tree_data.selected.keys():
         all_results, all_parents = tree_data.selected[name]
-        all_results.update(results)
+        all_results = all_results | results  # new sets (to unindex the old)
+        all_parents = all_parents.copy()
         for p, v in parents.items():  # update parents defaultdict
             all_parents[p] += v
         tree_data.selected[name] = (all_results, all_parents)
@@ -1083,7 +1360,7 @@ def store_selection(tree_id, args):
 
     tid, subtree = get_tid(tree_id)
     tree_data = app.trees[tid]
-    node = tree_data.tree[subtree]
+    node = get_ids(tree_data).node(subtree)
 
     parents = get_parents([node])
 
@@ -1094,7 +1371,7 @@ def store_selection(tree_id, args):
 def activate_node(tree_id):
     tid, subtree = get_tid(tree_id)
     tree_data = app.trees[int(tid)]
-    node = tree_data.tree[subtree]
+    node = get_ids(tree_data).node(subtree)
     tree_data.active.nodes.results.add(node)
     tree_data.active.nodes.parents.clear()
     tree_data.active.nodes.parents.update(get_parents(tree_data.active.nodes.results))
@@ -1103,7 +1380,7 @@ def activate_node(tree_id):
 def deactivate_node(tree_id):
     tid, subtree = get_tid(tree_id)
     tree_data = app.trees[tid]
-    node = tree_data.tree[subtree]
+    node = get_ids(tree_data).node(subtree)
     tree_data.active.nodes.results.discard(node)
     tree_data.active.nodes.parents.clear()
     tree_data.active.nodes.parents.update(get_parents(tree_data.active.nodes.results))
@@ -1146,7 +1423,7 @@ def get_active_clades(results, parents):
 def activate_clade(tree_id):
     tid, subtree = get_tid(tree_id)
     tree_data = app.trees[int(tid)]
-    node = tree_data.tree[subtree]
+    node = get_ids(tree_data).node(subtree)
     tree_data.active.clades.results.add(node)
     for n in node.descendants():
         tree_data.active.clades.results.discard(n)
@@ -1178,7 +1455,7 @@ def remove_active_clade(node, active):
 def deactivate_clade(tree_id):
     tid, subtree = get_tid(tree_id)
     tree_data = app.trees[int(tid)]
-    node = tree_data.tree[subtree]
+    node = get_ids(tree_data).node(subtree)
     remove_active_clade(node, tree_data.active.clades.results)
     tree_data.active.clades.parents.clear()
     tree_data.active.clades.parents.update(get_parents(tree_data.active.clades.results))
@@ -1205,57 +1482,6 @@ def remove_active(tree_data, idx):
     tree_data.active[idx].results.clear()
 
 
-def get_search_function(text):
-    "Return a function of a node that returns True for the searched nodes"
-    if text.startswith('/'):
-        return get_command_search(text)  # command-based search
-    elif text == text.lower():  # case-insensitive search
-        return lambda node: text in node.props.get('name', '').lower()
-    else:  # case-sensitive search
-        return lambda node: text in node.props.get('name', '')
-
-
-def get_command_search(text):
-    "Return the appropriate node search function according to the command"
-    parts = text.split(None, 1)
-    if parts[0] not in ['/r', '/e', '/t']:
-        abort(400, 'invalid command %r' % parts[0])
-    if len(parts) != 2:
-        abort(400, 'missing argument to command %r' % parts[0])
-
-    command, arg = parts
-    if command == '/r':  # regex search
-        return lambda node: re.search(arg, node.props.get('name', ''))
-    elif command == '/e':  # eval expression
-        return get_eval_search(arg)
-    elif command == '/t':  # topological search
-        return get_topological_search(arg)
-    else:
-        abort(400, 'invalid command %r' % command)
-
-
-def get_eval_search(expression):
-    "Return a function of a node that evaluates the given expression"
-    try:
-        code = compile(expression, '<string>', 'eval')
-    except SyntaxError as e:
-        abort(400, f'compiling expression: {e}')
-
-    return lambda node: safer_eval(code, {
-        'node': node, 'parent': node.up, 'up': node.up,
-        'name': node.name, 'is_leaf': node.is_leaf,
-        'length': node.dist, 'dist': node.dist, 'd': node.dist,
-        'props': node.props, 'p': node.props,
-        'get': dict.get,
-        'children': node.children, 'ch': node.children,
-        'size': node.size, 'dx': node.size[0], 'dy': node.size[1],
-        'regex': re.search,
-        'startswith': str.startswith, 'endswith': str.endswith,
-        'upper': str.upper, 'lower': str.lower, 'split': str.split,
-        'any': any, 'all': all, 'len': len,
-        'sum': sum, 'abs': abs, 'float': float, 'pi': pi})
-
-
 def safer_eval(code, context):
     "Return a safer version of eval(code, context)"
     for name in code.co_names:
@@ -1264,16 +1490,6 @@ def safer_eval(code, context):
     return eval(code, {'__builtins__': {}}, context)
 
 
-def get_topological_search(pattern):
-    "Return a function of a node that sees if it matches the given pattern"
-    try:
-        tree_pattern = tm.TreePattern(pattern)
-    except newick.NewickError as e:
-        abort(400, 'invalid pattern %r: %s' % (pattern, e))
-
-    return lambda node: tm.match(tree_pattern, node)
-
-
 def get_stats(tree_id, pname):
     "Return some statistics about the given property pname"
     pmin, pmax = inf, -inf
@@ -1424,7 +1640,7 @@ def add_tree(data):
     if nw is not None:
         tree = load_tree_from_newick(tid, nw)
     elif bpickle is not None:
-        tree = ete_format.loads(bpickle, unpack=True)
+        tree = ete_format.loads(base64.b64decode(bpickle))
         ops.update_sizes_all(tree)
     else:
         tree = data.get('tree')
@@ -1443,8 +1659,8 @@ def add_tree(data):
     tree_data.exclude_props = exclude_props
     tree_data.layouts = retrieve_layouts(layouts)
     tree_data.timer = time()
-    tree_data.searches = {}
-    tree_data.selected = {}
+    tree_data.searches = MarkedNodes()
+    tree_data.selected = MarkedNodes()
     tree_data.active = drawer_module.get_empty_active()
     tree_data.tree = tree
 
@@ -1536,6 +1752,29 @@ def update_layouts(active_layouts, tid):
                 tree_data.initialized = False
 
 
+def get_ids(tree_data):
+    """Return the index of node ids of the tree (creating it if needed)."""
+    if tree_data.ids is None or tree_data.ids.tree is not tree_data.tree:
+        tree_data.ids = NodeIds(tree_data.tree)
+    return tree_data.ids
+
+
+def get_summaries(tree_data):
+    """Return the level-of-detail summaries of the tree (creating them if needed)."""
+    if tree_data.summaries is None:
+        tree_data.summaries = Summaries()
+    return tree_data.summaries
+
+
+def get_searcher(tree_data):
+    """Return the searcher of the tree, with its results valid for the tree now."""
+    if tree_data.searcher is None:
+        tree_data.searcher = Searcher()
+    tree_data.searcher.check((tree_data.tree_version,
+                              flat_tree.get_edits(tree_data.tree, props=True)))
+    return tree_data.searcher
+
+
 def get_tid(tree_id):
     """Return the tree id and the subtree id, with the appropriate types."""
     # Example: '3342,1,0,1,1' -> (3342, [1, 0, 1, 1])
@@ -1590,6 +1829,9 @@ def initialize(tree=None, layouts=None,
     # Dict containing TreeData dataclasses with tree info
     app.trees = {}
 
+    # Cached drawings of all the trees
+    app.drawings = DrawCache(DRAW_CACHE_MB * 1024 * 1024)
+
     thread_maintenance = Thread(daemon=True, target=maintenance, args=(app,))
     thread_maintenance.start()
     g_threads['maintenance'] = thread_maintenance
@@ -1629,7 +1871,10 @@ def run_smartview(tree=None, name=None, layouts=[],
     # TODO: Create app.recent_trees with paths to recently viewed trees
 
     if tree:
-        ops.update_sizes_all(tree)
+        if isinstance(tree, ete_format.MappedTree):
+            tree.update_sizes()  # without creating all the nodes
+        else:
+            ops.update_sizes_all(tree)
 
         tree_data = {
             'id': 0,  # id to be replaced by actual hash
@@ -1,7 +1,9 @@
 // Functions related to the interaction with the server, including html cleanup
 // and error handling.
 
-export { escape_html, hash, api, api_post, api_put };
+import { Decoder } from "./binary.js";
+
+export { escape_html, hash, api, api_graphics, api_post, api_put };
 
 
 // API calls.
@@ -15,6 +17,24 @@ async function api(endpoint, path="") {
     return await response.json();
 }
 
+// Make a GET api call for graphics and return them. They come in binary
+// format (see binary.js), and are decoded as they arrive.
+async function api_graphics(endpoint, path="") {
+    const sep = endpoint.includes("?") ? "&" : "?";
+    const response = await fetch(path + endpoint + sep + "format=binary");
+
+    await assert(response.status === 200, "Request failed :(", response);
+
+    const decoder = new Decoder();
+    const reader = response.body.getReader();
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done)
+            return decoder.finish();
+        decoder.push(value);
+    }
+}
+
 // Make a POST api call using the stored authentication.
 async function api_post(endpoint, data, path="") {
     const response = await fetch(path + endpoint, {
@@ -0,0 +1,163 @@
+// Decoder of the binary format of the graphics that the server sends when
+// drawing. The format is described in ete4/smartview/renderer/binary.pyx
+
+export { Decoder };
+
+
+const MAGIC = [69, 84, 69, 71, 1];  // "ETEG" and the version (1)
+
+// Tags of the encoded values.
+const [NONE, FALSE, TRUE, INT8, INT32, FLOAT32, FLOAT64,
+       STRING, STRING_REF, LIST, DICT] = [...Array(11).keys()];
+
+const INCOMPLETE = {};  // thrown when a value continues in the next bytes
+
+
+// Decoder of graphic elements that may come in several pieces. Example:
+//   const decoder = new Decoder();
+//   decoder.push(bytes1);  // decodes the elements that are complete
+//   decoder.push(bytes2);  // continues from where it was left
+//   const elements = decoder.finish();
+class Decoder {
+    constructor() {
+        this.elements = [];  // decoded graphic elements
+        this.strings = [];  // table of strings received (for references)
+        this.bytes = new Uint8Array(0);  // bytes not yet decoded
+        this.header_read = false;
+        this.text_decoder = new TextDecoder();
+    }
+
+    // Decode all the complete elements in the given bytes (and previous ones).
+    push(bytes) {
+        this.bytes = concat(this.bytes, bytes);
+        this.view = new DataView(this.bytes.buffer, this.bytes.byteOffset,
+                                 this.bytes.byteLength);
+        this.pos = 0;
+
+        if (!this.header_read) {
+            if (this.bytes.length < MAGIC.length)
+                return;  // wait for more
+
+            if (!MAGIC.every((b, i) => this.bytes[i] === b))
+                throw new Error("Unknown format of graphics");
+
+            this.pos = MAGIC.length;
+            this.header_read = true;
+        }
+
+        let decoded = this.pos;  // position up to which we decoded elements
+        let nstrings = this.strings.length;  // strings in decoded elements
+        try {
+            while (this.pos < this.bytes.length) {
+                this.elements.push(this.unpack());
+                decoded = this.pos;
+                nstrings = this.strings.length;
+            }
+        }
+        catch (ex) {
+            if (ex !== INCOMPLETE)
+                throw ex;
+
+            this.strings.length = nstrings;  // forget partial strings
+        }
+
+        this.bytes = this.bytes.slice(decoded);  // keep the undecoded part
+    }
+
+    // Return all the decoded elements.
+    finish() {
+        if (!this.header_read || this.bytes.length > 0)
+            throw new Error("Incomplete graphics received");
+
+        return this.elements;
+    }
+
+    // Return the next value in the bytes.
+    unpack() {
+        const tag = this.read_byte();
+
+        switch (tag) {
+        case NONE:
+            return null;
+        case FALSE:
+            return false;
+        case TRUE:
+            return true;
+        case INT8:
+            return this.read_number("getInt8", 1);
+        case INT32:
+            return this.read_number("getInt32", 4);
+        case FLOAT32:
+            return this.read_number("getFloat32", 4);
+        case FLOAT64:
+            return this.read_number("getFloat64", 8);
+        case STRING:
+            const size = this.read_uint();
+            this.check_available(size);
+            const text = this.text_decoder.decode(
+                this.bytes.subarray(this.pos, this.pos + size));
+            this.pos += size;
+            this.strings.push(text);
+            return text;
+        case STRING_REF:
+            return this.strings[this.read_uint()];
+        case LIST:
+            const n = this.read_uint();
+            const list = [];
+            for (let i = 0; i < n; i++)
+                list.push(this.unpack());
+            return list;
+        case DICT:
+            const nitems = this.read_uint();
+            const dict = {};
+            for (let i = 0; i < nitems; i++) {
+                const key = this.unpack();
+                dict[key] = this.unpack();
+            }
+            return dict;
+        default:
+            throw new Error(`Unknown tag ${tag} in graphics`);
+        }
+    }
+
+    check_available(n) {
+        if (this.pos + n > this.bytes.length)
+            throw INCOMPLETE;
+    }
+
+    read_byte() {
+        this.check_available(1);
+        return this.bytes[this.pos++];
+    }
+
+    // Return the number read with the given DataView method (little-endian).
+    read_number(method, size) {
+        this.check_available(size);
+        const x = this.view[method](this.pos, true);
+        this.pos += size;
+        return x;
+    }
+
+    // Return the unsigned integer encoded as a varint (7 bits per byte).
+    read_uint() {
+        let n = 0, scale = 1, byte;
+        do {
+            byte = this.read_byte();
+            n += (byte & 0x7f) * scale;
+            scale *= 128;
+        } while (byte >= 0x80);
+        return n;
+    }
+}
+
+
+// Return a new array with the contents of the two given ones.
+function concat(a, b) {
+    if (a.length === 0)
+        return b;
+
+    const c = new Uint8Array(a.length + b.length);
+    c.set(a);
+    c.set(b, a.length);
+    return c;
+}
@@ -8,7 +8,7 @@ import { colorize_active, get_active_class } from "./active.js";
 import { colorize_searches, get_search_class } from "./search.js";
 import { colorize_selections, get_selection_class } from "./select.js";
 import { on_box_contextmenu } from "./contextmenu.js";
-import { api } from "./api.js";
+import { api, api_graphics } from "./api.js";
 import { draw_pixi, clear_pixi } from "./pixi.js";
 
 export { update, draw_tree, draw_tree_scale, draw_aligned, draw, get_class_name,
@@ -82,7 +82,7 @@ async function draw_tree() {
     try {
         clearTimeout(align_timeout);
 
-        const items = await api(`/trees/${get_tid()}/draw?${qs}`);
+        const items = await api_graphics(`/trees/${get_tid()}/draw?${qs}`);
 
         draw(div_tree, items, view.tl, view.zoom);
 
@@ -312,7 +312,7 @@ async function draw_legend(params) {
         ...params, "panel": -1,
     }).toString();
 
-    const items = await api(`/trees/${get_tid()}/draw?${qs}`);
+    const items = await api_graphics(`/trees/${get_tid()}/draw?${qs}`);
 
     if (items.length) {
         const div = document.createElement("div");
@@ -364,7 +364,7 @@ async function draw_aligned(params, npanels) {
 
             const div = panel.div;
 
-            const items = await api(`/trees/${get_tid()}/draw?${qs}`);
+            const items = await api_graphics(`/trees/${get_tid()}/draw?${qs}`);
 
             // Resize headers accordingly or remove them in no items
             if (panel_n === 2 || panel_n === 3) {
@@ -391,7 +391,7 @@ async function draw_aligned(params, npanels) {
                 "rmin": view.rmin + panel * view.tree_size.width
             }).toString();
 
-            const items = await api(`/trees/${get_tid()}/draw?${qs}`);
+            const items = await api_graphics(`/trees/${get_tid()}/draw?${qs}`);
 
             const replace = false;
             draw(div_tree, items, view.tl, view.zoom, replace);
@@ -2,7 +2,7 @@
 
 import { view, get_tid } from "./gui.js";
 import { draw, update } from "./draw.js";
-import { api } from "./api.js";
+import { api_graphics } from "./api.js";
 
 export { draw_minimap, update_minimap_visible_rect, move_minimap_view };
 
@@ -26,7 +26,7 @@ async function draw_minimap() {
     if (view.ultrametric)
         qs += "&ultrametric=1"
 
-    const items = await api(`/trees/${get_tid()}/draw?${qs}`);
+    const items = await api_graphics(`/trees/${get_tid()}/draw?${qs}`);
 
     const mbw = 2;  // border-width from .minimap css
     const offset = -(div_minimap.offsetWidth - 2*mbw) / view.minimap.zoom.x / 2;
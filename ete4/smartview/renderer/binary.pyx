@@ -0,0 +1,240 @@
+"""
+Compact binary encoding of the graphic elements made by the drawers.
+
+The graphic elements (like ['line', (x1, y1), (x2, y2), 'lengthline',
+[], {...}]) are encoded one after another, after a short header. Each
+value starts with a one-byte tag saying what comes next:
+
+  NONE, FALSE, TRUE       (nothing else)
+  INT8, INT32             signed little-endian integer
+  FLOAT32, FLOAT64        little-endian float
+  STRING                  varint length + utf-8 bytes (added to the table)
+  STRING_REF              varint position of the string in the table
+  LIST, DICT              varint length + the items (or key, value pairs)
+
+Strings are interned: the first time a string appears it is sent fully
+and gets the next position in a table, and later it is just referenced.
+Floats are sent as float32 when that loses less than the given tolerance
+(normally a fraction of a pixel), and as float64 otherwise.
+
+The decoder in the gui is static/js/binary.js.
+"""
+
+from libc.math cimport fabs
+from struct import Struct
+
+
+MAGIC = b'ETEG\x01'  # header: format name and version
+
+# Tags of the encoded values.
+cdef enum:
+    NONE = 0
+    FALSE = 1
+    TRUE = 2
+    INT8 = 3
+    INT32 = 4
+    FLOAT32 = 5
+    FLOAT64 = 6
+    STRING = 7
+    STRING_REF = 8
+    LIST = 9
+    DICT = 10
+
+INT32_S = Struct('<i')
+FLOAT32_S = Struct('<f')
+FLOAT64_S = Struct('<d')
+
+
+cdef class Encoder:
+    """Encoder of values, that remembers the strings it has already sent."""
+
+    cdef dict strings  # string -> position in the table
+    cdef double tolerance  # maximum error allowed when using float32
+    cdef bytearray out
+
+    def __init__(self, tolerance=0):
+        self.strings = {}
+        self.tolerance = tolerance
+        self.out = bytearray()
+
+    def encode(self, value):
+        """Return the bytes encoding value."""
+        self.pack(value)
+        data = bytes(self.out)
+        self.out.clear()
+        return data
+
+    def encode_into(self, value, bytearray out):
+        """Add to out the bytes encoding value."""
+        self.out = out
+        try:
+            self.pack(value)
+        finally:
+            self.out = bytearray()
+
+    cdef pack(self, value):
+        cdef double x
+        cdef float x32
+        t = type(value)
+
+        if t is str:
+            self.pack_str(value)
+        elif t is float:
+            x = value
+            x32 = <float>x
+            if fabs(<double>x32 - x) <= self.tolerance:
+                self.out.append(FLOAT32)
+                self.out += FLOAT32_S.pack(x)
+            else:
+                self.out.append(FLOAT64)
+                self.out += FLOAT64_S.pack(x)
+        elif t is list or t is tuple or isinstance(value, tuple):
+            self.out.append(LIST)
+            self.pack_uint(len(value))
+            for v in value:
+                self.pack(v)
+        elif t is dict:
+            self.out.append(DICT)
+            self.pack_uint(len(value))
+            for k, v in value.items():
+                self.pack(k)
+                self.pack(v)
+        elif value is None:
+            self.out.append(NONE)
+        elif t is bool:
+            self.out.append(TRUE if value else FALSE)
+        elif t is int:
+            if -128 <= value < 128:
+                self.out.append(INT8)
+                self.out.append(value & 0xff)
+            elif -2**31 <= value < 2**31:
+                self.out.append(INT32)
+                self.out += INT32_S.pack(value)
+            else:  # as the javascript numbers they will end up being
+                self.out.append(FLOAT64)
+                self.out += FLOAT64_S.pack(value)
+        elif isinstance(value, float):  # like numpy.float64
+            self.pack(float(value))
+        else:
+            raise TypeError(f'Object of type {t.__name__} cannot be encoded')
+
+    cdef pack_str(self, str text):
+        pos = self.strings.get(text)
+        if pos is None:
+            self.strings[text] = len(self.strings)
+            data = text.encode('utf8')
+            self.out.append(STRING)
+            self.pack_uint(len(data))
+            self.out += data
+        else:
+            self.out.append(STRING_REF)
+            self.pack_uint(pos)
+
+    cdef pack_uint(self, unsigned long n):
+        while n >= 0x80:  # varint: 7 bits per byte, high bit set if more follow
+            self.out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        self.out.append(n)
+
+
+def stream(elements, tolerance=0, chunk_size=64*1024):
+    """Yield the bytes encoding the elements, in chunks of about chunk_size."""
+    encoder = Encoder(tolerance)
+
+    out = bytearray(MAGIC)
+    for element in elements:
+        encoder.encode_into(element, out)
+        if len(out) >= chunk_size:
+            yield bytes(out)
+            out.clear()
+
+    if out:
+        yield bytes(out)
+
+
+def dumps(elements, tolerance=0):
+    """Return the bytes encoding the list of elements."""
+    return b''.join(stream(elements, tolerance))
+
+
+def loads(data):
+    """Return the list of elements encoded in data."""
+    assert data[:len(MAGIC)] == MAGIC, 'unknown format'
+
+    decoder = Decoder(data)
+    decoder.pos = len(MAGIC)
+
+    elements = []
+    while decoder.pos < len(data):
+        elements.append(decoder.unpack())
+
+    return elements
+
+
+cdef class Decoder:
+    """Decoder of values (used to read back what the Encoder makes)."""
+
+    cdef bytes data
+    cdef public Py_ssize_t pos
+    cdef list strings
+
+    def __init__(self, bytes data):
+        self.data = data
+        self.pos = 0
+        self.strings = []
+
+    def unpack(self):
+        """Return the next value."""
+        cdef int tag = self.data[self.pos]
+        self.pos += 1
+
+        if tag == NONE:
+            return None
+        elif tag == FALSE or tag == TRUE:
+            return tag == TRUE
+        elif tag == INT8:
+            value = self.data[self.pos]
+            self.pos += 1
+            return value - 256 if value >= 128 else value
+        elif tag == INT32:
+            return self.unpack_struct(INT32_S)
+        elif tag == FLOAT32:
+            return self.unpack_struct(FLOAT32_S)
+        elif tag == FLOAT64:
+            return self.unpack_struct(FLOAT64_S)
+        elif tag == STRING:
+            size = self.unpack_uint()
+            text = self.data[self.pos:self.pos + size].decode('utf8')
+            self.pos += size
+            self.strings.append(text)
+            return text
+        elif tag == STRING_REF:
+            return self.strings[self.unpack_uint()]
+        elif tag == LIST:
+            return [self.unpack() for _ in range(self.unpack_uint())]
+        elif tag == DICT:
+            n = self.unpack_uint()
+            d = {}
+            for _ in range(n):
+                k = self.unpack()
+                d[k] = self.unpack()
+            return d
+        else:
+            raise ValueError(f'Unknown tag {tag} at position {self.pos - 1}')
+
+    cdef unpack_struct(self, s):
+        value, = s.unpack_from(self.data, self.pos)
+        self.pos += s.size
+        return value
+
+    cdef unsigned long unpack_uint(self):
+        cdef unsigned long n = 0
+        cdef int shift = 0
+        cdef int byte
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            n |= <unsigned long>(byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
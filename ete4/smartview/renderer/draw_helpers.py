@@ -49,6 +49,19 @@ def intersects_segment(s1, s2):
     return s1min <= s2max and s2min <= s1max
 
 
+def contains_box(b1, b2):
+    "Return True if the box b1 contains the box b2 (of the same kind)"
+    return (contains_segment(get_xs(b1), get_xs(b2)) and
+            contains_segment(get_ys(b1), get_ys(b2)))
+
+
+def contains_segment(s1, s2):
+    "Return True if the segment s1 contains the segment s2"
+    s1min, s1max = s1
+    s2min, s2max = s2
+    return s1min <= s2min and s2max <= s1max
+
+
 def intersects_angles(rect, asec):
     "Return True if any part of rect is contained within the angles of the asec"
     return any(intersects_segment(get_ys(circumasec(r)), get_ys(asec))
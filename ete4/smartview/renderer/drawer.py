@@ -12,12 +12,22 @@ from ete4.core import operations as ops
 from .. import TreeStyle
 from .face_positions import FACE_POSITIONS, make_faces
 from . import draw_helpers as dh
+from .lod import nleaves
+from .marks import MarkedNodes
 Box = dh.Box  # shortcut, because we use it a lot
 
 Size = namedtuple('Size', 'dx dy')  # size of a 2D shape (sizes are always >= 0)
 TreeActive = namedtuple('TreeActive', 'nodes clades')
 Active = namedtuple('Active', 'results parents')
 
+def marked(marked_nodes):
+    "Return the given {text: (results, parents)} as MarkedNodes (indexed)"
+    if isinstance(marked_nodes, MarkedNodes):
+        return marked_nodes
+    else:
+        return MarkedNodes(marked_nodes or {})
+
+
 def get_empty_active():
     nodes = Active(set(), defaultdict(lambda: 0))
     clades = Active(set(), defaultdict(lambda: 0))
@@ -77,7 +87,7 @@ class Drawer:
                  limits=None, collapsed_ids=None,
                  active=None, selected=None, searches=None,
                  layouts=None, tree_style=None,
-                 include_props=None, exclude_props=None):
+                 include_props=None, exclude_props=None, summaries=None):
         self.tree = tree
         self.viewport = Box(*viewport) if viewport else None
         self.panel = panel
@@ -85,12 +95,13 @@ class Drawer:
         self.xmin, self.xmax, self.ymin, self.ymax = limits or (0, 0, 0, 0)
         self.collapsed_ids = collapsed_ids or set()  # manually collapsed
         self.active = active or get_empty_active()  # looks like (results, parents)
-        self.selected = selected or {}  # looks like {node_id: (node, parents)}
-        self.searches = searches or {}  # looks like {text: (results, parents)}
+        self.selected = marked(selected)  # looks like {name: (results, parents)}
+        self.searches = marked(searches)  # looks like {text: (results, parents)}
         self.layouts = layouts or []
         self.include_props = include_props
         self.exclude_props = exclude_props
         self.tree_style = tree_style or TreeStyle()
+        self.summaries = summaries  # lod.Summaries, to skip small nodes fast
 
     def draw(self):
         "Yield graphic elements to draw the tree"
@@ -99,6 +110,7 @@ class Drawer:
         self.nodeboxes = []  # boxes surrounding all nodes and collapsed boxes
         self.node_dxs = [[]]  # lists of nodes dx (to find the max)
         self.bdy_dys = [[]]  # lists of branch dys and total dys
+        self.partial_run = (None, 0)  # (parent, end) of a run not all visible
 
         if self.panel == 0:
             self.tree_style.aligned_grid_dxs = defaultdict(lambda: 0)
@@ -139,11 +151,20 @@ class Drawer:
             it.descend = False  # skip children
             return x, y + box_node.dy
 
+        if self.summaries and not self.collapsed_ids:
+            run_box = self.get_run_box(point, it)
+            if run_box:  # several small siblings that go in the same outline
+                self.node_dxs[-1].append(run_box.dx)
+                self.outline = stack(self.outline, run_box)
+                it.descend = False  # skip children (and the run's siblings)
+                return x, y + run_box.dy
+
         if not it.node.sm_style['draw_descendants']:
             # Skip descendants => in collapsed_ids
             self.collapsed_ids.add(it.node_id)
 
-        is_manually_collapsed = it.node_id in self.collapsed_ids
+        is_manually_collapsed = (bool(self.collapsed_ids) and
+                                 it.node_id in self.collapsed_ids)
 
         if is_manually_collapsed and self.outline:
             graphics += self.get_outline()  # so we won't stack with its outline
@@ -171,19 +192,16 @@ class Drawer:
         "Update list of graphics to draw and return new position"
 
         # Searches
-        searched_by = set( text for text,(results,_) in self.searches.items()
-                if it.node in results )
+        searched_by = set(self.searches.having(it.node))
         # Selection
-        selected_by = [ text for text,(results,_) in self.selected.items()
-                if it.node in results ]
+        selected_by = self.selected.having(it.node)
         active_clade = [ "active_clades" ] if it.node in self.active.clades.results else []
         # Only if node is collapsed
         selected_children = []
         active_children = TreeActive(0, 0)
         if self.outline:
-            if all(child in self.collapsed for child in it.node.children):
-                searched_by.update( text for text,(results,parents) in self.searches.items()
-                        if any(node in results or node in parents.keys() for node in self.collapsed) )
+            if self.collapses_all_children(it.node):
+                searched_by.update(self.searches.having_any(self.collapsed))
                 active_children = self.get_active_children()
                 selected_children = self.get_selected_children()
 
@@ -208,6 +226,62 @@ class Drawer:
 
         return x_before, y_after;
 
+    def get_run_box(self, point, it):
+        """Return the box of the run of small siblings starting at it.node.
+
+        The run comes from the summaries, and its nodes are added to the
+        collapsed ones. Return None if there is no such run (of more than
+        one node) fully in the viewport.
+        """
+        if len(it.visiting) < 2:
+            return None
+
+        parent, i = it.visiting[-2]
+        if parent is self.partial_run[0] and i < self.partial_run[1]:
+            return None  # its run did not fit, we are visiting them one by one
+
+        end, dx, dy = self.summaries.get_run(self, parent, i, point[0])
+
+        if end - i < 2:
+            return None
+
+        box = make_box(point, Size(dx, dy))
+        if not self.all_in_viewport(box):
+            self.partial_run = (parent, end)
+            end, box = self.get_partial_run(point, parent, i, end, box)
+            if end - i < 2:
+                return None
+
+        self.collapsed += parent.children[i:end]
+        it.skip_siblings(end - i - 1)
+        return box
+
+    def get_partial_run(self, point, parent, i, end, box):
+        """Return the end and box of the first part of the run in the viewport.
+
+        The run goes from i to end (not included) and has the given box.
+        """
+        _, _, dx, dy = box
+
+        def run_box(k):  # box of the run from i to k (approximate dx)
+            return make_box(point, Size(dx, dy - self.summaries.get_run(
+                self, parent, k, point[0])[2]))
+
+        lo, hi = i, end - 1  # the run from i to hi+1 does not fit
+        while lo < hi:  # find the last k such that the run from i to k fits
+            k = (lo + hi + 1) // 2
+            if self.all_in_viewport(run_box(k)):
+                lo = k
+            else:
+                hi = k - 1
+
+        k = lo
+        if k - i < 2:
+            return k, None
+
+        dx = max(self.node_size(node).dx for node in parent.children[i:k])
+        return k, make_box(point, Size(dx, run_box(k).dy))
+
     def draw_content(self, node, point, active_children=TreeActive(0, 0), selected_children=[]):
         "Yield the node content's graphic elements"
         x, y = point
@@ -232,10 +306,8 @@ class Drawer:
         if self.panel == 0:
             node_style = node.sm_style
             if dx > 0:
-                parent_of = set(text for text,(_,parents) in self.searches.items()
-                                if node in parents.keys())
-                parent_of.update(text for text,(_,parents) in self.selected.items()
-                                if node in parents.keys())
+                parent_of = set(self.searches.having_parent(node))
+                parent_of.update(self.selected.having_parent(node))
                 hz_line_style = {
                         'type': node_style['hz_line_type'],
                         'stroke-width': node_style['hz_line_width'],
@@ -340,12 +412,10 @@ class Drawer:
         x, y, _, _ = self.outline
         collapsed_node = self.get_collapsed_node()
 
-        searched_by = [text for text,(results,parents) in self.searches.items()
-                       if collapsed_node in results
-                       or any(node in results or node in parents
-                              for node in self.collapsed)]
-        selected_by = [text for text,(results,parents) in self.selected.items()
-                       if collapsed_node in results]
+        searched_by = self.searches.having_any(self.collapsed)
+        searched_by += [text for text in self.searches.having(collapsed_node)
+                        if text not in searched_by]
+        selected_by = self.selected.having(collapsed_node)
         active_clade = [ "active_clades" ] if collapsed_node in self.active.clades.results else []
         active_children = self.get_active_children()
         selected_children = self.get_selected_children()
@@ -397,24 +467,23 @@ class Drawer:
             return node0
 
         parent = node0.up
-        if all(node.up == parent for node in self.collapsed[1:]) and\
-           all(child in self.collapsed for child in parent.children):
+        if parent is not None and self.collapses_all_children(parent):
             parent.is_collapsed = True
             return parent
 
         # No node inside the tree contains all the collapsed nodes
         # Create a fictional node whose children are the collapsed nodes
+        # (Its dist is set in the constructor, so it doesn't count as an edit.)
         try:
-            node = Tree()
+            node = Tree({'dist': 0})
         except:
             from ... import Tree # avoid circular import
-            node = Tree()
+            node = Tree({'dist': 0})
 
         node.is_collapsed = True
         node.is_initialized = False
         node._children = self.collapsed  # add avoiding parent override
         _, _, _, dy = self.outline
-        node.dist = 0
         node.size = Size(0, dy)
 
         return node
@@ -428,21 +497,22 @@ class Drawer:
 
         return is_manually_collapsed or self.is_small(box_node)
 
+    def collapses_all_children(self, node):
+        "Return True if the collapsed nodes are exactly the children of node"
+        # The collapsed nodes are all different, so this is the same as
+        # checking that each child is in self.collapsed, but in O(n).
+        return (len(self.collapsed) == len(node.children) and
+                all(child.up is node for child in self.collapsed))
+
     def get_active_children(self):
         nodes = sum(1 for node in self.collapsed if node in self.active.nodes.results)
         nodes += sum(self.active.nodes.parents.get(node, 0) for node in self.collapsed)
-        clades = sum(len(node) for node in self.collapsed if node in self.active.clades.results)
+        clades = sum(nleaves(node) for node in self.collapsed if node in self.active.clades.results)
         clades += sum(self.active.clades.parents.get(node, 0) for node in self.collapsed)
         return TreeActive(nodes, clades)
 
     def get_selected_children(self):
-        selected_children = []
-        for text,(results, parents) in self.selected.items():
-            hits = sum(1 for node in self.collapsed if node in results)
-            hits += sum(parents.get(node, 0) for node in self.collapsed)
-            if hits:
-                selected_children.append((text, hits))
-        return selected_children
+        return self.selected.hits(self.collapsed)
 
     def get_popup_props(self, node):
         """Return dictionary of web-safe node properties (to use in a popup)."""
@@ -490,6 +560,16 @@ class DrawerRect(Drawer):
         else:
             return dh.intersects_segment(dh.get_ys(self.viewport), dh.get_ys(box))
 
+    def all_in_viewport(self, box):
+        "Return True if all the nodes stacked in box are in the viewport"
+        if not self.viewport:
+            return True
+
+        x, _, _, _ = box
+        vx, _, vdx, _ = self.viewport
+        return ((self.panel != 0 or vx <= x <= vx + vdx) and
+                dh.contains_segment(dh.get_ys(self.viewport), dh.get_ys(box)))
+
     def node_size(self, node):
         "Return the size of a node (its content and its children)"
         return Size(node.size[0], node.size[1])
@@ -571,12 +651,13 @@ class DrawerCirc(Drawer):
                  limits=None, collapsed_ids=None, active=None,
                  selected=None, searches=None,
                  layouts=None, tree_style=None,
-                 include_props=None, exclude_props=None):
+                 include_props=None, exclude_props=None, summaries=None):
         super().__init__(tree, viewport, panel, zoom,
                          limits, collapsed_ids, active, selected, searches,
                          layouts, tree_style,
                          include_props=include_props,
-                         exclude_props=exclude_props)
+                         exclude_props=exclude_props,
+                         summaries=summaries)
 
         assert self.zoom[0] == self.zoom[1], 'zoom must be equal in x and y'
 
@@ -595,6 +676,19 @@ class DrawerCirc(Drawer):
         else:
             return dh.intersects_angles(self.viewport, box)
 
+    def all_in_viewport(self, box):
+        "Return True if all the nodes stacked in box are in the viewport"
+        if not dh.contains_segment((-pi, +pi), dh.get_ys(box)):
+            return False
+
+        if not self.viewport:
+            return True
+
+        if self.panel == 0:
+            return dh.contains_box(self.viewport, dh.circumrect(box))
+        else:
+            return False  # do not bother with the angles for other panels
+
     def flush_outline(self, minimum_dr=0):
         "Return box outlining the collapsed nodes"
         r, a, dr, da = super().flush_outline(minimum_dr)
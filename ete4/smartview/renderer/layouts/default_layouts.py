@@ -3,6 +3,7 @@ from ..nodestyle import NodeStyle
 from ..faces import AttrFace, TextFace, OutlineFace, AlignLinkFace
 
 from ..draw_helpers import summary, Padding
+from ..lod import nleaves
 
 
 __all__ = ['LayoutLeafName', 'LayoutNumberLeaves',
@@ -69,7 +70,7 @@ class LayoutNumberLeaves(TreeLayout):
     def set_node_style(self, node):
         if not node.is_leaf:
             face = TextFace(
-                self.formatter % len(node),  # number of leaves
+                self.formatter % nleaves(node),  # number of leaves
                 color=self.color,
                 min_fsize=self.min_fsize, max_fsize=self.max_fsize,
                 ftype=self.ftype,
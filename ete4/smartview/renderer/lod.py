@@ -0,0 +1,111 @@
+"""
+Level-of-detail summaries, to draw big trees fast when zoomed out.
+
+When zoomed out, most nodes are too small to be drawn and the drawers
+just stack them one after another into outlines. The summaries keep, for
+each zoom level, the runs of consecutive small siblings together with
+the size of their stacked outline, so a drawer can emit the outline
+directly instead of visiting all those nodes.
+
+The summaries are computed lazily (only for the nodes that get drawn)
+and dropped whenever the tree is edited, so after an edit only the
+parts that are drawn again are recomputed.
+"""
+
+from collections import OrderedDict
+
+from ete4.core import flat_tree
+from .draw_helpers import Box
+
+
+class Summaries:
+    """Runs of small siblings of a tree, for the zoom levels it is drawn at."""
+
+    def __init__(self, max_levels=8):
+        self.max_levels = max_levels  # zoom levels to remember
+        self.levels = OrderedDict()  # level key -> {parent: runs}
+        self.edits = None  # stamp of the tree (flat_tree.get_edits()) when computed
+
+    def __reduce__(self):
+        return Summaries, (self.max_levels,)  # do not save the summaries
+
+    def get_run(self, drawer, parent, i, x):
+        """Return (end, dx, dy) for the run of small children of parent from i.
+
+        The children from i to end (not included) are all small, and
+        stacked together have the size (dx, dy). If child i is not
+        small, end == i. The value x is where the children start.
+        """
+        runs = self.get_level(drawer).get(parent)
+
+        if runs is None or runs[0] != x:
+            runs = level_runs(drawer, parent, x)
+            self.get_level(drawer)[parent] = runs
+
+        _, ends, dxs, dys = runs
+        return ends[i], dxs[i], dys[i]
+
+    def get_level(self, drawer):
+        """Return the runs for the zoom level (and kind) of the drawer."""
+        edits = flat_tree.get_edits(drawer.tree)
+        if edits != self.edits:  # tree edited since we computed them?
+            self.levels.clear()
+            self.edits = edits
+
+        key = (drawer.TYPE, drawer.zoom, drawer.COLLAPSE_SIZE,
+               getattr(drawer, 'dy2da', 1))
+
+        level = self.levels.get(key)
+        if level is None:
+            level = self.levels[key] = {}
+            if len(self.levels) > self.max_levels:
+                self.levels.popitem(last=False)  # forget the least recent
+        else:
+            self.levels.move_to_end(key)
+
+        return level
+
+
+def level_runs(drawer, parent, x):
+    """Return (x, ends, dxs, dys) with the runs of small children of parent.
+
+    For each child i, ends[i] is where its run of small siblings ends, and
+    dxs[i] and dys[i] the size of the outline of the run from i on.
+    """
+    children = parent.children
+    n = len(children)
+    ends, dxs, dys = [0] * n, [0] * n, [0] * n
+
+    for i in range(n - 1, -1, -1):  # backwards, to accumulate the sizes
+        child = children[i]
+        size = drawer.node_size(child)
+
+        if not (drawer.is_small(Box(x, 0, *size)) and
+                draws_descendants(child)):
+            ends[i] = i  # no run starting here
+        elif i + 1 < n and ends[i + 1] > i + 1:  # continues a run
+            ends[i] = ends[i + 1]
+            dxs[i] = max(size[0], dxs[i + 1])
+            dys[i] = size[1] + dys[i + 1]
+        else:  # starts a run
+            ends[i] = i + 1
+            dxs[i], dys[i] = size
+
+    return x, ends, dxs, dys
+
+
+def draws_descendants(node):
+    """Return True if the style of node lets its descendants be drawn."""
+    style = node._sm_style  # (not node.sm_style, which creates one)
+    return style is None or style['draw_descendants']
+
+
+def nleaves(node):
+    """Return the number of leaves of node, using its size if possible."""
+    children = node.children
+    if not children:
+        return 1
+    elif children[0].up is not node:  # fictional node (drawn collapsed)
+        return sum(nleaves(child) for child in children)
+    else:
+        return int(node.size[1])  # which counts the leaves for internal nodes
@@ -0,0 +1,142 @@
+"""
+Index of the searches and selections that mark each node.
+
+The drawers need to know, for every node they draw, which searches (or
+selections) have it as a result or as a parent of a result. MarkedNodes
+is a dict {text: (results, parents)} that keeps for each node a bitmask
+of the texts it is in, so that is found without looping over all of them.
+"""
+
+
+class MarkedNodes(dict):
+    """Dict {text: (results, parents)} with an index from nodes to texts.
+
+    The index is updated whenever an entry is set or removed (so the sets
+    of an entry must not be changed in place, but replaced by new ones).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.clear()  # initializes the index
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        return MarkedNodes, (dict(self),)  # the index is recreated
+
+    def __setitem__(self, text, value):
+        if text in self.bits:  # its old bit stops being valid
+            self.unindex(text)
+
+        results, parents = value
+        bit = 1 << self.nbits
+        self.nbits += 1
+
+        self.bits[text] = bit
+        self.texts[bit] = text
+
+        for node in results:
+            self.results_masks[node] = self.results_masks.get(node, 0) | bit
+        for node in parents:
+            self.parents_masks[node] = self.parents_masks.get(node, 0) | bit
+
+        super().__setitem__(text, value)
+
+        if self.nbits > 2 * len(self) + 64:  # too many old bits around?
+            self.reindex()
+
+    def __delitem__(self, text):
+        self.unindex(text)
+        super().__delitem__(text)
+
+        if not self:
+            self.clear()  # so we start using bits from 0 again
+
+    def pop(self, text, *default):
+        if text in self:
+            value = self[text]
+            del self[text]
+            return value
+        elif default:
+            return default[0]
+        else:
+            raise KeyError(text)
+
+    def update(self, *args, **kwargs):
+        for text, value in dict(*args, **kwargs).items():
+            self[text] = value
+
+    def setdefault(self, text, value=None):
+        if text not in self:
+            self[text] = value
+        return self[text]
+
+    def clear(self):
+        super().clear()
+        self.bits = {}  # text -> bit
+        self.texts = {}  # bit -> text
+        self.nbits = 0  # number of bits used (including old ones)
+        self.results_masks = {}  # node -> bits of the texts it is a result of
+        self.parents_masks = {}  # node -> bits of the texts it is a parent of
+
+    def unindex(self, text):
+        """Remove text from the index (and its bit from its nodes' masks)."""
+        bit = self.bits.pop(text)
+        self.texts.pop(bit)
+
+        results, parents = dict.__getitem__(self, text)
+        for masks, nodes in [(self.results_masks, results),
+                             (self.parents_masks, parents)]:
+            for node in nodes:
+                mask = masks.get(node, 0) & ~bit
+                if mask:
+                    masks[node] = mask
+                else:
+                    masks.pop(node, None)  # so we do not keep the node
+
+    def reindex(self):
+        """Recreate the index (forgetting the bits of removed texts)."""
+        items = list(self.items())
+        self.clear()
+        self.update(items)
+
+    def texts_of(self, mask):
+        """Return the texts whose bits are in the mask."""
+        texts = []
+        while mask:
+            bit = mask & -mask  # lowest bit set
+            text = self.texts.get(bit)
+            if text is not None:  # or it is an old bit
+                texts.append(text)
+            mask ^= bit
+        return texts
+
+    def having(self, node):
+        """Return the texts that have node as a result."""
+        return self.texts_of(self.results_masks.get(node, 0))
+
+    def having_parent(self, node):
+        """Return the texts that have node as a parent of a result."""
+        return self.texts_of(self.parents_masks.get(node, 0))
+
+    def having_any(self, nodes):
+        """Return the texts that have any of the nodes as result or parent."""
+        mask = 0
+        for node in nodes:
+            mask |= (self.results_masks.get(node, 0) |
+                     self.parents_masks.get(node, 0))
+        return self.texts_of(mask)
+
+    def hits(self, nodes):
+        """Return [(text, hits)] with the results in or under the given nodes.
+
+        For each text, the hits are the number of nodes that are results
+        plus the number of results under each node (from the parents).
+        """
+        hits = {}
+        for node in nodes:
+            for text in self.having(node):
+                hits[text] = hits.get(text, 0) + 1
+            for text in self.having_parent(node):
+                hits[text] = hits.get(text, 0) + self[text][1].get(node, 0)
+        return [(text, hits[text]) for text in sorted(hits, key=self.bits.get)
+                if hits[text]]
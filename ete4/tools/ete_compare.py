@@ -1,5 +1,6 @@
 from .common import as_str, shorten_str, src_tree_iterator, ref_tree_iterator
 
+import os
 import re
 
 DESC = """
@@ -49,6 +50,15 @@ def populate_args(compare_args_p):
                               action = "store_true",
                               help="activates the TreeKO duplication aware comparison method")
 
+    compare_args.add_argument("--rf_matrix", dest="rf_matrix",
+                              action = "store_true",
+                              help=("only output the normalized RF distances of all source trees"
+                                    " (rows) against all reference trees (columns)"))
+
+    compare_args.add_argument("-C", "--cpu", dest="maxjobs", type=int,
+                              default=None,
+                              help="number of processes used to compute the --rf_matrix")
+
 
 def run(args):
     from .. import Tree
@@ -73,7 +83,9 @@ def run(args):
               'RF', 'maxRF', "src-branches",
               "ref-branches", "subtrees", "treekoD" ]
 
-    if args.taboutput:
+    if args.rf_matrix:
+        pass  # print_rf_matrix() writes its own header
+    elif args.taboutput:
         print('# ' + '\t'.join(header))
     elif args.show_mismatches or args.show_matches:
         pass
@@ -89,28 +101,41 @@ def run(args):
     else:
         tree_class = Tree
 
-    for stree_name in src_tree_iterator(args):
-        stree = tree_class(stree_name, format=args.src_newick_format)
+    # Read the reference trees only once (they are compared to every source).
+    rtrees = []
+    for rtree_name in ref_tree_iterator(args):
+        rtree = read_tree(tree_class, rtree_name, args.ref_newick_format)
 
         # Parses attrs if necessary
-        src_tree_attr = args.src_tree_attr
-        if args.src_attr_parser:
-            for leaf in stree:
-                leaf.add_property('tempattr', re.search(
-                    args.src_attr_parser, getattr(leaf, args.src_tree_attr)).groups()[0])
-            src_tree_attr = 'tempattr'
+        ref_tree_attr = args.ref_tree_attr
+        if args.ref_attr_parser:
+            for leaf in rtree:
+                leaf.add_prop('tempattr', re.search(
+                    args.ref_attr_parser, leaf.get_prop(args.ref_tree_attr)).groups()[0])
+            ref_tree_attr = 'tempattr'
+
+        rtrees.append((rtree_name, rtree, ref_tree_attr))
 
-        for rtree_name in ref_tree_iterator(args):
-            rtree = tree_class(rtree_name, format=args.ref_newick_format)
+    def read_source_trees():
+        for stree_name in src_tree_iterator(args):
+            stree = read_tree(tree_class, stree_name, args.src_newick_format)
 
             # Parses attrs if necessary
-            ref_tree_attr = args.ref_tree_attr
-            if args.ref_attr_parser:
-                for leaf in rtree:
-                    leaf.add_property('tempattr', re.search(
-                        args.ref_attr_parser, getattr(leaf, args.ref_tree_attr)).groups()[0])
-                ref_tree_attr = 'tempattr'
+            src_tree_attr = args.src_tree_attr
+            if args.src_attr_parser:
+                for leaf in stree:
+                    leaf.add_prop('tempattr', re.search(
+                        args.src_attr_parser, leaf.get_prop(args.src_tree_attr)).groups()[0])
+                src_tree_attr = 'tempattr'
 
+            yield stree_name, stree, src_tree_attr
+
+    if args.rf_matrix:
+        print_rf_matrix(args, list(read_source_trees()), rtrees)
+        return
+
+    for stree_name, stree, src_tree_attr in read_source_trees():
+        for rtree_name, rtree, ref_tree_attr in rtrees:
             r = stree.compare(rtree,
                               ref_tree_attr=ref_tree_attr,
                               source_tree_attr=src_tree_attr,
@@ -161,6 +186,47 @@ def run(args):
                                 fix_col_width = col_sizes, wrap_style='cut')
 
 
+def read_tree(tree_class, source, parser):
+    """Return tree read from source (a file name or a newick)."""
+    if os.path.isfile(source):
+        with open(source) as f:
+            return tree_class(f, parser=parser)
+    else:
+        return tree_class(source, parser=parser)
+
+
+def print_rf_matrix(args, strees, rtrees):
+    """Print the normalized rf distances from all source to all ref trees."""
+    from ..core.splits import rf_matrix
+
+    # The leaves are identified by their name (or their parsed attribute).
+    for _, tree, attr in strees + rtrees:
+        if attr != 'name':
+            for leaf in tree:
+                leaf.add_prop('rf_leaf_id', leaf.get_prop(attr))
+
+    prop = ('name' if all(attr == 'name' for _, _, attr in strees + rtrees)
+            else 'rf_leaf_id')
+
+    nrf = rf_matrix([t for _, t, _ in strees], [t for _, t, _ in rtrees],
+                    prop=prop, unrooted=args.unrooted, normalized=True,
+                    processes=args.maxjobs)
+
+    header = ['source'] + [shorten_str(name, 15, reverse=True)
+                           for name, _, _ in rtrees]
+    rows = [[shorten_str(name, 15, reverse=True)] + ['%.4g' % x for x in row]
+            for (name, _, _), row in zip(strees, nrf)]
+
+    if args.taboutput:
+        print('# ' + '\t'.join(header))
+        for row in rows:
+            print('\t'.join(row))
+    else:
+        from ..utils import print_table
+        print_table([header] + rows, fix_col_width=[15] * len(header),
+                    wrap_style='cut')
+
+
 def euc_dist(v1, v2):
     if type(v1) != set: v1 = set(v1)
     if type(v2) != set: v2 = set(v2)
@@ -8,6 +8,8 @@ from scipy.cluster import hierarchy as hcluster
 import random
 import itertools
 import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+from scipy import sparse
 from ete4.core.tree import Tree
 from ete4.utils import print_table, color
 
@@ -204,6 +206,10 @@ def load_matrix(file,separator):
     '''
     Digests files containing a expression matrix and translates it to a dictionary
 
+    The file is read twice, line by line: first to count the rows, and
+    then to fill an array with the values, so only the array is kept in
+    memory.
+
     Parameters:
         file: expression matrix filename, as string
         separator: Column separator, as string
@@ -212,26 +218,74 @@ def load_matrix(file,separator):
         dictionary with key values:
             idx: values are row indexes, as integers
             headers: values are column names, as strings
-            dict: values are dictionary of columns as key values and their expression values, as lists
+            matrix: values of the expression matrix (rows x columns), as numpy array
+            dict: values are dictionary of columns as key values and their expression values, as numpy arrays (views of the matrix columns)
     '''
+    with open(file, "r") as f:
+        headers = f.readline().rstrip().split(separator)[1:] # exclude empty space at the begining
+        nrows = sum(1 for line in f if line.strip())
 
+    matrix = np.empty((nrows, len(headers)))
     idx = []
     with open(file, "r") as f:
-        headers = f.readline().rstrip().split(separator)[1:] # exclude empty space at the begining
-        col2v = { h :[] for h in headers}
+        f.readline()  # skip headers
         for line in f:
-            elements = line.strip().split(separator)
-            idx.append(elements.pop(0))
-            for i,h in enumerate(headers):
-                col2v[h].append(float(elements[i]))
+            if line.strip():
+                elements = line.strip().split(separator)
+                matrix[len(idx)] = elements[1:len(headers)+1]
+                idx.append(elements[0])
+
     treedict = {}
     treedict['idx'] = idx
     treedict['headers'] = headers
-    treedict['dict'] = col2v
+    treedict['matrix'] = matrix
+    treedict['dict'] = {h: matrix[:,i] for i,h in enumerate(headers)}
 
     return treedict
 
 
+def get_matrix(treedict):
+    '''
+    Returns the expression matrix (rows x columns) of a dictionary as made by load_matrix
+    '''
+    if 'matrix' in treedict:
+        return treedict['matrix']
+    else:
+        return np.column_stack([treedict['dict'][h] for h in treedict['headers']])
+
+
+def correlations(x, y=None, block_size=1024):
+    '''
+    Calculates the Pearson correlations between the columns of two matrices
+
+    It gives the same values as np.corrcoef for each pair of columns, but
+    computed at once with matrix products, by blocks of columns of x to
+    limit the memory used for wide matrices.
+
+    Parameters:
+        x: matrix with observations as columns (rows x n), as numpy array
+        y: matrix with observations as columns (rows x m), as numpy array (x if not given)
+        block_size: number of columns of x to correlate at a time, as integer
+
+    Returns:
+        matrix (n x m) of correlations, as numpy array
+    '''
+    def normalize(m):
+        m = np.asarray(m, dtype=float)
+        m = m - m.mean(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return m / np.sqrt((m * m).sum(axis=0))  # constant columns give nan
+
+    xn = normalize(x)
+    yn = xn if y is None else normalize(y)
+
+    corr = np.empty((xn.shape[1], yn.shape[1]))
+    for i in range(0, xn.shape[1], block_size):
+        np.matmul(xn[:, i:i+block_size].T, yn, out=corr[i:i+block_size])
+
+    return np.clip(corr, -1, 1, out=corr)
+
+
 def dict2tree(treedict,jobs=1,parallel=None):
     '''
     Generates a tree object from a dictionary using UPGMA algorithm and Pearson correlations between observations
@@ -241,65 +295,51 @@ def dict2tree(treedict,jobs=1,parallel=None):
             idx: values are row indexes, as integers
             headers: values are column names, as strings
             dict: values are dictionary of columns as key values and their expression values, as lists
-        jobs: maximum number of jobs to use when parallel argument is provided, as integer
-        parallel: parallelization method, as string. Options are:
-            async for asyncronous parallelization
-            sync for asyncronous parallelization
+        jobs: kept for compatibility, the correlations are computed at once with (possibly multithreaded) matrix products
+        parallel: kept for compatibility (see jobs)
 
     Returns:
         tree object
     '''
-    log = logging.getLogger()
-
-    matrix = np.zeros((len(treedict['headers']), len(treedict['headers'])))
-    dm = {h : {} for h in treedict['headers']}
-
-    if parallel == 'sync':
-        pool = mp.Pool(jobs)
-        matrix = [[pool.apply(np.corrcoef,args=(treedict['dict'][col1],treedict['dict'][col2])) for col2 in treedict['headers']] for col1 in treedict['headers']]
-        pool.close()
-
-    if parallel == 'async':
-        pool = mp.Pool(jobs)
-        matrix = [[pool.apply_async(np.corrcoef,args=(treedict['dict'][col1],treedict['dict'][col2])) for col2 in treedict['headers']] for col1 in treedict['headers']]
-        pool.close()
-        for i in range(len(matrix)):
-            for j in range(len(matrix[0])):
-                matrix[i][j] = matrix[i][j].get()[0][1]
-
-    else:
-        matrix = [[(np.corrcoef(treedict['dict'][col1],treedict['dict'][col2]))[0][1] for col2 in treedict['headers']] for col1 in treedict['headers']]
+    matrix = correlations(get_matrix(treedict))
 
     Z = hcluster.linkage(matrix, "average") #"single" for default, "average" for UPGMA
-    T = hcluster.to_tree(Z)
 
+    return linkage2tree(Z, treedict['headers'])
 
-    root = Tree()
-    root.dist = 0
-    root.name = "root"
-    item2node = {T.get_id(): [T, root]}
 
-    to_visit = [T]
-    while to_visit:
-        node = to_visit.pop()
-        cl_dist = node.dist /2.0
-        for ch_node in [node.left, node.right]:
-            if ch_node:
-                ch = Tree()
-                ch.dist = cl_dist
-                ch.name = str(ch_node.get_id())
-                item2node[node.get_id()][1].add_child(ch)
-                item2node[ch_node.get_id()] = [ch_node, ch]
-                to_visit.append(ch_node)
+def linkage2tree(Z, names):
+    '''
+    Generates a tree object from a linkage matrix (as made by scipy's linkage)
+
+    Each node has as dist half the height of the cluster of its parent.
+    The leaves are named after the observations, the internal nodes
+    with the ids of their clusters, and the root is called "root".
 
+    Parameters:
+        Z: linkage matrix, as numpy array
+        names: names of the observations, as list
 
-    # This is your ETE tree structure
-    tree = root
+    Returns:
+        tree object
+    '''
+    n = len(names)
+
+    # Clusters 0 to n-1 are the observations, and n+k is the one joined in Z[k].
+    children = {}  # cluster -> its children nodes (when they are made)
+    for k in range(n - 1):
+        dist = float(Z[k,2]) / 2.0
+        nodes = []
+        for c in [int(Z[k,0]), int(Z[k,1])]:
+            if c < n:
+                nodes.append(Tree({'dist': dist, 'name': names[c]}))
+            else:
+                nodes.append(Tree({'dist': dist, 'name': str(c)}, children.pop(c)))
+        children[n + k] = nodes
 
-    for leaf in tree:
-        leaf.name = treedict['headers'][int(leaf.name)]
+    root = Tree({'dist': 0.0, 'name': "root"}, children.pop(2 * n - 2, None))
 
-    return tree
+    return root
 
 def tree_from_matrix(matrix,sep=",",dictionary=False,jobs=1,parallel=None):
     '''
@@ -346,19 +386,22 @@ def pearson_corr(rdict,tdict):
     # Select only common genes by gene name y both dictionaries
     log = logging.getLogger()
     log.info("Getting shared genes...")
-    rfilter = [i for i,value in enumerate(rdict['idx']) if value in tdict['idx']]
-    tfilter = [i for i,value in enumerate(tdict['idx']) if value in rdict['idx']]
+    ridx, tidx = set(rdict['idx']), set(tdict['idx'])
+    rfilter = [i for i,value in enumerate(rdict['idx']) if value in tidx]
+    tfilter = [i for i,value in enumerate(tdict['idx']) if value in ridx]
     log.info("Total Genes Shared = " + str(len(rfilter)))
 
-    rdict['dict'] = {header : [rdict['dict'][header][element] for element in rfilter] for header in rdict['headers']}
+    for d, rows in [(rdict, rfilter), (tdict, tfilter)]:
+        d['matrix'] = get_matrix(d)[rows]
+        d['dict'] = {h: d['matrix'][:,i] for i,h in enumerate(d['headers'])}
 
-    tdict['dict'] = {header : [tdict['dict'][header][element] for element in tfilter] for header in tdict['headers']}
+    distances = 1 - correlations(rdict['matrix'], tdict['matrix'])
 
     leaves = np.concatenate((rdict['headers'],tdict['headers']))
     pearson = {x: {} for x in leaves}
-    for a in rdict['headers']:
-        for b in tdict['headers']:
-            pearson[a][b] = pearson[b][a] = 1 - np.corrcoef(rdict['dict'][a],tdict['dict'][b])[0][1]
+    for i, a in enumerate(rdict['headers']):
+        for j, b in enumerate(tdict['headers']):
+            pearson[a][b] = pearson[b][a] = distances[i,j]
 
     return pearson
 
@@ -485,6 +528,208 @@ def sepstring(items, sep=", "):
 
 
 
+### Distance matrix ###
+
+# Cells of the distance matrix computed in each block of rows (approximately).
+BLOCK_CELLS = 2**22
+
+
+def distance_matrix(parts1, parts2, dist_fn, support, prop1, prop2,
+                    jobs=1, parallel=None):
+    """Return the matrix of distances between the nodes of parts1 and parts2.
+
+    The matrix is computed in blocks of rows. For EUCL_DIST and
+    EUCL_DIST_B, each block is computed at once from the contents of
+    the nodes as sparse matrices (a compressed form of their bitmaps).
+    For other distance functions, calling dist_fn for each pair.
+
+    If parallel is given ('sync' or 'async', which are equivalent now),
+    the blocks are computed by up to jobs processes. The arrays they
+    need and the resulting matrix are in shared memory.
+
+    :param parts1: List of (node, contents) of the reference tree.
+    :param parts2: List of (node, contents) of the target tree.
+    """
+    n1, n2 = len(parts1), len(parts2)
+    nrows = max(1, min(BLOCK_CELLS // max(n2, 1),
+                       -(-n1 // (4 * jobs)) if parallel else n1))
+    blocks = [(i, min(i + nrows, n1)) for i in range(0, n1, nrows)]
+
+    arrays = get_contents_arrays(parts1, parts2, dist_fn, prop1, prop2)
+    if arrays is not None:
+        args = (None, None, dist_fn, support, prop1, prop2)
+    else:  # we will call dist_fn for each pair
+        arrays = {}
+        args = (parts1, parts2, dist_fn, support, prop1, prop2)
+
+    arrays['matrix'] = np.empty((n1, n2), dtype=np.float32)
+
+    if not parallel or jobs < 2 or len(blocks) < 2:
+        _worker.update(arrays=arrays, args=args)
+        try:
+            for block in blocks:
+                compute_block(block)
+        finally:
+            _worker.clear()
+        return arrays['matrix']
+
+    shms, specs = share(arrays)
+    try:
+        with mp.Pool(jobs, initializer=init_worker, initargs=(specs, args)) as pool:
+            for _ in pool.imap_unordered(compute_block, blocks):
+                pass
+        return get_shared(shms['matrix'], specs['matrix']).copy()
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+
+def get_contents_arrays(parts1, parts2, dist_fn, prop1, prop2):
+    """Return dict of arrays to compute distances for dist_fn, or None.
+
+    The arrays describe sparse matrices with the observed properties
+    (columns) of each node (rows) of each tree, and for EUCL_DIST_B
+    the dists of their leaves too.
+    """
+    if dist_fn not in [EUCL_DIST, EUCL_DIST_B]:
+        return None
+
+    try:
+        values = {}  # observed property value -> column
+        for _, contents in itertools.chain(parts1, parts2):
+            for value in contents:
+                values.setdefault(value, len(values))
+    except TypeError:
+        return None  # unhashable values (only for strange dist_fn uses)
+
+    arrays = {'nvalues': np.array([len(values)])}
+    for name, parts, prop in [('1', parts1, prop1), ('2', parts2, prop2)]:
+        arrays['sizes' + name] = np.array([len(c) for _, c in parts], dtype=np.int64)
+        add_csr(arrays, 'contents' + name, [[values[v] for v in c] for _, c in parts])
+
+        if dist_fn == EUCL_DIST_B:
+            leaf_dists = get_leaf_dists(parts, prop, values)
+            if leaf_dists is None:
+                return None
+            columns, dists, arrays['sums' + name], arrays['nleaves' + name] = leaf_dists
+            add_csr(arrays, 'dists' + name, columns, dists)
+
+    return arrays
+
+
+def get_leaf_dists(parts, prop, values):
+    """Return the leaf dists of each node, as in EUCL_DIST_B.
+
+    For each node, return the observed values of its leaves (as
+    columns), the sums of the dists of the leaves with each value, the
+    sum of all their dists, and their number. Or None if some leaf
+    lacks dist or prop.
+    """
+    position = {node: i for i, (node, _) in enumerate(parts)}
+    rows = [{} for _ in parts]  # row -> {column: sum of dists}
+    sums = np.zeros(len(parts))
+    nleaves = np.zeros(len(parts))
+
+    for node, _ in parts:
+        if node.is_leaf:
+            if node.dist is None or prop not in node.props:
+                return None
+            col, dist = values[node.props[prop]], node.dist
+
+            ancestor = node
+            while ancestor is not None:
+                i = position.get(ancestor)
+                if i is not None:
+                    rows[i][col] = rows[i].get(col, 0) + dist
+                    sums[i] += dist
+                    nleaves[i] += 1
+                ancestor = ancestor.up
+
+    return ([list(r.keys()) for r in rows], [list(r.values()) for r in rows],
+            sums, nleaves)
+
+
+def add_csr(arrays, name, columns, data=None):
+    """Add to arrays the ones describing a sparse matrix with the given columns.
+
+    The matrix has a row for each list in columns, with a value for
+    each column in it (1 by default, or the one in data).
+    """
+    arrays[name + '_indptr'] = np.cumsum([0] + [len(c) for c in columns])
+    arrays[name + '_indices'] = np.fromiter(itertools.chain(*columns),
+                                            dtype=np.int64)
+    arrays[name + '_data'] = (np.ones(len(arrays[name + '_indices'])) if data is None
+                              else np.fromiter(itertools.chain(*data), dtype=float))
+
+
+def get_csr(arrays, name, ncols):
+    """Return the sparse matrix described by the arrays named as name."""
+    indptr = arrays[name + '_indptr']
+    return sparse.csr_matrix((arrays[name + '_data'], arrays[name + '_indices'],
+                              indptr), shape=(len(indptr) - 1, ncols))
+
+
+# Data of the current process to compute blocks of the distance matrix.
+_worker = {}
+
+def init_worker(specs, args):
+    shms = {name: SharedMemory(name=spec[0]) for name, spec in specs.items()}
+    arrays = {name: get_shared(shms[name], spec) for name, spec in specs.items()}
+    _worker.update(shms=shms, arrays=arrays, args=args)
+
+
+def compute_block(block):
+    """Compute the rows from i to j of the distance matrix."""
+    i, j = block
+    arrays = _worker['arrays']
+    parts1, parts2, dist_fn, support, prop1, prop2 = _worker['args']
+    matrix = arrays['matrix']
+
+    if parts1 is not None:  # call dist_fn for each pair
+        for r in range(i, j):
+            a = parts1[r]
+            matrix[r] = [dist_fn(a, b, support, prop1, prop2) for b in parts2]
+        return
+
+    ncols = arrays['nvalues'][0]
+    contents1 = get_csr(arrays, 'contents1', ncols)[i:j]
+    contents2 = get_csr(arrays, 'contents2', ncols)
+
+    # Number of shared observed properties, and the maximum number of them.
+    shared = (contents1 @ contents2.T).toarray()
+    size_max = np.maximum(arrays['sizes1'][i:j, None], arrays['sizes2'][None, :])
+    similarity = shared / size_max
+
+    if dist_fn == EUCL_DIST:
+        matrix[i:j] = 1 - similarity
+    elif dist_fn == EUCL_DIST_B:
+        # Dists of the leaves of each node with the values that the other has.
+        dists1_in2 = (get_csr(arrays, 'dists1', ncols)[i:j] @ contents2.T).toarray()
+        dists2_in1 = (get_csr(arrays, 'dists2', ncols) @ contents1.T).toarray().T
+
+        dist_a = (arrays['sums1'][i:j, None] - dists1_in2) / arrays['nleaves1'][i:j, None]
+        dist_b = (arrays['sums2'][None, :] - dists2_in1) / arrays['nleaves2'][None, :]
+
+        matrix[i:j] = 1 - (similarity + abs(dist_a - dist_b)) / 2
+
+
+def share(arrays):
+    """Return shared memory blocks with copies of the arrays, and their specs."""
+    shms, specs = {}, {}
+    for name, array in arrays.items():
+        shms[name] = SharedMemory(create=True, size=max(array.nbytes, 1))
+        specs[name] = (shms[name].name, array.shape, array.dtype.str)
+        get_shared(shms[name], specs[name])[...] = array
+    return shms, specs
+
+
+def get_shared(shm, spec):
+    """Return the array in the shared memory block shm described by spec."""
+    _, shape, dtype = spec
+    return np.ndarray(shape, dtype, buffer=shm.buf)
+
+
 ### Treediff ###
 
 def treediff(t1, t2, prop1='name', prop2='name', dist_fn=EUCL_DIST,
@@ -544,27 +789,8 @@ def treediff(t1, t2, prop1='name', prop2='name', dist_fn=EUCL_DIST,
     parts1 = sorted(parts1, key = lambda x : len(x[1]))
     parts2 = sorted(parts2, key = lambda x : len(x[1]))
 
-    if parallel == 'sync':
-        pool = mp.Pool(jobs)
-        gen = [[pool.apply(dist_fn,args=((n1,x),(n2,y),support,prop1,prop2)) for n2,y in parts2] for n1,x in parts1]
-        pool.close()
-
-    elif parallel == 'async':
-        pool = mp.Pool(jobs)
-        gen = [[pool.apply_async(dist_fn,args=((n1,x),(n2,y),support,prop1,prop2)) for n2,y in parts2] for n1,x in parts1]
-        pool.close()
-
-        for i, subgen in enumerate(gen):
-            for j, element in enumerate(subgen):
-                gen[i][j] = element.get()
-
-    else:
-        gen = ((dist_fn((n1,x),(n2,y),support,prop1,prop2) for n2,y in parts2) for n1,x in parts1)
-
-    matrix = np.empty([len(parts1),len(parts2)],dtype=np.float32)
-    for i, subgen in enumerate(gen):
-        for j, element in enumerate(subgen):
-            matrix[i][j] = element
+    matrix = distance_matrix(parts1, parts2, dist_fn, support, prop1, prop2,
+                             jobs, parallel)
 
     # Reduce matrix to avoid useless comparisons
     if reduce_matrix:
@@ -6,6 +6,8 @@ with expressions and strings.
 """
 
 from itertools import permutations
+from functools import lru_cache
+from types import CodeType
 import re
 
 from ete4 import Tree
@@ -53,37 +55,69 @@ class TreePattern(Tree):
         return search(self, tree, context, strategy)
 
 
+# Values of a node that can be used in the conditions, and functions too.
+NODE_VALUES = {
+    'node': lambda node: node,
+    'name': lambda node: node.props.get('name', ''),  # node.name could be None
+    'dist': lambda node: node.dist, 'd': lambda node: node.dist,
+    'support': lambda node: node.support, 'sup': lambda node: node.support,
+    'up': lambda node: node.up, 'parent': lambda node: node.up,
+    'children': lambda node: node.children, 'ch': lambda node: node.children,
+    'is_leaf': lambda node: node.is_leaf, 'is_root': lambda node: node.is_root,
+    'props': lambda node: node.props, 'p': lambda node: node.props,
+    'species': lambda node: getattr(node, 'species', ''),  # for PhyloTree
+    'size': lambda node: node.size,
+    'dx': lambda node: node.size[0], 'dy': lambda node: node.size[1]}
+
+FUNCTIONS = {
+    'get': dict.get,
+    'regex': re.search,
+    'startswith': str.startswith, 'endswith': str.endswith,
+    'upper': str.upper, 'lower': str.lower, 'split': str.split,
+    'any': any, 'all': all, 'len': len,
+    'sum': sum, 'abs': abs, 'float': float}
+
+
+def code_names(code):
+    """Return the names used in the compiled code (and in the code inside it)."""
+    # Comprehensions and generator expressions have their own code objects.
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= code_names(const)
+    return names
+
+
+@lru_cache(maxsize=1024)
+def get_node_values(code):
+    """Return [(name, get)] for the node values used in the compiled code."""
+    return [(name, NODE_VALUES[name])
+            for name in code_names(code) if name in NODE_VALUES]
+
+
+@lru_cache(maxsize=1024)
+def get_functions(code):
+    """Return a dict with the functions used in the compiled code."""
+    return {name: FUNCTIONS[name]
+            for name in code_names(code) if name in FUNCTIONS}
+
+
 def match(pattern, node, context=None):
     """Return True if the pattern matches the given node."""
     if pattern.children and len(node.children) != len(pattern.children):
         return False  # no match if there's not the same number of children
 
     context = context or {}
-    context_base = {
-        'node': node,
-        'name': node.props.get('name', ''),  # node.name could be None
-        'dist': node.dist, 'd': node.dist,
-        'support': node.support, 'sup': node.support,
-        'up': node.up, 'parent': node.up,
-        'children': node.children, 'ch': node.children,
-        'is_leaf': node.is_leaf, 'is_root': node.is_root,
-        'props': node.props, 'p': node.props,
-        'species': getattr(node, 'species', ''),  # for PhyloTree
-        'get': dict.get,
-        'size': node.size, 'dx': node.size[0], 'dy': node.size[1],
-        'regex': re.search,
-        'startswith': str.startswith, 'endswith': str.endswith,
-        'upper': str.upper, 'lower': str.lower, 'split': str.split,
-        'any': any, 'all': all, 'len': len,
-        'sum': sum, 'abs': abs, 'float': float}
-
     for k in context:
-        assert k not in context_base, f'colliding name: {k}'
+        assert k not in NODE_VALUES and k not in FUNCTIONS, f'colliding name: {k}'
 
-    eval_context = dict(context_base, **context)  # merge dicts
+    code = pattern.props['code']
+    eval_context = {name: get(node) for name, get in get_node_values(code)}
+    eval_context.update(get_functions(code))
+    eval_context.update(context)
 
     evaluate = safer_eval if pattern.safer else eval  # risky business
-    if not evaluate(pattern.props['code'], eval_context):
+    if not evaluate(code, eval_context):
         return False  # no match if the condition for this node if false
 
     if not pattern.children:
@@ -6,7 +6,7 @@ import os
 import pytest
 
 from ete4 import PhyloTree, NCBITaxa, ETE_DATA_HOME, update_ete_data
-from ete4.ncbi_taxonomy import ncbiquery
+from ete4.ncbi_taxonomy import ncbiquery, taxonomy
 
 DATABASE_PATH = ETE_DATA_HOME + '/tests/test_ncbiquery.taxa.sqlite'
 
@@ -153,6 +153,149 @@ def test_get_topology():
         assert diffs1['rf'] == diffs2['rf'] == diffs3['rf'] == 0.0
 
 
+def test_get_topology_annotations():
+    ncbi = NCBITaxa(dbfile=DATABASE_PATH)
+
+    taxids = ncbi.get_descendant_taxa(9604)  # Hominidae
+
+    t1 = ncbi.get_topology(taxids)  # annotated while building it
+    t2 = ncbi.get_topology(taxids, annotate=False)
+    ncbi.annotate_tree(t2)
+
+    assert t1.write(props=None) == t2.write(props=None)
+    assert t1['9606'].props['lineage'] == HUMAN_LINEAGE
+    assert t1['9606'].props['named_lineage'] == HUMAN_NAMED_LINEAGE
+
+
+def test_many_taxids():
+    ncbi = NCBITaxa(dbfile=DATABASE_PATH)
+
+    # More taxids than the variables allowed in a single query.
+    taxids = list(range(1, 100_000))
+
+    id2name = ncbi.get_taxid_translator(taxids)
+    assert id2name[9606] == 'Homo sapiens'
+    assert id2name[7507] == 'Mantis religiosa'
+
+    assert ncbi.get_rank(taxids)[9606] == 'species'
+    assert ncbi.get_lineage_translator(taxids)[9606] == HUMAN_LINEAGE
+
+    assert ncbi.get_taxid_translator(taxids) == id2name  # cached
+
+
+def test_taxonomy_index(tmp_path):
+    # Taxonomy: 1 -> (2 -> (4, 5), 3), with the root as its own parent.
+    index = taxonomy.build_index(
+        [1, 2, 3, 4, 5], [1, 1, 1, 2, 2],
+        ['no rank', 'genus', 'species', 'species', 'species'],
+        names=['root', 'g', 's3', 's4', 'sé5'])
+
+    path = str(tmp_path / 'taxa.sqlite.index')
+    index.save(path)
+
+    for index in [index, taxonomy.TaxonomyIndex.load(path)]:
+        assert list(index.taxids) == [1, 2, 4, 5, 3]  # preorder
+
+        assert list(index.descendants(1)) == [4, 5, 3]
+        assert list(index.descendants(1, intermediate_nodes=True)) == [2, 4, 5, 3]
+        assert list(index.descendants(2)) == [4, 5]
+        assert list(index.descendants(3)) == []
+
+        taxids, parents = index.subtree(2)
+        assert list(taxids) == [2, 4, 5]
+        assert list(parents) == [-1, 0, 0]
+
+        assert index.get_rank(2) == 'genus'
+        assert index.get_rank(6) is None
+
+        positions = index.positions([5, 3, 6])
+        assert positions == {5: 3, 3: 4}
+        assert index.lineages([3, 4]) == [[1, 2, 5], [1, 3]]
+
+        nodes, parents = index.induced([3, 4])
+        assert list(nodes) == [0, 1, 3, 4]
+        assert parents == [-1, 0, 1, 0]
+        assert index.names.take([3, 0]) == ['sé5', 'root']
+
+        with pytest.raises(ValueError):
+            index.descendants(6)
+
+
+def test_shared_handle():
+    import pickle
+    import threading
+    import multiprocessing
+
+    ncbi = NCBITaxa(dbfile=DATABASE_PATH)
+
+    taxids = list(range(1, 10_000))
+    id2name = ncbi.get_taxid_translator(taxids)
+
+    results = []
+    def lookup():
+        ncbi._cache = None  # make it go to the database
+        results.append(ncbi.get_taxid_translator(taxids) == id2name and
+                       ncbi.get_name_translator(['Homo sapiens']) == {'Homo sapiens': [9606]})
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 4
+
+    ncbi2 = pickle.loads(pickle.dumps(ncbi))
+    assert ncbi2.get_taxid_translator(taxids) == id2name
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(2) as pool:
+            assert pool.map(ncbi.get_lineage, [9606, 9606]) == [HUMAN_LINEAGE] * 2
+
+
+def build_test_db(dbfile, nodes):
+    """Create the database dbfile from nodes [(taxid, parent, rank, name), ...]."""
+    import io
+    import tarfile
+
+    dump = io.BytesIO()
+    with tarfile.open(fileobj=dump, mode='w') as tar:
+        for fname, text in [
+                ('nodes.dmp', ''.join(f'{t}\t|\t{p}\t|\t{r}\t|\n' for t, p, r, _ in nodes)),
+                ('names.dmp', ''.join(f'{t}\t|\t{n}\t|\t\t|\tscientific name\t|\n'
+                                      for t, _, _, n in nodes)),
+                ('merged.dmp', '')]:
+            data = text.encode()
+            info = tarfile.TarInfo(fname)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    dump.seek(0)
+    with tarfile.open(fileobj=dump) as tar:
+        taxonomy.build_db(dbfile, tar, ncbiquery.DB_VERSION)
+
+
+def test_index_of_replaced_db(tmp_path):
+    import shutil
+
+    dbfile1, dbfile2 = str(tmp_path / 'taxa1.sqlite'), str(tmp_path / 'taxa2.sqlite')
+    build_test_db(dbfile1, [(1, 1, 'no rank', 'root'), (2, 1, 'order', 'A'),
+                            (30, 2, 'species', 'A b')])
+    build_test_db(dbfile2, [(1, 1, 'no rank', 'root'), (3, 1, 'genus', 'C'),
+                            (40, 3, 'species', 'C d')])
+
+    assert NCBITaxa(dbfile1, update=False).get_lineage(30) == [1, 2, 30]
+
+    # Replace the database with another one (not with build_db()).
+    shutil.copyfile(dbfile2, dbfile1)
+
+    ncbi = NCBITaxa(dbfile1, update=False)
+    assert ncbi.get_rank([30, 3]) == {3: 'genus'}
+    assert ncbi.get_taxid_translator([40]) == {40: 'C d'}
+    with pytest.raises(ValueError):
+        ncbi.get_lineage(30)
+    assert ncbi.get_lineage(40) == [1, 3, 40]
+
+
 def test_merged_id():
     ncbi = NCBITaxa(dbfile=DATABASE_PATH)
 
@@ -7,7 +7,8 @@ Tests related to the nexus module.
 #   http://wiki.christophchamp.com/index.php?title=NEXUS_file_format
 #   http://hydrodictyon.eeb.uconn.edu/eebedia/index.php/Phylogenetics:_NEXUS_Format
 
-from tempfile import TemporaryFile
+from tempfile import TemporaryFile, NamedTemporaryFile
+import gzip
 import unittest
 
 from ete4 import Tree
@@ -102,3 +103,44 @@ end;
 
             trees = nexus.load(fp)
             assert trees == {}
+
+
+    def test_iter_trees(self):
+        text = """#NEXUS
+BEGIN TAXA;
+    TaxLabels Scarabaeus Drosophila Aranaeus;
+END;
+
+BEGIN TREES;
+    Translate beetle Scarabaeus, fly Drosophila, spider Aranaeus;
+    Tree tree1 = ((1,2),3);
+    Tree tree2 = [&U] ((beetle,fly),spider);
+    Tree tree3 = ((Scarabaeus,Drosophila),'Aranaeus;x');
+END;
+"""
+        with TemporaryFile(mode='w+t') as fp:
+            fp.write(text)
+            fp.seek(0)
+
+            newicks = [(name, t.write()) for name, t in nexus.iter_trees(fp)]
+
+            assert newicks == [
+                ('tree1', '((1,2),3);'),
+                ('tree2', '((Scarabaeus,Drosophila),Aranaeus);'),
+                ('tree3', "((Scarabaeus,Drosophila),'Aranaeus;x');")]
+
+        with NamedTemporaryFile(suffix='.nex.gz') as fp:  # compressed
+            fp.write(gzip.compress(text.encode()))
+            fp.flush()
+
+            names = [name for name, _ in nexus.iter_trees(fp.name, skip=1)]
+            assert names == ['tree2', 'tree3']
+
+            names = [name for name, _ in nexus.iter_trees(fp.name, step=2)]
+            assert names == ['tree1', 'tree3']
+
+        with TemporaryFile(mode='w+t') as fp:
+            fp.write('not a nexus file; (a,b);')
+            fp.seek(0)
+
+            self.assertRaises(nexus.NexusError, list, nexus.iter_trees(fp))
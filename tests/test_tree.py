@@ -1,14 +1,20 @@
 import sys
+import gzip
+import bz2
 import random
 import itertools
 import json
+import pickle
 from tempfile import NamedTemporaryFile
 import unittest
 
+import numpy as np
+
 from ete4 import Tree, PhyloTree
 from ete4.core.tree import TreeError
+from ete4.core import operations as ops, splits, prop_index
 from ete4.parser.newick import NewickError
-from ete4.parser import newick
+from ete4.parser import newick, ete_format
 
 from . import datasets as ds
 
@@ -139,6 +145,35 @@ class Test_Core_Tree(unittest.TestCase):
             t['B'].add_prop(letter, letter)
         self.assertEqual(expected_nw, t.write(props=None))
 
+    def test_iter_trees(self):
+        """Test reading files with many newicks, one tree at a time."""
+        newicks = ['(a,b);', "((c,'d;e'),g);", '(h[a comment],i);', 'j;']
+        text = '\n'.join(newicks) + '\n'
+
+        for compress in [lambda x: x, gzip.compress, bz2.compress]:
+            with NamedTemporaryFile() as fp:
+                fp.write(compress(text.encode()))
+                fp.flush()
+
+                trees = list(newick.iter_trees(fp.name))
+                self.assertEqual([t.write(format_root_node=True) for t in trees],
+                                 ['(a,b);', "((c,'d;e'),g);", '(h,i);', 'j;'])
+
+                trees = list(newick.iter_trees(open(fp.name, 'rb'), skip=1, step=2))
+                self.assertEqual([t.write(format_root_node=True) for t in trees],
+                                 ["((c,'d;e'),g);", 'j;'])
+
+        # Reading from a file in text mode, in small chunks.
+        with NamedTemporaryFile('w+t') as fp:
+            fp.write(text)
+            fp.flush()
+            fp.seek(0)
+
+            chunks = newick.read_chunks(fp, chunk_size=3)
+            self.assertEqual(list(newick.split_newicks(chunks)),
+                             ['(a,b);', "\n((c,'d;e'),g);",
+                              '\n(h[a comment],i);', '\nj;'])
+
     def test_repr(self):
         """Test that the Tree representation looks like we expect."""
         t = Tree()
@@ -364,6 +399,36 @@ class Test_Core_Tree(unittest.TestCase):
             self.assertEqual(nw_normalized, nw_back)
             self.assertEqual(nw_normalized, nw_back2)
 
+    def test_deep_newick(self):
+        """Test reading and writing trees deeper than the recursion limit."""
+        n = 5 * sys.getrecursionlimit()
+
+        # Caterpillar tree: (((a0,a1),a2),a3)...
+        nw = '(' * (n - 1) + 'a0,' + '),'.join(f'a{i}' for i in range(1, n)) + ');'
+
+        t = Tree(nw)
+        self.assertEqual(len(t), n)
+        self.assertEqual(t['a0'].level, n - 1)
+
+        self.assertEqual(t.write(), nw)  # writing deep trees works too
+
+        with NamedTemporaryFile('w+t') as fp:
+            newick.dump(t, fp, buffer_size=7)
+            fp.seek(0)
+            self.assertEqual(fp.read(), nw + '\n')
+
+    def test_newick_errors(self):
+        """Test the errors and messages of malformed newicks."""
+        for nw, message in [
+                ('(a,b)', 'text ends with no ";"'),
+                ('((a,b);', 'nodes text ends missing a matching ")"'),
+                ('(a,b)c);', 'root node ends at position 6, before tree ends'),
+                ("('a,b);", 'unfinished quoted name'),
+                ('(a[comment,b);', 'unfinished comment at position 1')]:
+            with self.assertRaises(NewickError) as cm:
+                Tree(nw)
+            self.assertTrue(str(cm.exception).startswith(message))
+
     def test_custom_formatting_formats(self):
         """Test change dist, name and support formatters."""
         t = Tree('((A:1.1111,B:2.2222)C:3.3333[&&NHX:support=1],D:4.4444);',
@@ -618,6 +683,24 @@ class Test_Core_Tree(unittest.TestCase):
         self.assertEqual(matrix1, matrix2)
         self.assertEqual(len(list(t.descendants())), (sample_size*2)-2 )
 
+        # Conserved internal nodes, and nodes that only join conserved ones.
+        t = Tree('(((((A,B)C)D,E)F,G)H,(I,J)K)root;', parser=1)
+        for names, result in [(['A', 'B'], '(A,B)root;'),
+                              (['A', 'B', 'C'], '((A,B)C)root;'),
+                              (['A', 'B', 'I'], '((A,B)C,I)root;'),
+                              (['A', 'B', 'F', 'H'], '(((A,B)F)H)root;'),
+                              (['E', 'J'], '(E,J)root;')]:
+            t1 = t.copy()
+            t1.prune(names)
+            self.assertEqual(t1.write(parser=1, format_root_node=True), result)
+
+        # Pruning a subtree, with PhyloTree.
+        t = PhyloTree('((a:1,(b:1,c:1):1):1,(d:1,e:1):1);')
+        ops.update_sizes_all(t)
+        t.children[0].prune(['a', 'c'], preserve_branch_length=True)
+        self.assertEqual(t.write(), '((a:1,c:2):1,(d:1,e:1):1);')
+        self.assertEqual(t.size, (3, 4))  # sizes are updated too
+
     def test_resolve_polytomy(self):
         t = Tree('((a,a,a,a),(b,b,b,(c,c,c)));')
         t.resolve_polytomy()
@@ -924,6 +1007,39 @@ class Test_Core_Tree(unittest.TestCase):
                  '[&&NHX:color=blue]):0.8[&&NHX:color=red]);')
         self.assertRaises(AssertionError, t.unroot, bprops=['color'])
 
+    def test_incremental_sizes(self):
+        """Test that editing operations keep the sizes of the nodes updated."""
+        random.seed(0)
+        t = Tree()
+        t.populate(50, dist_fn=random.random)
+        ops.update_sizes_all(t)
+
+        def assert_sizes_updated():
+            sizes = [n.size for n in t.traverse()]
+            ops.update_sizes_all(t)
+            self.assertEqual(sizes, [n.size for n in t.traverse()])
+
+        nodes = list(t.descendants())
+        for node in random.sample(nodes, 5):
+            t.set_outgroup(node)
+            assert_sizes_updated()
+
+        t.unroot()
+        assert_sizes_updated()
+
+        node = random.choice(list(t.descendants()))
+        ops.insert_intermediate(node, Tree({'dist': 0.1}))
+        assert_sizes_updated()
+
+        ops.join_branch(node.up)
+        assert_sizes_updated()
+
+        ops.remove(random.choice(list(t.descendants())))
+        assert_sizes_updated()
+
+        t.prune(random.sample(list(t.leaves()), 10))
+        assert_sizes_updated()
+
     def test_tree_navigation(self):
         t = Tree('(((A,B)H,C)I,(D,F)J)root;', parser=1)
         postorder = [n.name for n in t.traverse("postorder")]
@@ -1088,6 +1204,134 @@ class Test_Core_Tree(unittest.TestCase):
         self.assertTrue(all(abs(node.dist - leaf.dist) < EPSILON
                             for node in leaf.ancestors() if not node.is_root))
 
+    def test_to_arrays(self):
+        t = Tree()
+        t.populate(100, dist_fn=random.random)
+
+        ft = t.to_arrays()
+        nodes = ft.nodes
+
+        self.assertEqual(nodes, list(t.traverse('preorder')))
+        self.assertEqual([nodes[i] for i in ft.postorder],
+                         list(t.traverse('postorder')))
+        self.assertEqual([nodes[i] for i in ft.leaves], list(t.leaves()))
+        self.assertEqual([nodes[i].up for i in range(1, len(ft))],
+                         [nodes[i] for i in ft.parent[1:]])
+        self.assertEqual(ft.leaf_counts().tolist(), [len(n) for n in nodes])
+        self.assertEqual(ft.subtree_sizes().tolist(),
+                         [len(list(n.traverse())) for n in nodes])
+
+        i = 5
+        children = ft.children[ft.child_offsets[i]:ft.child_offsets[i+1]]
+        self.assertEqual([nodes[j] for j in children], nodes[i].children)
+
+        for i, d in enumerate(ft.root_distances()):
+            self.assertAlmostEqual(d, t.get_distance(t, nodes[i]))
+
+        pairs = [(random.randrange(len(ft)), random.randrange(len(ft)))
+                 for _ in range(50)]
+        nodes1, nodes2 = zip(*pairs)
+        for (i, j), k, d in zip(pairs, ft.lca(nodes1, nodes2),
+                                ft.distances(nodes1, nodes2)):
+            self.assertIs(nodes[k], t.common_ancestor([nodes[i], nodes[j]]))
+            self.assertAlmostEqual(d, t.get_distance(nodes[i], nodes[j]))
+
+        ft.update_sizes()
+        sizes = [n.size for n in nodes]
+        ops.update_sizes_all(t)
+        self.assertEqual(sizes, [n.size for n in nodes])
+
+        ft.to_ultrametric()  # also writes the new dists to the nodes
+        d_max = max(t.get_distance(t, leaf) for leaf in t)
+        self.assertTrue(all(abs(t.get_distance(t, leaf) - d_max) < 1e-9
+                            for leaf in t))
+
+    def test_lca_index(self):
+        t = Tree()
+        t.populate(100, dist_fn=random.random)
+        index = t.get_lca_index()
+
+        nodes = list(t.traverse())
+        pairs = [(random.choice(nodes), random.choice(nodes)) for _ in range(50)]
+        for n1, n2 in pairs:
+            self.assertIs(index.common_ancestor(n1, n2),
+                          t.common_ancestor([n1, n2]))
+            self.assertAlmostEqual(index.get_distance(n1, n2),
+                                   t.get_distance(n1, n2))
+            self.assertEqual(index.get_distance(n1, n2, topological=True),
+                             t.get_distance(n1, n2, topological=True))
+
+        # Batched queries (with the positions of the nodes).
+        positions1 = [index.position(n1) for n1, _ in pairs]
+        positions2 = [index.position(n2) for _, n2 in pairs]
+        lcas = index.common_ancestors(positions1, positions2)
+        dists = index.distances(positions1, positions2)
+        for (n1, n2), i, d in zip(pairs, lcas, dists):
+            self.assertIs(index.flat.nodes[i], t.common_ancestor([n1, n2]))
+            self.assertAlmostEqual(d, t.get_distance(n1, n2))
+
+        # The index is updated when the tree changes.
+        a, c = t.children[0], next(t.children[1].leaves())
+        leaf = a.add_child(name='new', dist=1)
+        self.assertIs(index.common_ancestor(leaf, c), t)
+        self.assertAlmostEqual(index.get_distance(leaf, c),
+                               t.get_distance(leaf, c))
+        t.set_outgroup(c)
+        self.assertIs(index.common_ancestor(leaf, c),
+                      t.common_ancestor([leaf, c]))
+
+        leaf2 = leaf.up.add_child()  # a new node with no dist
+        self.assertIs(index.common_ancestor(leaf2, leaf), leaf.up)
+
+        leaf.add_prop('dist', 10)  # changes in dists are seen too
+        self.assertAlmostEqual(index.get_distance(leaf, c),
+                               t.get_distance(leaf, c))
+
+        # Changes in other trees do not outdate the index.
+        flat = index.flat
+        t2 = Tree('(a:1,b:1);')
+        t2[0].dist = 2
+        t2.add_child(name='c')
+        index.common_ancestor(leaf, c)
+        self.assertIs(index.flat, flat)
+
+    def test_prop_index(self):
+        t = Tree('(((a,b)x,(c,d)y)w,(e,a)k)r;', parser=1)
+        index = t.create_index('name')
+
+        self.assertEqual(len(index.get('a')), 2)
+        self.assertIs(t['x'], index.get('x')[0])
+        self.assertEqual(list(t['k'].search_leaves_by_name('a')),
+                         [t['k'].children[1]])
+
+        # The index follows the changes made with the tree methods.
+        t['c'].add_prop('name', 'z')
+        t['y'].add_child(name='f')
+        t['e'].name = 'g'
+        t['x'].detach()
+        t['w'].delete()
+        self.assertTrue(index.up_to_date)
+
+        names = {n.name for n in t.traverse()}
+        self.assertEqual(set(index.nodes), names)
+        self.assertEqual(names, {'r', 'y', 'z', 'd', 'f', 'k', 'g', 'a'})
+        self.assertEqual(t['f'].up, t['y'])
+        self.assertNotIn('c', t)
+
+        t.prune(['z', 'g'])
+        self.assertEqual(set(t.search_nodes(name='a')), set())
+        self.assertEqual(set(index.nodes), {'r', 'z', 'g'})
+
+        with self.assertRaises(TreeError):
+            t['z'].create_index('name')
+
+        with self.assertRaises(TreeError):
+            t.create_index('is_leaf')  # an attribute, not in node.props
+
+        t.drop_index('name')
+        self.assertNotIn(index, prop_index.indexed.get('name', ()))
+        self.assertEqual(list(t.search_nodes(name='z')), [t['z']])
+
     def test_expand_polytomies_rf(self):
         gtree = Tree('((a:1, (b:1, (c:1, d:1):1):1), (e:1, (f:1, g:1):1):1);')
         ref1 = Tree('((a:1, (b:1, c:1, d:1):1):1, (e:1, (f:1, g:1):1):1);')
@@ -1121,6 +1365,36 @@ class Test_Core_Tree(unittest.TestCase):
             gtree.robinson_foulds(ref, expand_polytomies=True,
                                   polytomy_size_limit=8)[0]
 
+    def test_rf_matrix(self):
+        random.seed(0)
+        names = list('abcdefghij')
+
+        trees = []
+        for size in [10, 10, 8, 10, 7]:
+            t = Tree()
+            t.populate(size, names=random.sample(names, size))
+            trees.append(t)
+
+        for unrooted in [False, True]:
+            rf = splits.rf_matrix(trees, unrooted=unrooted)
+            nrf = splits.rf_matrix(trees, unrooted=unrooted, normalized=True)
+            for i, t1 in enumerate(trees):
+                for j, t2 in enumerate(trees):
+                    result = t1.robinson_foulds(t2, unrooted_trees=unrooted)
+                    self.assertEqual(rf[i, j], result[0])
+                    self.assertAlmostEqual(nrf[i, j],
+                        result[0] / result[1] if result[1] else 0)
+
+        # Against other trees, and with several processes.
+        rf = splits.rf_matrix(trees[:2], trees[2:], processes=2)
+        self.assertEqual(rf.shape, (2, 3))
+        self.assertEqual(rf[1, 0], trees[1].robinson_foulds(trees[2])[0])
+
+        with self.assertRaises(TreeError):
+            splits.rf_matrix([Tree('(a,b,c);')])  # unrooted tree
+        with self.assertRaises(TreeError):
+            splits.rf_matrix([Tree('((a,b),(a,c));')])  # duplicated leaves
+
     # TODO: Fix the compare() function and this test.
     # def test_tree_compare(self):
     #     def _astuple(d):
@@ -1610,6 +1884,79 @@ class Test_Core_Tree(unittest.TestCase):
         self.assertEqual((t_pkl["A"]).props['complex'][0], [0,1])
         self.assertEqual((t_deep["A"]).props['testfn'](), "YES")
 
+    def test_ete_format(self):
+        """Test reading and writing trees in the (binary) ete format."""
+        t = Tree('((A:1,B:2)0.5:3,(C:4,D:5)0.9:6);')
+        t.name = 'root'
+        t['A'].add_props(label='custom Value', complex=[[0,1], [2,3]])
+        for node, sp in zip(t, ['human', 'human', 'mouse', 'human']):
+            node.add_props(species=sp, count=len(sp), ok=(sp == 'human'))
+        t['C'].add_props(big=2**70, weird={'a': 1}, name_utf8='ñandú')
+
+        props = [n.props for n in t.traverse()]
+
+        for compression in [None, 'gzip']:
+            data = ete_format.dumps(t, compression=compression)
+            self.assertTrue(data.startswith(ete_format.MAGIC))
+
+            for t2 in [ete_format.loads(data),
+                       Tree(data),  # guessing the format
+                       Tree(data, parser='ete'),
+                       PhyloTree(data, parser='ete')]:
+                self.assertEqual([n.props for n in t2.traverse()], props)
+                self.assertEqual(t2.write(props=None, format_root_node=True),
+                                 t.write(props=None, format_root_node=True))
+
+        with NamedTemporaryFile() as fp:  # reading and writing files
+            t.write(fp.name, parser='ete')
+            t2 = Tree(open(fp.name, 'rb'))
+            self.assertEqual([n.props for n in t2.traverse()], props)
+
+        self.assertRaises(ete_format.EteFormatError, ete_format.loads, b'ETE')
+        self.assertRaises(ete_format.EteFormatError, ete_format.dumps, t, 'rar')
+
+    def test_mapped_tree(self):
+        """Test read-only trees from memory-mapped files in ete format."""
+        t = Tree('((A:1,B:2)0.5:3,(C:4,(D:5,E:1):2)0.9:6,F:1);')
+        t['A'].add_props(label='x', complex=[1, 2])
+        t['D'].add_props(label='y')
+
+        with NamedTemporaryFile() as fp:
+            t.write(fp.name, parser='ete')
+            t2 = ete_format.open_tree(fp.name)
+
+            self.assertIsNone(t2._kids)  # children not created yet
+            self.assertEqual(t2['D'].props, t['D'].props)
+            self.assertEqual([n.props for n in t2.traverse()],
+                             [n.props for n in t.traverse()])
+            self.assertEqual(t2.write(props=None), t.write(props=None))
+            self.assertEqual([n.is_leaf for n in t2.traverse()],
+                             [n.is_leaf for n in t.traverse()])
+
+            t2.update_sizes()
+            ops.update_sizes_all(t)
+            self.assertEqual([n.size for n in t2.traverse()],
+                             [n.size for n in t.traverse()])
+
+            ft, ft2 = t.to_arrays(), t2.to_arrays()  # mapped nodes too
+            self.assertEqual(ft2.parent.tolist(), ft.parent.tolist())
+            self.assertEqual(ft2.root_distances().tolist(),
+                             ft.root_distances().tolist())
+            self.assertEqual(t2.get_lca_index().get_distance(t2['A'], t2['D']),
+                             t.get_distance('A', 'D'))
+
+            node = pickle.loads(pickle.dumps(t2['E']))
+            self.assertEqual(node.props, t['E'].props)
+            self.assertEqual(node.root.write(), t.write())
+
+            self.assertRaises(TreeError, t2.add_child)
+            self.assertRaises(TreeError, t2['A'].detach)
+
+            with open(fp.name, 'wb') as fout:
+                ete_format.dump(t, fout, compression='gzip')
+            self.assertRaises(ete_format.EteFormatError,
+                              ete_format.open_tree, fp.name)
+
     def test_cophenetic_matrix(self):
         t = Tree(ds.nw_full)
         dists, leaves = t.cophenetic_matrix()
@@ -1686,6 +2033,23 @@ class Test_Core_Tree(unittest.TestCase):
                 self.assertAlmostEqual(actualdists[i][j], dists[i][j], places=4)
         self.assertEqual(actualleaves, leaves)
 
+        # Condensed matrix, for a subset of the leaves, in float32.
+        subset = ['Hsa0000001', 'Ddi0002240', 'Ptr0000001']
+        condensed, names = t.cophenetic_matrix(subset, dtype=np.float32,
+                                               condensed=True)
+        self.assertEqual(names, subset)
+        self.assertEqual(condensed.dtype, np.float32)
+        ids = [actualleaves.index(name) for name in subset]
+        for value, (i, j) in zip(condensed, [(0, 1), (0, 2), (1, 2)]):
+            self.assertAlmostEqual(value, actualdists[ids[i]][ids[j]], places=4)
+
+        # Writing to a memory-mapped array.
+        with NamedTemporaryFile() as fp:
+            n = len(actualleaves)
+            out = np.memmap(fp.name, dtype=np.float64, mode='w+', shape=(n, n))
+            t.cophenetic_matrix(out=out)
+            self.assertTrue(np.allclose(out, actualdists))
+
 
 if __name__ == '__main__':
     unittest.main()
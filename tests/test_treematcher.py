@@ -77,3 +77,14 @@ def test_safer():
                               '  node.species=="b")', safer=True)
     with pytest.raises(ValueError):
         list(tp_safer.search(t))  # asked for unknown function get_species()
+
+
+def test_nested_names():
+    t = Tree('(abc,(de,fg)x);', parser=1)
+
+    # Names used only inside generator expressions and comprehensions.
+    pattern = tm.TreePattern(""" "any(s in name for s in ['ab'])" """)
+    assert [n.name for n in pattern.search(t)] == ['abc']
+
+    pattern = tm.TreePattern(""" "[c for c in ch if len(c.children) == 0] == ch" """)
+    assert [n.name for n in pattern.search(t)] == ['abc', 'x', 'de', 'fg']